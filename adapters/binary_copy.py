@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+""" Encoder of COPY ... FROM STDIN (FORMAT binary)
+
+    The rows are built a column at a time with numpy: every field is
+    its int32 length and its bytes in the network order. A column is a
+    (rows, width) uint8 array, variable width columns (varchar) come
+    with the array of their lengths and are cut by a mask in the end.
+"""
+
+import numpy as np
+
+from engines.records import UID_SIZE, RECORD_SIZE
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + b'\x00\x00\x00\x00' + b'\x00\x00\x00\x00'
+PGCOPY_TRAILER = b'\xff\xff'
+
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+
+def uuid_column(raw):
+    """ uuid: 16 raw bytes """
+    return np.asarray(raw, dtype=np.uint8).reshape(-1, UID_SIZE), None
+
+
+def text_column(values):
+    """ varchar/text: the utf-8 bytes of a numpy bytes (S) array """
+    values = np.asarray(values)
+    if values.dtype.kind == 'U':
+        values = np.char.encode(values, 'utf-8')
+    data = values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+    return data, np.char.str_len(values)
+
+
+def timestamp_column(values):
+    """ timestamp: int64 microseconds since 2000-01-01 """
+    micros = (np.asarray(values).astype('datetime64[us]') - PG_EPOCH).astype(np.int64)
+    return micros.astype('>i8').view(np.uint8).reshape(-1, 8), None
+
+
+def float8_column(values):
+    """ float8: IEEE 754 double """
+    return np.asarray(values, dtype='>f8').view(np.uint8).reshape(-1, 8), None
+
+
+def encode_columns(columns):
+    """ Return the binary COPY tuples (without the header) of the columns """
+    num = len(columns[0][0])
+    width = 2 + sum(4 + data.shape[1] for data, _ in columns)
+
+    rows = np.zeros((num, width), dtype=np.uint8)
+    rows[:, 0:2] = np.array([len(columns)], dtype='>i2').view(np.uint8)
+    mask = None
+
+    position = 2
+    for data, lengths in columns:
+        field_width = data.shape[1]
+        if lengths is None:
+            field_lengths = np.full(num, field_width, dtype='>i4')
+        else:
+            field_lengths = np.asarray(lengths).astype('>i4')
+        rows[:, position:position + 4] = field_lengths.view(np.uint8).reshape(num, 4)
+        rows[:, position + 4:position + 4 + field_width] = data
+
+        if lengths is not None:
+            if mask is None:
+                mask = np.ones((num, width), dtype=bool)
+            mask[:, position + 4:position + 4 + field_width] = \
+                np.arange(field_width) < np.asarray(lengths)[:, None]
+        position += 4 + field_width
+
+    return rows.tobytes() if mask is None else rows[mask].tobytes()
+
+
+def encode_hash_records(packed, adapter_name):
+    """ Return the (adapter_name, transaction_uid, hash) tuples of the
+        storage table for the packed (uid, digest) records """
+    records = np.frombuffer(packed, dtype=np.uint8).reshape(-1, RECORD_SIZE)
+    if not len(records):
+        return b''
+
+    name = np.frombuffer(adapter_name.encode('utf-8'), dtype=np.uint8)
+    return encode_columns([(np.broadcast_to(name, (len(records), len(name))), None),
+                           uuid_column(records[:, :UID_SIZE]),
+                           uuid_column(records[:, UID_SIZE:])])
+
+
+def encode_uids(packed_uids):
+    """ Return the one-column tuples of the packed transaction_uid """
+    uids = np.frombuffer(packed_uids, dtype=np.uint8).reshape(-1, UID_SIZE)
+    if not len(uids):
+        return b''
+    return encode_columns([uuid_column(uids)])
+
+
+def binary_stream(parts):
+    """ Wrap the encoded parts with the header and the trailer """
+    yield PGCOPY_HEADER
+    for part in parts:
+        if part:
+            yield part
+    yield PGCOPY_TRAILER
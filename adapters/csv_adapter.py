@@ -3,50 +3,208 @@
 """ Working with CSV file """
 
 import os
-import multiprocessing as mp
+import glob
+import mmap
 import hashlib
 
+from utils.chunk_cache import ChunkCache
+from utils.columnar import check_arrow, hash_csv_buffer
+from utils.compression import decompress, detect_compression, get_frames, open_stream
+from utils.digest import get_scheme
 from utils.monitoring import Monitoring
+from utils.iterator_file import IteratorFile
+from utils.parallel import ordered_imap
 from adapters.database_tool import PostgreSQLCommon
+from adapters.binary_copy import PGCOPY_HEADER, PGCOPY_TRAILER, binary_stream, encode_hash_records
+from engines.records import RECORD_SIZE, unpack_hash_lines
 
 m = Monitoring('csv_adapter')
 
+_mappings = {}
+
+
+def get_mapping(file_name, length):
+    """ Return the read-only memory map of the first `length` bytes of the
+        file. The map is opened once by the main process before the pool
+        starts, so the forked workers share it instead of reopening """
+    key = (os.path.abspath(file_name), length)
+    mapping = _mappings.get(key)
+    if mapping is None:
+        if not length:
+            return b''
+        with open(file_name, 'rb') as file:
+            mapping = mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ)
+        _mappings[key] = mapping
+    return mapping
+
+
+def release_mapping(file_name, length):
+    """ Close the memory map of the process """
+    mapping = _mappings.pop((os.path.abspath(file_name), length), None)
+    if mapping is not None:
+        mapping.close()
+
+
+def get_input_files(file_name_raw, exclude=()):
+    """ Return the sorted CSV files of a file name, a directory or a glob """
+    if os.path.isdir(file_name_raw):
+        file_names = [file_name
+                      for pattern in ('*.csv', '*.csv.gz', '*.csv.zst')
+                      for file_name in glob.glob(os.path.join(file_name_raw, pattern))]
+    else:
+        file_names = glob.glob(file_name_raw)
+
+    exclude = [os.path.abspath(file_name) for file_name in exclude]
+    file_names = sorted(file_name for file_name in file_names
+                        if os.path.isfile(file_name) and os.path.abspath(file_name) not in exclude)
+    if not file_names:
+        raise FileNotFoundError('No CSV files found by %s' % file_name_raw)
+    return file_names
+
+
+class CsvFile:
+    """ One input file and its part to be read """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # Reading starts from file_start (the watermark of incremental runs)
+        self.file_start = 0
+        self.file_end = os.path.getsize(file_name)
+        # gzip or zstd, the offsets are the ones of the compressed file
+        self.compression = detect_compression(file_name)
+        if not self.compression:
+            self.file_end = self.get_line_end(self.file_end)
+
+    def get_line_end(self, file_size, block_size=64*1024):
+        """ Return the offset after the last complete line: a line being
+            appended is left for the next run, so neither the chunks nor
+            the watermark end in the middle of it """
+        with open(self.file_name, 'rb') as file:
+            block_end = file_size
+            while block_end > 0:
+                block_start = max(0, block_end - block_size)
+                file.seek(block_start)
+                line_end = file.read(block_end - block_start).rfind(b'\n')
+                if line_end >= 0:
+                    line_end += block_start + 1
+                    break
+                block_end = block_start
+            else:
+                line_end = 0
+
+        if line_end < file_size:
+            m.info('CSV file %s ends with an incomplete line of %s bytes, '
+                   'it is left for the next run' % (self.file_name, file_size - line_end))
+        return line_end
+
+    def get_fingerprint(self, offset, sample_size=64*1024):
+        """ Identity of the first `offset` bytes: their head, their tail
+            and the length """
+        fingerprint = hashlib.blake2b(str(offset).encode(), digest_size=16)
+        with open(self.file_name, 'rb') as file:
+            fingerprint.update(file.read(min(sample_size, offset)))
+            file.seek(max(0, offset - sample_size))
+            fingerprint.update(file.read(min(sample_size, offset)))
+        return fingerprint.hexdigest()
+
+    def set_watermark(self, offset, fingerprint):
+        """ Start reading after a reconciled offset if the file still has
+            the same content before it, from the beginning otherwise """
+        if offset <= self.file_end and fingerprint == self.get_fingerprint(offset):
+            self.file_start = offset
+            m.info('CSV reading of %s continues from %s Mb'
+                   % (self.file_name, CsvAdapter.get_size_in_mb(offset)))
+        else:
+            self.file_start = 0
+            m.info('CSV file %s has been changed, it will be read in full'
+                   % self.file_name)
+
+    def chunkify(self, size):
+        """ Return the chunks of the file: (file name, start, size) """
+        if self.compression:
+            yield from self.chunkify_compressed(size)
+            return
+
+        with open(self.file_name, 'rb') as file:
+            file.seek(self.file_start)
+            chunk_end = file.tell()
+            while chunk_end < self.file_end:
+                chunk_start = chunk_end
+                file.seek(size, 1)
+                file.readline()
+                chunk_end = min(file.tell(), self.file_end)
+                yield self.file_name, chunk_start, chunk_end - chunk_start
+
+    def chunkify_compressed(self, size):
+        """ Return the groups of independent frames of about `size` compressed
+            bytes: (file name, start, size, None), the workers decompress
+            them. A file of one stream is decompressed here by blocks of
+            `size` bytes: (file name, offset, size, data). The lines are cut
+            at the chunk edges in both cases """
+        mapping = get_mapping(self.file_name, self.file_end)
+        frames = get_frames(mapping, self.file_start, self.file_end, self.compression)
+
+        if frames:
+            bounds = [frames[0]]
+            for offset in frames[1:]:
+                if offset - bounds[-1] >= size:
+                    bounds.append(offset)
+            bounds.append(self.file_end)
+
+            for chunk_start, chunk_end in zip(bounds, bounds[1:]):
+                yield self.file_name, chunk_start, chunk_end - chunk_start, None
+            return
+
+        m.info('CSV file %s is one %s stream, it is decompressed serially'
+               % (self.file_name, self.compression))
+        with open(self.file_name, 'rb') as file:
+            file.seek(self.file_start)
+            stream = open_stream(file, self.compression)
+            offset = 0
+            while True:
+                data = stream.read(size)
+                if not data:
+                    break
+                yield self.file_name, offset, len(data), data
+                offset += len(data)
+
 
 class CsvAdapter:
     """ Class for the reading of CSV """
     def __init__(self, **kwargs):
+        # A file, a directory of *.csv files or a glob
         self.file_name_raw = kwargs['file_name_raw']
-        self.file_end = os.path.getsize(self.file_name_raw)
-        self.file_end_mb = self.get_size_in_mb(self.file_end)
-
         self.schema_target = kwargs['schema_target']
         self.file_name_hash = kwargs['file_name_hash']
 
+        self.files = self.get_files()
+        self.file_end_mb = self.get_size_in_mb(sum(csv_file.file_end
+                                                   for csv_file in self.files.values()))
+
         self.storage_table = '.'.join([self.schema_target, kwargs['storage_table']])
         self.chunk_counter = 0
 
-    @staticmethod
-    def md5(input_string):
-        """ Get hash from a string """
-        return hashlib.md5(input_string.encode('utf-8')).hexdigest()
-
-    def get_hash(self, arr):
-        """ Return the output hash-row """
-        output_str = ('csv_adapter\t' +
-                      arr[0] + '\t' +
-                      self.md5(self.md5(arr[1]) +
-                               self.md5(arr[2]) +
-                               self.md5(arr[3]) +
-                               self.md5(arr[4])))
-        return output_str
-
-    def process(self, line):
-        """ Save hashed line into file """
-        arr_line = list(line.split('\t'))
-        hash_line = self.get_hash(arr_line)
-
-        with open(self.file_name_hash, 'a') as hash_txt:
-            hash_txt.write(hash_line + '\n')
+        # Feed the hashes into COPY directly instead of the hash file
+        self.streaming = kwargs.get('streaming', False)
+        self.scheme = get_scheme(kwargs.get('digest_scheme', 'md5_nested_v1'))
+        # text: tab separated hash lines, binary: the binary COPY format
+        self.binary = kwargs.get('copy_format') == 'binary'
+
+        # lines: the raw lines are hashed as they are,
+        # arrow: the chunks are parsed into columns and canonicalized in batch
+        self.ingest_mode = kwargs.get('ingest_mode') or 'lines'
+        if self.ingest_mode == 'arrow':
+            check_arrow()
+
+        # Hashed chunks of the previous runs, disabled without cache_dir
+        self.cache = None
+        if kwargs.get('cache_dir'):
+            self.cache = ChunkCache(kwargs['cache_dir'], kwargs.get('cache_max_mb', 1024))
+
+    def get_files(self):
+        """ Return the input files by their names """
+        return dict((file_name, CsvFile(file_name))
+                    for file_name in get_input_files(self.file_name_raw,
+                                                     exclude=[self.file_name_hash]))
 
     @staticmethod
     def get_size_in_mb(file_size):
@@ -54,69 +212,255 @@ class CsvAdapter:
         return round(file_size / (1024 * 1024), 2)
 
     @m.timing
-    def process_wrapper(self, chunk_start, chunk_size):
-        """ Read a particular chunk """
-        with open(self.file_name_raw, newline='\n') as file:
-            file.seek(chunk_start)
-            lines = file.read(chunk_size).splitlines()
-            for line in lines:
-                self.process(line)
-
-        message_txt = (('\tReading from {:7} Mb to {:7} Mb (total: {} Mb). ')
-                       .format(self.get_size_in_mb(chunk_start),
-                               self.get_size_in_mb(chunk_start + chunk_size),
-                               self.file_end_mb))
-        print(message_txt, end='')
+    @m.profiled
+    def process_wrapper(self, file_name, chunk_start, chunk_size, packed=False):
+        """ Hash a particular chunk and return it as one buffer,
+            as text lines or as packed (uid, digest) records """
+        mapping = get_mapping(file_name, self.files[file_name].file_end)
+        chunk_end = chunk_start + chunk_size
+
+        records = None
+        if self.cache:
+            with memoryview(mapping) as view:
+                checksum = self.cache.checksum(view[chunk_start:chunk_end])
+            key = self.cache.get_key(file_name, chunk_start, chunk_size,
+                                     checksum, '/'.join([self.scheme.scheme_id,
+                                                         self.ingest_mode]))
+            records = self.cache.get(key)
+
+        hash_buffer = None
+        if records is None:
+            if self.cache or packed:
+                records = self.hash_chunk(mapping, chunk_start, chunk_end)
+                if self.cache:
+                    self.cache.put(key, records)
+            else:
+                hash_buffer = self.hash_chunk(mapping, chunk_start, chunk_end, 'csv_adapter')
+            cached = ''
+        else:
+            cached = '(cached)'
+
+        if hash_buffer is None:
+            rows = len(records) // RECORD_SIZE
+        else:
+            rows = hash_buffer.count('\n')
+        m.metrics.add_progress(rows, chunk_size)
+
+        m.info('Reading {} from {:7} Mb to {:7} Mb (total: {} Mb) {}'
+               .format(os.path.basename(file_name),
+                       self.get_size_in_mb(chunk_start),
+                       self.get_size_in_mb(chunk_start + chunk_size),
+                       self.file_end_mb,
+                       cached))
+
+        if packed:
+            return records
+        if hash_buffer is None:
+            hash_buffer = unpack_hash_lines(records, 'csv_adapter')
+        return hash_buffer
+
+    def hash_chunk(self, buffer, start, end, adapter_name=None):
+        """ Hash the lines of buffer[start:end] in the ingestion mode """
+        if self.ingest_mode == 'arrow':
+            return hash_csv_buffer(buffer, start, end, self.scheme, adapter_name)
+        return self.scheme.hash_buffer(buffer, start, end, adapter_name)
+
+    @m.timing
+    @m.profiled
+    def process_compressed(self, file_name, chunk_start, chunk_size, data=None, packed=False):
+        """ Decompress a chunk if it is not yet and hash its whole lines.
+            Return (file name, head, hashed buffer, tail): the bytes before
+            the first and after the last line end are joined with the
+            neighbour chunks by stitch(), hashed buffer is None if the chunk
+            has no line end at all. The chunks are cached with their edges,
+            by the compressed frames or by the decompressed data of a stream """
+        csv_file = self.files[file_name]
+        mapping = get_mapping(file_name, csv_file.file_end)
+
+        parts = None
+        if self.cache:
+            if data is None:
+                with memoryview(mapping) as view:
+                    checksum = self.cache.checksum(view[chunk_start:chunk_start + chunk_size])
+            else:
+                checksum = self.cache.checksum(data)
+            key = self.cache.get_key(file_name, chunk_start, chunk_size,
+                                     checksum, '/'.join([self.scheme.scheme_id,
+                                                         self.ingest_mode,
+                                                         csv_file.compression]))
+            parts = self.cache.get_parts(key)
+
+        if parts is None:
+            if data is None:
+                with memoryview(mapping) as view:
+                    data = decompress(csv_file.compression,
+                                      view[chunk_start:chunk_start + chunk_size])
+
+            first = data.find(b'\n')
+            if first < 0:
+                return file_name, data, None, b''
+            last = data.rfind(b'\n')
+            head, tail = data[:first + 1], data[last + 1:]
+
+            if self.cache or packed:
+                records = self.hash_chunk(data, first + 1, last + 1)
+                if self.cache:
+                    self.cache.put_parts(key, [head, records, tail])
+                hash_buffer = None
+            else:
+                hash_buffer = self.hash_chunk(data, first + 1, last + 1, 'csv_adapter')
+            cached = ''
+        else:
+            head, records, tail = parts
+            hash_buffer = None
+            cached = '(cached)'
+
+        if hash_buffer is None:
+            rows = len(records) // RECORD_SIZE
+            if not packed:
+                hash_buffer = unpack_hash_lines(records, 'csv_adapter')
+        else:
+            rows = hash_buffer.count('\n')
+        m.metrics.add_progress(rows, chunk_size)
+
+        m.info('Reading {} from {:7} Mb to {:7} Mb (total: {} Mb) {}'
+               .format(os.path.basename(file_name),
+                       self.get_size_in_mb(chunk_start),
+                       self.get_size_in_mb(chunk_start + chunk_size),
+                       self.file_end_mb,
+                       cached))
+        return file_name, head, records if packed else hash_buffer, tail
+
+    def process_chunk(self, chunk):
+        """ Unpack the chunk tuple for process_wrapper """
+        if len(chunk) == 4:
+            return self.process_compressed(*chunk)
+        return self.process_wrapper(*chunk)
+
+    def process_chunk_packed(self, chunk):
+        """ Return the hashed chunk as packed (uid, digest) records """
+        if len(chunk) == 4:
+            return self.process_compressed(*chunk, packed=True)
+        return self.process_wrapper(*chunk, packed=True)
+
+    def hash_line(self, line, packed):
+        """ Hash a line stitched from the edges of two chunks """
+        hash_buffer = self.hash_chunk(line, 0, len(line), None if packed else 'csv_adapter')
+        m.metrics.add_progress(len(hash_buffer) // RECORD_SIZE if packed
+                               else hash_buffer.count('\n'))
+        return hash_buffer
+
+    def stitch(self, results, packed=False):
+        """ Pass the hashed chunks on in order, the lines cut by the edges
+            of the compressed chunks are joined and hashed here """
+        file_name = None
+        carry = b''
+
+        for result in results:
+            if not isinstance(result, tuple) or result[0] != file_name:
+                if carry:
+                    yield self.hash_line(carry, packed)
+                file_name = None
+                carry = b''
+            if not isinstance(result, tuple):
+                yield result
+                continue
+
+            file_name, head, hash_buffer, tail = result
+            if hash_buffer is None:
+                carry += head
+                continue
+            if carry or head:
+                yield self.hash_line(carry + head, packed)
+            yield hash_buffer
+            carry = tail
+
+        if carry:
+            yield self.hash_line(carry, packed)
+
+    def evict_cache(self):
+        """ Keep the chunk cache within its size limit """
+        if self.cache:
+            self.cache.evict()
 
     def chunkify(self, size=1024*1024*5):
-        """ Return a new chunk """
-        with open(self.file_name_raw, 'rb') as file:
-            chunk_end = file.tell()
-            while True:
-                chunk_start = chunk_end
-                file.seek(size, 1)
-                file.readline()
-                chunk_end = file.tell()
+        """ Return the chunks of all the files, every chunk of about `size`
+            bytes, so the pool is balanced by bytes and not by files """
+        for csv_file in self.files.values():
+            yield from csv_file.chunkify(size)
 
-                if chunk_end > self.file_end:
-                    chunk_end = self.file_end
-                    yield chunk_start, chunk_end - chunk_start
-                    break
-                else:
-                    yield chunk_start, chunk_end - chunk_start
+    def open_mappings(self):
+        """ Map the files before the pool starts, the workers inherit them """
+        for csv_file in self.files.values():
+            get_mapping(csv_file.file_name, csv_file.file_end)
+
+    def release_mappings(self):
+        """ Close the memory maps of the files """
+        for csv_file in self.files.values():
+            release_mapping(csv_file.file_name, csv_file.file_end)
 
     @m.timing
     def run_reading(self):
         """ The main method for the reading """
-        # init objects
-        pool = mp.Pool(mp.cpu_count())
-        jobs = []
+        m.info('Run csv reading of %s files...' % len(self.files))
+
+        # write the chunk buffers in the order of the chunks,
+        # releasing every buffer as soon as it is written
+        if self.binary:
+            with open(self.file_name_hash, 'wb') as hash_file:
+                hash_file.write(PGCOPY_HEADER)
+                for records in self.hash_iterator(packed=True):
+                    hash_file.write(encode_hash_records(records, 'csv_adapter'))
+                hash_file.write(PGCOPY_TRAILER)
+        else:
+            with open(self.file_name_hash, 'w') as hash_txt:
+                for hash_buffer in self.hash_iterator():
+                    hash_txt.write(hash_buffer)
+
+        m.info('CSV file reading has been completed')
 
-        m.info('Run csv reading...')
-        # create jobs
-        for chunk_start, chunk_size in self.chunkify():
-            jobs.append(pool.apply_async(self.process_wrapper,
-                                         (chunk_start, chunk_size)))
+    def hash_iterator(self, packed=False):
+        """ Yield hashed chunks in order while the pool is still working """
+        process_func = self.process_chunk_packed if packed else self.process_chunk
+        # init objects, the workers inherit the memory maps
+        self.open_mappings()
+        try:
+            yield from self.stitch(ordered_imap(process_func, self.chunkify()), packed)
+        finally:
+            self.release_mappings()
+        self.evict_cache()
 
-        # wait for all jobs to finish
-        for job in jobs:
-            job.get()
+    @m.timing
+    @m.wrapper(m.entering, m.exiting)
+    def run_streaming(self):
+        """ Hash the file and COPY the result without the hash file """
+        database = PostgreSQLCommon('staging')
 
-        # clean up
-        pool.close()
-        pool.join()
+        m.info('Run csv streaming...')
+        try:
+            if self.binary:
+                source = binary_stream(encode_hash_records(packed, 'csv_adapter')
+                                       for packed in self.hash_iterator(packed=True))
+            else:
+                source = self.hash_iterator()
+            rows = database.bulk_copy(IteratorFile(source), self.storage_table,
+                                      binary=self.binary)
 
-        m.info('CSV file reading has been completed')
+            m.info('Streaming copy of %s rows has been successfully completed!' % rows)
+        except Exception as err:
+            m.error('OOps! Streaming copy operation FAILED! Reason: %s' % str(err))
+        finally:
+            database.close()
 
     @m.timing
     @m.wrapper(m.entering, m.exiting)
     def bulk_copy_to_db(self):
         """ Saving the hashed data into the database """
-        database = PostgreSQLCommon()
+        database = PostgreSQLCommon('staging')
 
         try:
-            file = open(self.file_name_hash)
-            database.bulk_copy(file, self.storage_table)
+            file = open(self.file_name_hash, 'rb' if self.binary else 'r')
+            database.bulk_copy(file, self.storage_table, binary=self.binary)
 
             m.info('Bulk insert from %s has been successfully completed!'
                    % self.file_name_hash)
@@ -2,155 +2,268 @@
 
 """ Base class for the database """
 
-import threading
-from multiprocessing import Process
-from multiprocessing import Queue
-import configparser
-from math import floor
+import os
+import multiprocessing as mp
+import multiprocessing.util as mp_util
+from time import time, sleep
+from contextlib import contextmanager
 
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import (connection, TRANSACTION_STATUS_IDLE,
+                                  TRANSACTION_STATUS_INERROR)
 from psycopg2.extras import DictCursor
-from psycopg2.pool import ThreadedConnectionPool
 
+from utils.config_reader import ConfigReader
 from utils.monitoring import Monitoring
 
 
-config = configparser.ConfigParser()
-config.read('./conf/db.ini')
-
-DB_URL = config.get('POSTGRESQL', 'db_url')
-
 m = Monitoring('db_tool')
 
+_worker_database = {}
+
+
+class PooledConnection(connection):
+    """ A connection which remembers its session profile """
+    profile = None
+
+
+class ConnectionManager:
+    """ The connections of every process, opened on the first use with
+        the settings of conf/db.ini and given back to the pool on close.
+        A session profile tunes a connection for its workload """
+    def __init__(self, config_file='./conf/db.ini'):
+        self.config_file = config_file
+        self.conf = None
+        # idle connections by the process, the forked workers open their own
+        self.idle = {}
+        self.profiles = None
+
+    def get_conf(self):
+        """ Read the config on the first connection """
+        if self.conf is None:
+            self.conf = ConfigReader(self.config_file).conf
+        return self.conf
+
+    def get_profiles(self):
+        """ Return the session settings of the workloads """
+        if self.profiles is None:
+            conf = self.get_conf()
+            self.profiles = {
+                'default': {},
+                # COPY and inserts into the staging tables,
+                # they are created again after a crash anyway
+                'staging': {'synchronous_commit': 'off',
+                            'work_mem': conf['work_mem']},
+                # classification and the joins of the clean save
+                'join': {'work_mem': conf['work_mem'],
+                         'max_parallel_workers_per_gather': conf['parallel_workers_per_gather']},
+                # keys and indexes of the loaded tables
+                'maintenance': {'maintenance_work_mem': conf['maintenance_work_mem']}
+            }
+        return self.profiles
+
+    def get_idle(self):
+        """ Return the idle connections of the current process. They are
+            closed when the process exits: the pool workers leave by
+            os._exit() and don't run atexit, only the finalizers of
+            multiprocessing """
+        pid = os.getpid()
+        if pid not in self.idle:
+            self.idle[pid] = []
+            mp_util.Finalize(None, close_worker_connections, exitpriority=10)
+        return self.idle[pid]
+
+    def acquire(self, profile='default'):
+        """ Return an idle connection of the process or a new one """
+        idle = self.get_idle()
+        conn = None
+        while idle and conn is None:
+            conn = idle.pop()
+            if conn.closed:
+                conn = None
+
+        if conn is None:
+            conn = psycopg2.connect(self.get_conf()['db_url'],
+                                    connection_factory=PooledConnection)
+            m.metrics.inc('db_connections_opened')
+
+        self.apply_profile(conn, profile)
+        return conn
+
+    def apply_profile(self, conn, profile):
+        """ Reset the session settings to the ones of the profile """
+        if conn.profile == profile:
+            return
+        if profile not in self.get_profiles():
+            raise ValueError('Unknown session profile %s' % profile)
+
+        if conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+            conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute('reset all')
+            for name, value in self.get_profiles()[profile].items():
+                if value:
+                    cur.execute('select set_config(%s, %s, false)', (name, str(value)))
+        conn.commit()
+        conn.profile = profile
+
+    def release(self, conn):
+        """ Keep the connection for the next user, up to pool_size of them """
+        if conn.closed:
+            return
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+
+        idle = self.get_idle()
+        if len(idle) < self.get_conf()['pool_size']:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def close_all(self):
+        """ Close the idle connections of the current process """
+        for conn in self.idle.pop(os.getpid(), []):
+            if not conn.closed:
+                conn.close()
+
+
+manager = ConnectionManager()
+
+
+def get_worker_database(profile='default'):
+    """ Return the connection of the current process, opening it once """
+    database = _worker_database.get(os.getpid())
+    if database is None or database.conn.closed:
+        database = PostgreSQLCommon(profile)
+        _worker_database.clear()
+        _worker_database[os.getpid()] = database
+    database.set_profile(profile)
+    return database
+
+
+def drop_worker_database():
+    """ Forget the connection of the current process after a failure """
+    database = _worker_database.pop(os.getpid(), None)
+    if database is not None:
+        try:
+            database.close()
+        except psycopg2.Error:
+            pass
+
+
+def close_worker_connections():
+    """ Close every connection of the current process at its exit """
+    drop_worker_database()
+    manager.close_all()
 
-class PostgreSQLMultiThread:
-    """ Multi-threaded database work """
-    _select_conn_count = 10
-    _select_conn_pool = None
 
-    data_queque = Queue()  # reader reads data from queue
-
-    def __init__(self, str_sql,
-                 total_records, max_id_num_row):
+class PostgreSQLMultiThread:
+    """ Runs a statement over id_num_row ranges in parallel processes,
+        every worker with its own connection opened from the DSN """
+    def __init__(self, str_sql, ranges,
+                 workers=None, retries=3, profile='default'):
         self.str_sql = str_sql
-        self.total_records = total_records
-        self.max_id_num_row = max_id_num_row
-
-        m.info('Total rows for processing %s' % self.total_records)
-
-        # calculate the max and min connection required
-        self.pid_max = floor(self.total_records / 100000)
-
-    def create_connection_pool(self):
-        """ Create the thread safe threaded postgres connection pool"""
-
-        max_conn = self.pid_max
-        min_conn = max_conn / 2
-
-        # creating separate connection for read and write purpose
-        self._select_conn_pool = ThreadedConnectionPool(min_conn,
-                                                        max_conn,
-                                                        DB_URL)
-
-    @staticmethod
-    def chunks(array, start, num):
-        """Yield successive n-sized chunks from array"""
-        for i in range(start, len(array), num):
-            yield array[i:i + num]
-
-    @classmethod
-    def get_threads(cls, start=0,
-                    num=1000, div=10):
-        """ Split input value into equal chunks """
-        inter = (num - start) // div
-        mod = num % div
-        threads_arr = []
-
-        gener_list = list(cls.chunks(range(0, num), start, inter + mod))
-
-        for gen in gener_list:
-            threads_arr.append([gen.start, gen.stop])
-
-        return threads_arr
+        self.ranges = ranges
+        self.profile = profile
 
+        self.workers = workers or mp.cpu_count()
+        self.retries = retries
 
     def read_data(self):
-        """
-        Read the data from the postgres and shared those records with each
-        processor to perform their operation using threads
-        """
-        threads_array = self.get_threads(0,
-                                         self.max_id_num_row,
-                                         self.pid_max)
-
-        for pid in range(1, len(threads_array) + 1):
-            m.info('Process %s' % pid)
-
-            # Getting connection from the connection pool
-            select_conn = self._select_conn_pool.getconn()
-            select_conn.autocommit = 1
-
-            # Creating 10 process to perform the operation
-            process = Process(target=self.process_data,
-                              args=(self.data_queque,
-                                    pid,
-                                    threads_array[pid-1][0],
-                                    threads_array[pid-1][1],
-                                    select_conn))
-
-            process.daemon = True
-            process.start()
-            process.join()
-            select_conn.close()
-
-    def process_data(self, queue, pid,
-                     start_index, end_index,
-                     select_conn):
-        """
-        Here we process the each process into 10 multiple threads to do data process
-        """
-        m.info('Started processing record from %s to %s' % (start_index, end_index))
-
-        threads_array = self.get_threads(start_index,
-                                         end_index,
-                                         10)
-
-        for tid in range(1, len(threads_array) + 1):
-            worker = threading.Thread(target=self.process_thread,
-                                      args=(queue,
-                                            pid,
-                                            tid,
-                                            threads_array[tid-1][0],
-                                            threads_array[tid-1][1],
-                                            select_conn.cursor(),
-                                            threading.Lock()))
-
-            worker.daemon = True
-            worker.start()
-            worker.join()
-
-    @m.timing
-    def process_thread(self, queue, pid, tid,
-                       start_index, end_index,
-                       sel_cur, lock):
-        """
-        Thread read data from database and doing the elatic search to get
-        experience have the same data
-        """
-        sel_cur.execute(self.str_sql, (int(start_index), int(end_index)))
-        sel_cur.close()
-        message_txt = ('\t pid {:2}, tid {:2}, '
-                       'start_index {:7}, end_index {:7}. ').format(pid,
-                                                                    tid,
-                                                                    start_index,
-                                                                    end_index)
-        print(message_txt, end=' ')
+        """ Execute the statement for every range, at most `workers`
+            ranges (and connections) at the same time """
+        ranges = self.ranges
+        if not ranges:
+            return 0
+
+        workers = min(self.workers, len(ranges))
+        total_rows = 0
+        start = time()
+
+        m.info('Run %s ranges on %s workers' % (len(ranges), workers))
+
+        pool = mp.Pool(workers)
+        try:
+            for range_stat in pool.imap_unordered(self.process_range, ranges):
+                total_rows += range_stat['rows']
+                m.info('Range %(start_index)s - %(end_index)s: %(rows)s rows '
+                       'in %(elapsed)s sec (%(rows_per_sec)s rows/sec, '
+                       'attempts %(attempts)s)' % range_stat)
+            # the workers exit by themselves and close their connections
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        elapsed = max(time() - start, 1e-6)
+        m.info('Processed %s rows in %s sec (%s rows/sec)'
+               % (total_rows, round(elapsed, 4), round(total_rows / elapsed)))
+        return total_rows
+
+    @m.profiled
+    def process_range(self, id_range):
+        """ Execute the statement for one range, retrying it on the
+            connection failures with a new connection """
+        start_index, end_index = id_range
+        attempt = 0
+
+        while True:
+            attempt += 1
+            start = time()
+            try:
+                rows = get_worker_database(self.profile).execute(self.str_sql,
+                                                     start_index=int(start_index),
+                                                     end_index=int(end_index))
+                break
+            except psycopg2.OperationalError as err:
+                drop_worker_database()
+                if attempt > self.retries:
+                    raise
+                m.error('Range %s - %s FAILED, attempt %s of %s. Reason: %s'
+                        % (start_index, end_index, attempt, self.retries + 1, str(err)))
+                sleep(attempt)
+
+        elapsed = max(time() - start, 1e-6)
+        m.metrics.observe('range_seconds', elapsed)
+        m.metrics.add_progress(rows)
+        return {'start_index': start_index,
+                'end_index': end_index,
+                'rows': rows,
+                'elapsed': round(elapsed, 4),
+                'rows_per_sec': round(rows / elapsed),
+                'attempts': attempt}
 
 
 class PostgreSQLCommon():
     """ Simple working with database """
-    def __init__(self):
-        self.conn = psycopg2.connect(DB_URL)
+    def __init__(self, profile='default'):
+        self.profile = profile
+        self._conn = None
+
+    @property
+    def conn(self):
+        """ The connection, taken from the pool on the first use """
+        if self._conn is None or self._conn.closed:
+            self._conn = manager.acquire(self.profile)
+        return self._conn
+
+    def set_profile(self, profile):
+        """ Switch the session settings of the connection """
+        self.profile = profile
+        if self._conn is not None and not self._conn.closed:
+            manager.apply_profile(self._conn, profile)
+
+    @contextmanager
+    def session(self, profile):
+        """ Run the statements of the block with another session profile """
+        previous = self.profile
+        self.set_profile(profile)
+        try:
+            yield self
+        finally:
+            self.set_profile(previous)
 
     def query(self, query, **kwargs):
         """ Query executing for many records """
@@ -173,16 +286,34 @@ class PostgreSQLCommon():
             cur.close()
         return rows_count
 
-    def bulk_copy(self, file_source, target_table, columns=None):
-        """ Massive insertion """
+    def bulk_copy(self, file_source, target_table, columns=None, binary=False):
+        """ Massive insertion, from tab separated text or from the binary
+            COPY format (see adapters/binary_copy.py) """
         with self.conn.cursor() as cur:
-            cur.copy_from(file_source, target_table, sep='\t', columns=columns)
+            if binary:
+                sql_command = sql.SQL('copy {0} {1} from stdin (format binary)').format(
+                    sql.Identifier(*target_table.split('.')),
+                    sql.SQL('({})').format(sql.SQL(', ').join(map(sql.Identifier, columns)))
+                    if columns else sql.SQL(''))
+                cur.copy_expert(sql_command, file_source)
+            else:
+                cur.copy_from(file_source, target_table, sep='\t', columns=columns)
             rows_count = cur.rowcount
             self.conn.commit()
             cur.close()
         return rows_count
 
+    def bulk_export(self, query, file_target):
+        """ Massive reading with COPY ... TO STDOUT """
+        with self.conn.cursor() as cur:
+            cur.copy_expert(query, file_target)
+            rows_count = cur.rowcount
+            cur.close()
+        file_target.flush()
+        return rows_count
+
     def close(self):
-        """ Connection closing """
-        if self.conn:
-            self.conn.close()
+        """ Give the connection back to the pool """
+        if self._conn is not None:
+            manager.release(self._conn)
+            self._conn = None
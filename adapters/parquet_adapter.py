@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+""" Working with the Parquet archives of the transaction feed """
+
+import os
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from adapters.csv_adapter import CsvAdapter, get_input_files
+from utils.columnar import CSV_COLUMNS, hash_table
+from utils.monitoring import Monitoring
+from engines.records import RECORD_SIZE
+
+m = Monitoring('parquet_adapter')
+
+COLUMN_TYPES = (('transaction_uid', 'string'),
+                ('account_uid', 'string'),
+                ('transaction_date', 'timestamp'),
+                ('type_deal', 'string'),
+                ('transaction_amount', 'float64'))
+
+
+def parse_date(value):
+    """ Return the datetime of a window bound, None for an open one """
+    return datetime.fromisoformat(value) if value else None
+
+
+class ParquetFile:
+    """ One Parquet input file, it is always read in full """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file_start = 0
+        self.file_end = os.path.getsize(file_name)
+
+
+class ParquetAdapter(CsvAdapter):
+    """ Reads Parquet files instead of the CSV ones: the row groups are
+        hashed by the pool of the CSV adapter, every row group is a chunk
+        and its output is the one of the CSV side """
+    def __init__(self, **kwargs):
+        if pa is None:
+            raise ValueError('The parquet source requires pyarrow')
+        super().__init__(**kwargs)
+
+        # The row groups are parsed by pyarrow and are not cached
+        self.ingest_mode = 'arrow'
+        self.cache = None
+
+        # Only the transactions of [date_from, date_to) are read
+        self.date_from = parse_date(kwargs.get('date_from'))
+        self.date_to = parse_date(kwargs.get('date_to'))
+
+    def get_files(self):
+        """ Return the input files of a file, a directory of *.parquet
+            files or a glob """
+        file_name_raw = self.file_name_raw
+        if os.path.isdir(file_name_raw):
+            file_name_raw = os.path.join(file_name_raw, '*.parquet')
+        return dict((file_name, ParquetFile(file_name))
+                    for file_name in get_input_files(file_name_raw))
+
+    def in_window(self, statistics):
+        """ False if the statistics of a row group show that none of its
+            transaction_date values is inside the window """
+        if self.date_from is None and self.date_to is None:
+            return True
+        if statistics is None:
+            return True
+        if not statistics.has_min_max:
+            # only NULL dates: they are outside of any window
+            return statistics.null_count == 0
+        if not isinstance(statistics.min, datetime):
+            return True
+
+        if self.date_from is not None and statistics.max < self.date_from:
+            return False
+        if self.date_to is not None and statistics.min >= self.date_to:
+            return False
+        return True
+
+    def chunkify(self, size=None):
+        """ Return the row groups of all the files with the dates of the
+            window: (file name, row group, bytes) """
+        skipped = 0
+        for file_name in self.files:
+            metadata = pq.ParquetFile(file_name).metadata
+            date_index = metadata.schema.names.index('transaction_date')
+
+            for row_group in range(metadata.num_row_groups):
+                group = metadata.row_group(row_group)
+                if self.in_window(group.column(date_index).statistics):
+                    yield file_name, row_group, group.total_byte_size
+                else:
+                    skipped += 1
+
+        if skipped:
+            m.info('%s row groups are outside of the date window' % skipped)
+
+    def open_mappings(self):
+        """ The row groups are read by the workers themselves """
+
+    def release_mappings(self):
+        """ Nothing is mapped """
+
+    def read_row_group(self, file_name, row_group):
+        """ Return the needed columns of a row group in the types of the
+            CSV side, only the rows of the window """
+        table = pq.ParquetFile(file_name).read_row_group(row_group, columns=list(CSV_COLUMNS))
+
+        columns = []
+        for name, column_type in COLUMN_TYPES:
+            column = table[name]
+            if column_type == 'timestamp':
+                columns.append(pc.cast(column, pa.timestamp('us')))
+            else:
+                columns.append(pc.cast(column, getattr(pa, column_type)()))
+        table = pa.table(columns, names=list(CSV_COLUMNS))
+
+        if self.date_from is not None:
+            table = table.filter(pc.greater_equal(
+                table['transaction_date'], pa.scalar(self.date_from, pa.timestamp('us'))))
+        if self.date_to is not None:
+            table = table.filter(pc.less(
+                table['transaction_date'], pa.scalar(self.date_to, pa.timestamp('us'))))
+        return table
+
+    @m.timing
+    @m.profiled
+    def process_wrapper(self, file_name, row_group, group_size, packed=False):
+        """ Hash a row group and return it as one buffer,
+            as text lines or as packed (uid, digest) records """
+        table = self.read_row_group(file_name, row_group)
+
+        if packed:
+            hash_buffer = hash_table(table, self.scheme)
+            rows = len(hash_buffer) // RECORD_SIZE
+        else:
+            hash_buffer = hash_table(table, self.scheme, 'csv_adapter')
+            rows = hash_buffer.count('\n')
+        m.metrics.add_progress(rows, group_size)
+
+        m.info('Reading {} row group {} ({} rows)'.format(os.path.basename(file_name),
+                                                          row_group, rows))
+        return hash_buffer
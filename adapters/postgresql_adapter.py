@@ -1,29 +1,124 @@
 #!/usr/bin/env python3
 """ Postgres stuff """
 
+import io
+import uuid
+from math import ceil
+from functools import partial
+
 import psycopg2
 from psycopg2 import sql
 
-from adapters.database_tool import PostgreSQLCommon, PostgreSQLMultiThread
+from adapters.database_tool import (PostgreSQLCommon, PostgreSQLMultiThread,
+                                    get_worker_database)
+from adapters.binary_copy import binary_stream, encode_hash_records, encode_uids
+from adapters.range_planner import RangePlanner
+from engines.records import RECORD_SIZE, LineSink, pack_hash_lines, unpack_uids
+from engines.report import (DiscrepancyReport, MATCHED, HASH_MISMATCH,
+                            MISSING_IN_CSV, MISSING_IN_DB)
+from utils.digest import get_scheme, SQL_CANONICAL_COLUMNS
+from utils.iterator_file import IteratorFile
 from utils.monitoring import Monitoring
+from utils.parallel import ordered_imap
 
 
 m = Monitoring('postgresql_adapter')
 
 
+@m.profiled
+def extract_range(schema_raw, scheme_id, packed, id_range, date_filter=''):
+    """ Read a range of rows with COPY ... TO STDOUT and hash it locally """
+    sql_command = sql.SQL("""
+        copy (
+            select {1}
+            from {0}.transaction_log
+            where id_num_row > {2} and id_num_row <= {3}{4}
+        ) to stdout""").format(sql.Identifier(schema_raw),
+                               SQL_CANONICAL_COLUMNS,
+                               sql.Literal(id_range[0]),
+                               sql.Literal(id_range[1]),
+                               sql.SQL(date_filter))
+
+    raw_rows = io.BytesIO()
+    get_worker_database().bulk_export(sql_command, raw_rows)
+
+    raw_bytes = raw_rows.getvalue()
+    if packed:
+        hash_buffer = get_scheme(scheme_id).hash_buffer(raw_bytes, 0, len(raw_bytes))
+        rows = len(hash_buffer) // RECORD_SIZE
+    else:
+        hash_buffer = get_scheme(scheme_id).hash_buffer(raw_bytes, 0, len(raw_bytes),
+                                                        'postresql_adapter')
+        rows = hash_buffer.count('\n')
+    m.metrics.add_progress(rows, len(raw_bytes))
+    return hash_buffer
+
+
 class PostgreSQLAdapter:
     """ The adapter for PostgreSQL """
     def __init__(self, **kwargs):
         self.storage_table = kwargs['storage_table']
+        # transaction_uid with its reconciliation class, filled from the storage
+        self.classes_table = '_'.join([self.storage_table, 'classes'])
+        self.classified = False
         self.schema_raw = kwargs['schema_raw']
         self.schema_target = kwargs['schema_target']
         self.schema_db_clean = kwargs['schema_db_clean']
         self.rows_count = 0
+        # Only the rows after min_id_num_row are taken (incremental runs)
+        self.min_id_num_row = 0
         self.max_id_num_row = 0
+        self.scheme = get_scheme(kwargs.get('digest_scheme', 'md5_nested_v1'))
         self.database = PostgreSQLCommon()
 
+        # Hash on the reconciliation side if asked or if the database can't
+        self.local_hashing = (kwargs.get('extract_mode', 'sql') == 'copy'
+                              or self.scheme.sql_expression is None)
+        self.rows_per_task = kwargs.get('rows_per_task', 50000)
+
+        self.parallel_workers = kwargs.get('parallel_workers')
+        self.range_retries = kwargs.get('range_retries', 3)
+
+        # bulk: an unlogged storage, its keys are built after the load
+        self.storage_layout = kwargs.get('storage_layout', 'classic')
+        self.storage_partitions = kwargs.get('storage_partitions', 0)
+        # the clean rows are saved by transactions of about this size
+        self.publish_batch_rows = max(1, kwargs.get('publish_batch_rows', 100000))
+        # Only the transactions of [date_from, date_to) if the other side is limited
+        self.date_from = kwargs.get('date_from') or None
+        self.date_to = kwargs.get('date_to') or None
+        # text: tab separated lines, binary: the binary COPY format
+        self.binary = kwargs.get('copy_format') == 'binary'
+
+    def register_run(self, engine):
+        """ Record the run with the digest scheme both sides are hashed with """
+        sql_command = sql.SQL("""
+            create table if not exists {0}.run_history (
+                storage_table       varchar(50) not null,
+                digest_scheme       varchar(50) not null,
+                engine              varchar(50),
+                date_start          timestamp default now()
+            );
+            insert into {0}.run_history
+                (storage_table, digest_scheme, engine)
+            values (%(storage_table)s, %(digest_scheme)s, %(engine)s);
+            """).format(sql.Identifier(self.schema_target))
+        try:
+            self.database.execute(sql_command,
+                                  storage_table=self.storage_table,
+                                  digest_scheme=self.scheme.scheme_id,
+                                  engine=engine)
+            m.info('Run %s registered with digest scheme %s'
+                   % (self.storage_table, self.scheme.scheme_id))
+        except psycopg2.Error as err:
+            m.error('OOps! Run registering FAILED! Reason: %s' % str(err.pgerror))
+
     def storage_create(self):
         """ Create a table for the comparing the sources """
+        if self.storage_layout == 'bulk':
+            self.storage_create_bulk()
+            return
+
         sql_command = sql.SQL("""
             drop table if exists {0}.{1};
             create table {0}.{1} (
@@ -43,12 +138,73 @@ class PostgreSQLAdapter:
         except psycopg2.Error as err:
             m.error('OOps! Table creating for Storage FAILED! Reason: %s' % str(err.pgerror))
 
+    def storage_create_bulk(self):
+        """ Create an unlogged storage without keys for the COPY,
+            hash partitioned on transaction_uid if asked """
+        sql_command = sql.SQL("""
+            drop table if exists {0}.{1};
+            create {2} table {0}.{1} (
+                adapter_name        varchar(50) not null,
+                transaction_uid     uuid not null,
+                hash                uuid not null
+            ) {3};
+            """).format(sql.Identifier(self.schema_target),
+                        sql.Identifier(self.storage_table),
+                        # a partitioned table can't be unlogged, its partitions can
+                        sql.SQL('' if self.storage_partitions else 'unlogged'),
+                        sql.SQL('partition by hash (transaction_uid)'
+                                if self.storage_partitions else ''))
+
+        for remainder in range(self.storage_partitions):
+            sql_command += sql.SQL("""
+            create unlogged table {0}.{2} partition of {0}.{1}
+                for values with (modulus {3}, remainder {4});
+            """).format(sql.Identifier(self.schema_target),
+                        sql.Identifier(self.storage_table),
+                        sql.Identifier('_'.join([self.storage_table, 'p%s' % remainder])),
+                        sql.Literal(self.storage_partitions),
+                        sql.Literal(remainder))
+
+        try:
+            self.database.execute(sql_command)
+            m.info('Unlogged table %s (%s partitions) has been created!'
+                   % (self.storage_table, self.storage_partitions))
+        except psycopg2.Error as err:
+            m.error('OOps! Table creating for Storage FAILED! Reason: %s' % str(err.pgerror))
+
+    @m.timing
+    @m.wrapper(m.entering, m.exiting)
+    def storage_finalize(self):
+        """ Build the keys of a bulk storage after the load and
+            collect the statistics for the classification """
+        sql_command = sql.SQL("""
+            analyze {0}.{1};
+            """).format(sql.Identifier(self.schema_target),
+                        sql.Identifier(self.storage_table))
+
+        if self.storage_layout == 'bulk':
+            sql_command = sql.SQL("""
+            alter table {0}.{1}
+                add constraint {2} primary key (adapter_name, transaction_uid, hash);
+            """).format(sql.Identifier(self.schema_target),
+                        sql.Identifier(self.storage_table),
+                        sql.Identifier('_'.join(['pk', self.storage_table]))) + sql_command
+
+        try:
+            with self.database.session('maintenance'):
+                self.database.execute(sql_command)
+            m.info('Table %s has been finalized!' % self.storage_table)
+        except psycopg2.Error as err:
+            m.error('OOps! Storage finalizing FAILED! Reason: %s' % str(err.pgerror))
+
     def drop_storage(self):
         """ Drop a staging table """
         sql_command = sql.SQL("""
             drop table if exists {0}.{1};
+            drop table if exists {0}.{2};
             """).format(sql.Identifier(self.schema_target),
-                        sql.Identifier(self.storage_table))
+                        sql.Identifier(self.storage_table),
+                        sql.Identifier(self.classes_table))
         try:
             self.database.execute(sql_command)
             m.info('Table %s has been droped!' % self.storage_table)
@@ -56,6 +212,17 @@ class PostgreSQLAdapter:
             m.error('OOps! Table droping for Storage %s FAILED! Reason: %s'
                     % (self.storage_table, str(err.pgerror)))
 
+    def get_date_filter(self):
+        """ Return the condition of the date window, empty without it """
+        date_filter = sql.SQL('')
+        if self.date_from:
+            date_filter += sql.SQL(' and transaction_date >= {0}::timestamp').format(
+                sql.Literal(self.date_from))
+        if self.date_to:
+            date_filter += sql.SQL(' and transaction_date < {0}::timestamp').format(
+                sql.Literal(self.date_to))
+        return date_filter
+
     def adapter_simple_run(self):
         """ Insert hashed data from PostgreSQL """
         sql_command = sql.SQL("""
@@ -63,12 +230,9 @@ class PostgreSQLAdapter:
                 select
                     transaction_uid,
                     'postresql_adapter' as adapter_name,
-                    md5(
-                        coalesce(md5(account_uid::text), ' ') ||
-                        coalesce(md5(to_char(transaction_date, 'YYYY-MM-DD HH24:MI:SS')), ' ') ||
-                        coalesce(md5(type_deal::text), ' ') ||
-                        coalesce(md5(transaction_amount::text), ' ')) as hash
+                    {3} as hash
                 from {0}.transaction_log
+                where id_num_row > %(min_id)s and id_num_row <= %(max_id)s{4}
             )
             insert into {1}.{2}
                 (adapter_name, transaction_uid, hash)
@@ -78,32 +242,38 @@ class PostgreSQLAdapter:
                 s.hash::uuid
             from pre_select s;""").format(sql.Identifier(self.schema_raw),
                                           sql.Identifier(self.schema_target),
-                                          sql.Identifier(self.storage_table))
+                                          sql.Identifier(self.storage_table),
+                                          self.scheme.sql_expression,
+                                          self.get_date_filter())
 
         try:
-            self.database.execute(sql_command)
+            with self.database.session('staging'):
+                self.database.execute(sql_command,
+                                      min_id=self.min_id_num_row,
+                                      max_id=self.max_id_num_row)
             m.info('PostgreSQL simple adapter_run successfully completed')
         except psycopg2.Error as err:
             m.error('OOps! PostgreSQL simple adapter_run FAILED! Reason %s' % str(err.pgerror))
 
     def get_rows_count(self):
-        """ Return a count of rows """
+        """ Return a count of rows after the watermark and the last id """
         rows_count = 0
         max_id_num_row = 0
 
-        sql_command = """
+        sql_command = sql.SQL("""
             select count(*), max(id_num_row)
-            from transaction_db_raw.transaction_log;"""
+            from {0}.transaction_log
+            where id_num_row > %(min_id)s;""").format(sql.Identifier(self.schema_raw))
 
         try:
-            rows = self.database.query_one(sql_command)
+            rows = self.database.query_one(sql_command, min_id=self.min_id_num_row)
             rows_count = rows[0]
             max_id_num_row = rows[1]
         except psycopg2.Error as err:
             m.error('OOps! PostgreSQLAdapter.adapter_run FAILED! Reason: %s, sql command: %s'
                     % (str(err.pgerror), sql_command))
 
-        return rows_count, max_id_num_row
+        return rows_count, max_id_num_row or self.min_id_num_row
 
     def adapter_thread_run(self):
         """ Adapter running in multi-threads option """
@@ -112,14 +282,9 @@ class PostgreSQLAdapter:
                 select
                     transaction_uid,
                     'postresql_adapter' as adapter_name,
-                    md5(
-                        coalesce(md5(account_uid::text), ' ') ||
-                        coalesce(md5(to_char(transaction_date,
-                            'YYYY-MM-DD HH24:MI:SS')), ' ') ||
-                        coalesce(md5(type_deal::text), ' ') ||
-                        coalesce(md5(transaction_amount::text), ' ')) as hash
+                    {3} as hash
                 from {0}.transaction_log
-                where id_num_row > %s and id_num_row <= %s
+                where id_num_row > %(start_index)s and id_num_row <= %(end_index)s{4}
             )
             insert into {1}.{2}
                 (adapter_name, transaction_uid, hash)
@@ -129,16 +294,23 @@ class PostgreSQLAdapter:
                 s.hash::uuid
             from pre_select s;""").format(sql.Identifier(self.schema_raw),
                                           sql.Identifier(self.schema_target),
-                                          sql.Identifier(self.storage_table))
+                                          sql.Identifier(self.storage_table),
+                                          self.scheme.sql_expression,
+                                          self.get_date_filter())
 
         m.info('Run multiprocessing read...')
-        multi_run = PostgreSQLMultiThread(sql_command, self.rows_count, self.max_id_num_row)
-
-        # Creating database connection pool to help connection shared along process
-        multi_run.create_connection_pool()
-        multi_run.read_data()
+        m.info('Total rows for processing %s' % self.rows_count)
+        multi_run = PostgreSQLMultiThread(sql_command.as_string(self.database.conn),
+                                          self.get_ranges(),
+                                          workers=self.parallel_workers,
+                                          retries=self.range_retries,
+                                          profile='staging')
 
-        m.info('Read_data successfully completed')
+        try:
+            multi_run.read_data()
+            m.info('Read_data successfully completed')
+        except psycopg2.Error as err:
+            m.error('OOps! PostgreSQL adapter_thread_run FAILED! Reason %s' % str(err.pgerror))
 
     @m.timing
     @m.wrapper(m.entering, m.exiting)
@@ -147,40 +319,90 @@ class PostgreSQLAdapter:
             the necessary handler is launched """
         self.rows_count, self.max_id_num_row = self.get_rows_count()
 
-        if self.rows_count < 100000:
+        if self.local_hashing:
+            self.adapter_copy_run()
+        elif self.rows_count < 100000:
             # Simple processing
             self.adapter_simple_run()
         else:
             self.adapter_thread_run()
 
+    @m.timing
+    @m.wrapper(m.entering, m.exiting)
+    def classify_storage(self):
+        """ Classify every transaction_uid of the storage in one pass:
+            the database side against the other side. The classes are
+            rebuilt by every run, they are not WAL-logged """
+        sql_command = sql.SQL("""
+            drop table if exists {0}.{2};
+            create unlogged table {0}.{2} as
+            select
+                transaction_uid,
+                case
+                    when count(*) filter (where adapter_name = 'postresql_adapter') = 0
+                        then {3}
+                    when count(*) filter (where adapter_name <> 'postresql_adapter') = 0
+                        then {4}
+                    -- a hash on both sides: the duplicated rows of one side
+                    -- (a bulk storage without its key) don't count
+                    when count(distinct hash) < count(distinct (adapter_name, hash))
+                        then {5}
+                    else {6}
+                end as class
+            from {0}.{1}
+            group by transaction_uid;
+            """).format(sql.Identifier(self.schema_target),
+                        sql.Identifier(self.storage_table),
+                        sql.Identifier(self.classes_table),
+                        sql.Literal(MISSING_IN_DB),
+                        sql.Literal(MISSING_IN_CSV),
+                        sql.Literal(MATCHED),
+                        sql.Literal(HASH_MISMATCH))
+
+        sql_index = sql.SQL("""
+            create index {2} on {0}.{1} (transaction_uid) where class = {3};
+            """).format(sql.Identifier(self.schema_target),
+                        sql.Identifier(self.classes_table),
+                        sql.Identifier('_'.join([self.classes_table, 'matched_idx'])),
+                        sql.Literal(MATCHED))
+
+        if self.storage_partitions:
+            # the uid is the partition key: every partition is grouped apart
+            sql_command = sql.SQL('set enable_partitionwise_aggregate = on;') + sql_command
+
+        try:
+            with self.database.session('join'):
+                # the rows of the create table ... as, the last statement
+                rows = self.database.execute(sql_command)
+                self.database.execute(sql_index)
+            self.classified = True
+            m.metrics.add_progress(rows)
+            m.info('%s transactions have been classified!' % rows)
+        except psycopg2.Error as err:
+            m.error('OOps! Classify_storage FAILED! Reason: %s' % str(err.pgerror))
+
     @m.wrapper(m.entering, m.exiting)
     def get_discrepancy_report(self):
         """ Reconciliation report returning """
+        if not self.classified:
+            self.classify_storage()
 
         sql_command = sql.SQL("""
             select
-                s1.adapter_name,
-                count(s1.transaction_uid) as tran_count
-            from {0}.{1} s1
-            full join {0}.{1} s2
-                on s2.transaction_uid = s1.transaction_uid
-                and s2.adapter_name != s1.adapter_name
-                and s2.hash = s1.hash
-            where s2.transaction_uid is null
-            group by s1.adapter_name;""").format(sql.Identifier(self.schema_target),
-                                                 sql.Identifier(self.storage_table))
+                class,
+                count(*) as tran_count
+            from {0}.{1}
+            group by class;""").format(sql.Identifier(self.schema_target),
+                                       sql.Identifier(self.classes_table))
 
         try:
             rows = self.database.query(sql_command)
 
             m.info('Discrepancy_report successfully completed!')
 
-            print('\n\tNumber of discrepancies detected by adapters')
-            print('\t---------------------------------')
-            for row in rows:
-                print('\t', end='')
-                print('{:20} | {:10}'.format(row[0], row[1]))
-            print('\t---------------------------------')
+            report = DiscrepancyReport(**dict((row[0], row[1]) for row in rows))
+            report.print_report()
+            return report
 
         except psycopg2.Error as err:
             m.error('OOps! Get_discrepancy_report FAILED! Reason: %s' % str(err.pgerror))
@@ -189,42 +411,245 @@ class PostgreSQLAdapter:
     @m.wrapper(m.entering, m.exiting)
     def save_clean_data(self):
         """ Saving the reconcilied date into """
+        if not self.classified:
+            self.classify_storage()
+
+        sql_count = sql.SQL("""
+            select count(*)
+            from {0}.{1}
+            where class = {2};""").format(sql.Identifier(self.schema_target),
+                                          sql.Identifier(self.classes_table),
+                                          sql.Literal(MATCHED))
+        try:
+            rows_count = self.database.query_one(sql_count)[0]
+        except psycopg2.Error as err:
+            m.error('OOps! Save_clean_data FAILED! Reason: %s' % str(err.pgerror))
+            return
+
+        self.publish_clean(sql.SQL('.').join([sql.Identifier(self.schema_target),
+                                              sql.Identifier(self.classes_table)]),
+                           sql.SQL('r.class = {0}').format(sql.Literal(MATCHED)),
+                           rows_count)
+
+    def publish_clean(self, source, condition, rows_count):
+        """ Insert the reconciled rows of `source` into the clean schema
+            by transaction_uid ranges, every batch in its own transaction,
+            the rows which are already there are skipped """
+        batches = max(1, ceil(rows_count / self.publish_batch_rows))
+        bounds = [i * 2 ** 128 // batches for i in range(batches + 1)]
+
         sql_command = sql.SQL("""
-            with reconcil_data as (
-                select
-                    s1.transaction_uid
-                from {0}.{1} s1
-                join {0}.{1} s2
-                    on s2.transaction_uid = s1.transaction_uid
-                    and s2.adapter_name != s1.adapter_name
-                where s2.hash = s1.hash
-                    and s1.adapter_name = 'postresql_adapter'
-            )
-            insert into {2}.transaction_log
+            insert into {1}.transaction_log (
+                transaction_uid,
+                account_uid,
+                transaction_date,
+                type_deal,
+                transaction_amount)
             select
                 t.transaction_uid,
                 t.account_uid,
                 t.transaction_date,
                 t.type_deal,
                 t.transaction_amount
-            from {3}.transaction_log t
-            join reconcil_data r
+            from {2}.transaction_log t
+            join {0} r
                 on t.transaction_uid = r.transaction_uid
-            where not exists
-                (
-                    select 1
-                    from {2}.transaction_log tl
-                    where tl.transaction_uid = t.transaction_uid
-                )
-            """).format(sql.Identifier(self.schema_target),
-                        sql.Identifier(self.storage_table),
+            where {3}
+                and r.transaction_uid between %(start_uid)s and %(end_uid)s
+            on conflict (transaction_uid) do nothing
+            """).format(source,
                         sql.Identifier(self.schema_db_clean),
-                        sql.Identifier(self.schema_raw))
+                        sql.Identifier(self.schema_raw),
+                        condition)
+
+        total_rows = 0
+        with self.database.session('join'):
+            for batch in range(batches):
+                try:
+                    rows = self.database.execute(sql_command,
+                                                 start_uid=str(uuid.UUID(int=bounds[batch])),
+                                                 end_uid=str(uuid.UUID(int=bounds[batch + 1] - 1)))
+                except psycopg2.Error as err:
+                    self.database.conn.rollback()
+                    m.error('OOps! Publishing of batch %s of %s FAILED, %s rows have been saved. '
+                            'Reason: %s' % (batch + 1, batches, total_rows, str(err.pgerror)))
+                    return total_rows
+
+                total_rows += rows
+                m.metrics.add_progress(rows)
+                m.info('Batch %s of %s: %s rows saved to the clean schema (%s of %s)'
+                       % (batch + 1, batches, rows, total_rows, rows_count))
+
+        m.info('Saving to the clean schema has been successfully completed!')
+        return total_rows
 
+    def get_ranges(self):
+        """ Split id_num_row into ranges of about rows_per_task rows """
+        planner = RangePlanner(self.database,
+                               self.schema_raw,
+                               'transaction_log',
+                               rows_per_task=self.rows_per_task)
+        return planner.plan(self.rows_count, self.max_id_num_row, self.min_id_num_row)
+
+    def hash_iterator(self, packed=False):
+        """ Yield the rows hashed by the local pool, range by range """
+        return ordered_imap(partial(extract_range,
+                                    self.schema_raw,
+                                    self.scheme.scheme_id,
+                                    packed,
+                                    date_filter=self.get_date_filter().as_string(
+                                        self.database.conn)),
+                            self.get_ranges(),
+                            processes=self.parallel_workers)
+
+    def adapter_copy_run(self):
+        """ Insert data from PostgreSQL hashed by the local pool """
+        target_table = '.'.join([self.schema_target, self.storage_table])
+
+        m.info('Run copy extraction...')
+        try:
+            if self.binary:
+                source = binary_stream(encode_hash_records(packed, 'postresql_adapter')
+                                       for packed in self.hash_iterator(packed=True))
+            else:
+                source = self.hash_iterator()
+            with self.database.session('staging'):
+                rows = self.database.bulk_copy(IteratorFile(source), target_table,
+                                               binary=self.binary)
+            m.info('PostgreSQL copy adapter_run of %s rows successfully completed' % rows)
+        except psycopg2.Error as err:
+            m.error('OOps! PostgreSQL copy adapter_run FAILED! Reason %s' % str(err.pgerror))
+
+    @m.timing
+    @m.wrapper(m.entering, m.exiting)
+    def export_hashes(self, callback, packed=False):
+        """ Stream the hashed rows by batches of 'adapter\tuid\thash' lines
+            (or packed records) into the callback """
+        self.rows_count, self.max_id_num_row = self.get_rows_count()
+
+        if self.local_hashing:
+            try:
+                for hash_buffer in self.hash_iterator(packed):
+                    callback(hash_buffer)
+                m.info('PostgreSQL hashes export successfully completed')
+            except psycopg2.Error as err:
+                m.error('OOps! Export_hashes FAILED! Reason: %s' % str(err.pgerror))
+            return
+
+        sql_command = sql.SQL("""
+            copy (
+                select
+                    'postresql_adapter',
+                    transaction_uid,
+                    {1}
+                from {0}.transaction_log
+                where id_num_row > {2} and id_num_row <= {3}{4}
+            ) to stdout""").format(sql.Identifier(self.schema_raw),
+                                   self.scheme.sql_expression,
+                                   sql.Literal(self.min_id_num_row),
+                                   sql.Literal(self.max_id_num_row),
+                                   self.get_date_filter())
+
+        def send_batch(text):
+            """ Pass the batch on in the requested form """
+            m.metrics.add_progress(text.count('\n'), len(text))
+            callback(pack_hash_lines(text) if packed else text)
+
+        try:
+            self.database.bulk_export(sql_command, LineSink(send_batch))
+            m.info('PostgreSQL hashes export successfully completed')
+        except psycopg2.Error as err:
+            m.error('OOps! Export_hashes FAILED! Reason: %s' % str(err.pgerror))
+
+    @m.timing
+    @m.wrapper(m.entering, m.exiting)
+    def save_clean_uids(self, packed_uids):
+        """ Saving the rows reconciled outside of the database """
+        matched_table = sql.Identifier('_'.join([self.storage_table, 'matched']))
+        sql_create = sql.SQL("""
+            drop table if exists {0};
+            create temp table {0} (transaction_uid uuid not null);
+            """).format(matched_table)
+
+        sql_index = sql.SQL("""
+            create index on {0} (transaction_uid);
+            analyze {0};
+            """).format(matched_table)
+
+        try:
+            self.database.execute(sql_create)
+            if self.binary:
+                source = binary_stream(encode_uids(part) for part in packed_uids)
+            else:
+                source = ('\n'.join(unpack_uids(part)) + '\n' for part in packed_uids)
+            with self.database.session('staging'):
+                rows_count = self.database.bulk_copy(IteratorFile(source),
+                                                     '_'.join([self.storage_table, 'matched']),
+                                                     binary=self.binary)
+            self.database.execute(sql_index)
+        except psycopg2.Error as err:
+            m.error('OOps! Save_clean_uids FAILED! Reason: %s' % str(err.pgerror))
+            return
+
+        self.publish_clean(matched_table, sql.SQL('true'), rows_count)
+
+        try:
+            self.database.execute(sql.SQL('drop table if exists {0};').format(matched_table))
+        except psycopg2.Error as err:
+            m.error('OOps! Save_clean_uids FAILED! Reason: %s' % str(err.pgerror))
+
+    def run_state_create(self):
+        """ Create the table of the watermarks """
+        sql_command = sql.SQL("""
+            create table if not exists {0}.run_state (
+                source_name         varchar(255) not null,
+                watermark           bigint not null,
+                fingerprint         varchar(64),
+                date_update         timestamp default now(),
+                constraint pk_run_state primary key (source_name)
+            );""").format(sql.Identifier(self.schema_target))
         try:
             self.database.execute(sql_command)
+        except psycopg2.Error as err:
+            m.error('OOps! Table creating for run_state FAILED! Reason: %s' % str(err.pgerror))
 
-            m.info('Saving to the clean schema has been successfully completed!')
+    def load_run_state(self):
+        """ Return the watermarks of the sources by their names """
+        self.run_state_create()
+        sql_command = sql.SQL("""
+            select source_name, watermark, fingerprint
+            from {0}.run_state;""").format(sql.Identifier(self.schema_target))
+
+        state = {}
+        try:
+            for row in self.database.query(sql_command):
+                state[row['source_name']] = (row['watermark'], row['fingerprint'])
         except psycopg2.Error as err:
-            m.error('OOps! Save_clean_data FAILED! Reason: %s, SQL command: %s'
-                    % (str(err.pgerror), sql_command))
+            m.error('OOps! Load_run_state FAILED! Reason: %s' % str(err.pgerror))
+
+        return state
+
+    def save_run_state(self, source_name, watermark, fingerprint=None):
+        """ Move the watermark of a source """
+        self.run_state_create()
+        sql_command = sql.SQL("""
+            insert into {0}.run_state
+                (source_name, watermark, fingerprint)
+            values (%(source_name)s, %(watermark)s, %(fingerprint)s)
+            on conflict (source_name) do update
+            set watermark = excluded.watermark,
+                fingerprint = excluded.fingerprint,
+                date_update = now();""").format(sql.Identifier(self.schema_target))
+
+        try:
+            self.database.execute(sql_command,
+                                  source_name=source_name,
+                                  watermark=watermark,
+                                  fingerprint=fingerprint)
+            m.info('Watermark of %s has been moved to %s' % (source_name, watermark))
+        except psycopg2.Error as err:
+            m.error('OOps! Save_run_state FAILED! Reason: %s' % str(err.pgerror))
+
+    def get_source_name(self):
+        """ Name of the database side in run_state """
+        return '.'.join([self.schema_raw, 'transaction_log'])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+""" Balanced id_num_row ranges for the parallel work """
+
+from math import ceil
+
+import psycopg2
+from psycopg2 import sql
+
+from utils.monitoring import Monitoring
+
+m = Monitoring('range_planner')
+
+
+class RangePlanner:
+    """ Splits a bigint column into (start, end] ranges of about
+        rows_per_task rows each, following the real distribution
+        of the values instead of their width """
+    def __init__(self, database, schema, table,
+                 column='id_num_row', rows_per_task=50000):
+        self.database = database
+        self.schema = schema
+        self.table = table
+        self.column = column
+        self.rows_per_task = max(1, rows_per_task)
+
+    def histogram_bounds(self):
+        """ Return the equal-frequency bounds collected by ANALYZE """
+        sql_command = """
+            select histogram_bounds::text::bigint[]
+            from pg_stats
+            where schemaname = %(schema)s
+                and tablename = %(table)s
+                and attname = %(column)s;"""
+
+        row = self.database.query_one(sql_command,
+                                      schema=self.schema,
+                                      table=self.table,
+                                      column=self.column)
+        return row[0] if row and row[0] else []
+
+    def analyze(self):
+        """ Collect the statistics of the column """
+        sql_command = sql.SQL('analyze {0}.{1} ({2});').format(sql.Identifier(self.schema),
+                                                               sql.Identifier(self.table),
+                                                               sql.Identifier(self.column))
+        self.database.execute(sql_command)
+
+    def ntile_bounds(self, tasks, min_value):
+        """ Return the last values of `tasks` groups of equal size """
+        sql_command = sql.SQL("""
+            select max(n) from (
+                select {2} as n, ntile(%(tasks)s) over (order by {2}) as tile
+                from {0}.{1}
+                where {2} > %(min_value)s
+            ) s
+            group by tile
+            order by 1;""").format(sql.Identifier(self.schema),
+                                   sql.Identifier(self.table),
+                                   sql.Identifier(self.column))
+
+        return [row[0] for row in self.database.query(sql_command,
+                                                      tasks=tasks,
+                                                      min_value=min_value)]
+
+    @staticmethod
+    def split_bounds(bounds, tasks):
+        """ Turn k equal-frequency buckets into `tasks` buckets """
+        buckets = len(bounds) - 1
+        if tasks <= buckets:
+            return [bounds[round(i * buckets / tasks)] for i in range(tasks + 1)]
+
+        # more tasks than buckets: divide every bucket by the width
+        parts = ceil(tasks / buckets)
+        new_bounds = [bounds[0]]
+        for low, high in zip(bounds, bounds[1:]):
+            for i in range(1, parts + 1):
+                new_bounds.append(low + (high - low) * i // parts)
+        return new_bounds
+
+    def plan(self, total_rows, max_value, min_value=0):
+        """ Return the list of [start, end] ranges covering the values
+            in (min_value, max_value], start is exclusive """
+        if not total_rows or max_value <= min_value:
+            return []
+
+        tasks = ceil(total_rows / self.rows_per_task)
+        bounds = []
+
+        try:
+            if tasks > 1:
+                bounds = self.histogram_bounds()
+                if not bounds:
+                    self.analyze()
+                    bounds = self.histogram_bounds()
+
+                bounds = [min_value] + [value for value in bounds
+                                        if min_value < value <= max_value]
+                if len(bounds) < 2:
+                    bounds = [min_value] + self.ntile_bounds(tasks, min_value)
+        except psycopg2.Error as err:
+            m.error('OOps! Range planning FAILED, equal ranges are used. Reason: %s'
+                    % str(err.pgerror))
+            self.database.conn.rollback()
+            bounds = []
+
+        if len(bounds) < 2:
+            bounds = list(range(min_value, max_value, self.rows_per_task)) + [max_value]
+        else:
+            bounds = self.split_bounds(bounds, tasks)
+
+        # the rows added after the statistics: ranges of rows_per_task ids,
+        # a short tail goes into the last range
+        while bounds[-1] < max_value:
+            if max_value - bounds[-1] <= self.rows_per_task // 2:
+                bounds[-1] = max_value
+            else:
+                bounds.append(min(bounds[-1] + self.rows_per_task, max_value))
+
+        ranges = []
+        start = bounds[0]
+        for end in bounds[1:]:
+            if end > start:
+                ranges.append([start, end])
+                start = end
+
+        m.info('%s rows split into %s ranges' % (total_rows, len(ranges)))
+        return ranges
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+""" Stage-level benchmark of the reconciliation """
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import threading
+import subprocess
+import multiprocessing as mp
+
+from generate_test_data import GenerateTestData
+from reconciliation_start import Reconciliator
+from engines.hash_join import HashJoinEngine
+from engines.sort_merge import SortMergeEngine
+from utils.config_reader import ConfigReader
+from utils.monitoring import Monitoring
+
+
+m = Monitoring('benchmark')
+
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+
+def get_peak_rss_mb():
+    """ Return the peak resident memory of the process and of its
+        finished workers since the start, in Mb """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    divider = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(peak_self, peak_children) / divider, 2)
+
+
+def get_rss_kb(pid):
+    """ Return the resident memory of a process in Kb, 0 if it is gone """
+    try:
+        with open('/proc/%s/status' % pid) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def get_process_tree(pid):
+    """ Return the pid and the pids of all its descendants """
+    pids = [pid]
+    for pid in pids:
+        try:
+            for task in os.listdir('/proc/%s/task' % pid):
+                with open('/proc/%s/task/%s/children' % (pid, task)) as file:
+                    pids.extend(int(child) for child in file.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+class RssSampler(threading.Thread):
+    """ Samples the resident memory of the process and of its workers
+        while a stage runs, the peak of the sum is the one of the stage.
+        Without /proc the lifetime peak of ru_maxrss is taken """
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.enabled = os.path.exists('/proc/self/status')
+        self.peak_kb = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        """ Take the current memory of the process tree """
+        rss_kb = sum(get_rss_kb(pid) for pid in get_process_tree(os.getpid()))
+        self.peak_kb = max(self.peak_kb, rss_kb)
+
+    def run(self):
+        """ Sample until the stage is over """
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if self.enabled:
+            self.sample()
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self.done.set()
+            self.join()
+            self.sample()
+
+    def get_peak_mb(self):
+        """ Return the peak of the stage in Mb """
+        if not self.enabled:
+            return get_peak_rss_mb()
+        return round(self.peak_kb / 1024, 2)
+
+
+def get_commit():
+    """ Return the current git commit, if any """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    """ Builds a dataset of a fixed size and seed and times every
+        stage of the reconciliation separately """
+    def __init__(self, num_rows, seed):
+        self.num_rows = num_rows
+        self.seed = seed
+        self.stages = {}
+        self.setup_seconds = None
+
+    def stage(self, name, func, *args):
+        """ Run and measure one stage """
+        with RssSampler() as sampler:
+            start = time.perf_counter()
+            result = func(*args)
+            seconds = time.perf_counter() - start
+
+        self.stages[name] = {
+            'seconds': round(seconds, 4),
+            'rows_per_sec': round(self.num_rows / seconds) if seconds else None,
+            'peak_rss_mb': sampler.get_peak_mb()
+        }
+        m.info('Stage %s: %s sec' % (name, round(seconds, 4)))
+        return result
+
+    def prepare(self):
+        """ Create the CSV file and the database table """
+        start = time.perf_counter()
+        GenerateTestData(self.seed).run(self.num_rows)
+        self.setup_seconds = round(time.perf_counter() - start, 4)
+
+    def run_database(self, recon):
+        """ The stages of the storage table engine """
+        self.stage('csv_hashing', recon.csv.run_reading)
+        self.stage('storage_load', self.storage_load, recon)
+        self.stage('pg_hashing', recon.postgresql_adapter_run)
+        self.stage('storage_finalize', recon.psa.storage_finalize)
+        self.stage('report', recon.get_report)
+        self.stage('clean_save', recon.reconcillation_run)
+
+    @staticmethod
+    def storage_load(recon):
+        """ Create the storage table and load the CSV hashes """
+        recon.storage_preparing()
+        recon.csv.bulk_copy_to_db()
+
+    def run_hash_join(self, recon):
+        """ The stages of the in-process engine """
+        engine = HashJoinEngine()
+
+        self.stage('pg_hashing', self.hash_join_build, recon, engine)
+        self.stage('csv_hashing', self.hash_join_probe, recon, engine)
+        report = self.stage('report', engine.finish)
+        report.print_report()
+        self.stage('clean_save', recon.psa.save_clean_uids, engine.matched_uids())
+
+    @staticmethod
+    def hash_join_build(recon, engine):
+        """ Export and sort the database side """
+        recon.psa.export_hashes(engine.add_build, packed=True)
+        engine.build_finish()
+
+    @staticmethod
+    def hash_join_probe(recon, engine):
+        """ Hash the CSV side and probe it against the database side """
+        for packed in recon.csv.hash_iterator(packed=True):
+            engine.probe(packed)
+
+    def run_sort_merge(self, recon):
+        """ The stages of the on-disk engine """
+        engine = SortMergeEngine(recon.conf_reader.get_attr('sort_dir'),
+                                 recon.conf_reader.get_attr('sort_run_mb'))
+        try:
+            self.stage('pg_hashing', recon.psa.export_hashes, engine.add_db, True)
+            self.stage('csv_hashing', self.sort_merge_spill, recon, engine)
+            report = self.stage('report', engine.finish)
+            report.print_report()
+            self.stage('clean_save', recon.psa.save_clean_uids, engine.matched_uids())
+        finally:
+            engine.close()
+
+    @staticmethod
+    def sort_merge_spill(recon, engine):
+        """ Hash the CSV side into the sorted runs """
+        for packed in recon.csv.hash_iterator(packed=True):
+            engine.add_csv(packed)
+
+    def run(self):
+        """ Prepare the data and run the stages, return the results """
+        self.prepare()
+
+        errors_before = Monitoring.errors_count
+        recon = Reconciliator()
+        recon.psa.register_run(recon.engine)
+
+        if recon.engine == 'hash_join':
+            self.run_hash_join(recon)
+        elif recon.engine == 'sort_merge':
+            self.run_sort_merge(recon)
+        else:
+            self.run_database(recon)
+
+        total = sum(stage['seconds'] for stage in self.stages.values())
+        return {
+            'rows': self.num_rows,
+            'seed': self.seed,
+            'setup_seconds': self.setup_seconds,
+            'total_seconds': round(total, 4),
+            'rows_per_sec': round(self.num_rows / total) if total else None,
+            'peak_rss_mb': max(stage['peak_rss_mb'] for stage in self.stages.values()),
+            'errors': Monitoring.errors_count - errors_before,
+            'stages': self.stages
+        }
+
+
+def main():
+    """ Benchmark starter """
+    parser = argparse.ArgumentParser(description='Stage-level benchmark of the reconciliation. '
+                                                 'It recreates the test schemas of conf/db.ini!')
+    parser.add_argument('sizes', nargs='*', type=int, default=DEFAULT_SIZES,
+                        help='dataset sizes in rows')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the test data')
+    parser.add_argument('--output', default='data/benchmark.json', help='JSON result file')
+    args = parser.parse_args()
+
+    # the data doesn't exist yet: the config is read without the adapters
+    conf_reader = ConfigReader('./conf/db.ini')
+    result = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'cpu_count': mp.cpu_count(),
+        'engine': conf_reader.get_attr('engine'),
+        'digest_scheme': conf_reader.get_attr('digest_scheme'),
+        'extract_mode': conf_reader.get_attr('extract_mode'),
+        'streaming': conf_reader.get_attr('streaming'),
+        'runs': []
+    }
+
+    for num_rows in args.sizes:
+        m.info('Benchmark of %s rows' % num_rows)
+        result['runs'].append(Benchmark(num_rows, args.seed).run())
+
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    m.info('Benchmark results have been saved into %s' % args.output)
+
+if __name__ == '__main__':
+    main()
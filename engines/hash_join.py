@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" In-process reconciliation engine """
+
+import numpy as np
+
+from engines.records import UID_SIZE
+from engines.report import (DiscrepancyReport, MATCHED, HASH_MISMATCH,
+                            MISSING_IN_CSV, MISSING_IN_DB)
+from utils.monitoring import Monitoring
+
+m = Monitoring('hash_join')
+
+RECORD_DTYPE = np.dtype([('uid', 'S16'), ('digest', 'S16')])
+
+
+class HashJoinEngine:
+    """ Keeps the database side in memory as two sorted S16 arrays
+        (32 bytes per row) and streams the CSV side against it,
+        every transaction_uid is counted once as in the database engine """
+    def __init__(self):
+        self._build_parts = []
+        self.uids = None
+        self.records = None
+        self.seen = None
+        self.matched = None
+
+        self.report = DiscrepancyReport()
+        self.missing_parts = []
+
+    def add_build(self, packed):
+        """ Collect packed records of the database side """
+        if packed:
+            self._build_parts.append(packed)
+
+    @m.timing
+    def build_finish(self):
+        """ Sort the collected database side by (transaction_uid, digest) """
+        records = np.frombuffer(b''.join(self._build_parts), dtype=RECORD_DTYPE)
+        self._build_parts = []
+
+        order = np.lexsort((records['digest'], records['uid']))
+        records = records[order]
+        self.uids = records['uid']
+        # the whole record as one key for the exact (uid, digest) lookups
+        self.records = records.view('S%s' % RECORD_DTYPE.itemsize)
+
+        # the state of a transaction_uid is kept on its first row
+        self.seen = np.zeros(len(self.uids), dtype=bool)
+        self.matched = np.zeros(len(self.uids), dtype=bool)
+
+        m.info('Hash join build side: %s rows, %s Mb'
+               % (len(self.uids), round(self.records.nbytes / (1024 * 1024), 2)))
+
+    def probe(self, packed):
+        """ Mark the transaction_uid of packed records of the CSV side """
+        batch = np.frombuffer(packed, dtype=RECORD_DTYPE)
+        if not len(batch):
+            return
+
+        if not len(self.uids):
+            self.missing_parts.append(batch['uid'].tobytes())
+            return
+
+        first = np.searchsorted(self.uids, batch['uid'])
+        first[first == len(self.uids)] = 0
+        found = self.uids[first] == batch['uid']
+
+        keys = batch.view('S%s' % RECORD_DTYPE.itemsize)
+        idx = np.searchsorted(self.records, keys)
+        idx[idx == len(self.records)] = 0
+        same = self.records[idx] == keys
+
+        self.seen[first[found]] = True
+        self.matched[first[same]] = True
+        self.missing_parts.append(batch['uid'][~found].tobytes())
+
+    def finish(self):
+        """ Classify every transaction_uid of both sides """
+        starts = np.ones(len(self.uids), dtype=bool)
+        starts[1:] = self.uids[1:] != self.uids[:-1]
+
+        matched_count = int((starts & self.matched).sum())
+        seen_count = int((starts & self.seen).sum())
+        self.report.add(MATCHED, matched_count)
+        self.report.add(HASH_MISMATCH, seen_count - matched_count)
+        self.report.add(MISSING_IN_CSV, int(starts.sum()) - seen_count)
+
+        missing = np.frombuffer(b''.join(self.missing_parts), dtype='S%s' % UID_SIZE)
+        self.report.add(MISSING_IN_DB, len(np.unique(missing)))
+        self.missing_parts = []
+
+        self.matched = starts & self.matched
+        return self.report
+
+    def matched_uids(self, block_rows=1024*1024):
+        """ Yield packed arrays of the reconciled transaction_uid """
+        uids = self.uids[self.matched]
+        for pos in range(0, len(uids), block_rows):
+            yield uids[pos:pos + block_rows].tobytes()
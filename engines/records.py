@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+""" Fixed-width (transaction_uid, digest) records shared by the engines """
+
+import io
+
+# 16 bytes of transaction_uid followed by 16 bytes of digest
+UID_SIZE = 16
+RECORD_SIZE = 32
+
+
+def pack_hash_lines(text):
+    """ Pack lines like 'adapter\\tuid\\thash' (adapter name is optional)
+        into the concatenated 32-byte records """
+    packed = bytearray()
+    for line in text.splitlines():
+        if not line:
+            continue
+        fields = line.split('\t')
+        packed += bytes.fromhex((fields[-2] + fields[-1]).replace('-', ''))
+    return bytes(packed)
+
+
+def unpack_hash_lines(packed, adapter_name):
+    """ Turn the packed records back into 'adapter\tuid\thash' lines """
+    output = []
+    for pos in range(0, len(packed), RECORD_SIZE):
+        output.append(adapter_name + '\t' +
+                      packed[pos:pos + UID_SIZE].hex() + '\t' +
+                      packed[pos + UID_SIZE:pos + RECORD_SIZE].hex() + '\n')
+    return ''.join(output)
+
+
+def unpack_uids(packed):
+    """ Return the text uuids of the packed uid array """
+    for pos in range(0, len(packed), UID_SIZE):
+        yield packed[pos:pos + UID_SIZE].hex()
+
+
+class LineSink(io.TextIOBase):
+    """ Writable file object for copy_expert(... TO STDOUT): collects the
+        output and passes it on to the callback by batches of whole lines """
+    def __init__(self, callback, batch_size=1024*1024*8):
+        self.callback = callback
+        self.batch_size = batch_size
+        self._parts = []
+        self._size = 0
+        self._tail = ''
+
+    def writable(self):
+        """ The stream is writable """
+        return True
+
+    def write(self, data):
+        """ Collect a new piece of the COPY output """
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self.batch_size:
+            self._push()
+        return len(data)
+
+    def _push(self, final=False):
+        """ Send the complete lines to the callback """
+        text = self._tail + ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+
+        if final:
+            self._tail = ''
+        else:
+            cut = text.rfind('\n') + 1
+            text, self._tail = text[:cut], text[cut:]
+
+        if text:
+            self.callback(text)
+
+    def flush(self):
+        """ Send everything that is left """
+        if self._parts or self._tail:
+            self._push(final=True)
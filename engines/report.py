@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" Classified reconciliation report """
+
+MATCHED = 'matched'
+HASH_MISMATCH = 'hash_mismatch'
+MISSING_IN_CSV = 'missing_in_csv'
+MISSING_IN_DB = 'missing_in_db'
+
+CLASSES = (MATCHED, HASH_MISMATCH, MISSING_IN_CSV, MISSING_IN_DB)
+
+
+class DiscrepancyReport:
+    """ Counts of transaction_uid by the reconciliation class """
+    def __init__(self, **counts):
+        self.counts = dict.fromkeys(CLASSES, 0)
+        for name, value in counts.items():
+            self.add(name, value)
+
+    def add(self, name, value):
+        """ Increase a class counter """
+        self.counts[name] += int(value)
+
+    def get_adapters_count(self):
+        """ Return the discrepancies from the side of every adapter """
+        return [('csv_adapter',
+                 self.counts[HASH_MISMATCH] + self.counts[MISSING_IN_DB]),
+                ('postresql_adapter',
+                 self.counts[HASH_MISMATCH] + self.counts[MISSING_IN_CSV])]
+
+    def print_report(self):
+        """ Print the report to stdout """
+        print('\n\tNumber of discrepancies detected by adapters')
+        print('\t---------------------------------')
+        for row in self.get_adapters_count():
+            print('\t', end='')
+            print('{:20} | {:10}'.format(row[0], row[1]))
+        print('\t---------------------------------')
+
+        print('\n\tNumber of transactions by classes')
+        print('\t---------------------------------')
+        for name in CLASSES:
+            print('\t', end='')
+            print('{:20} | {:10}'.format(name, self.counts[name]))
+        print('\t---------------------------------')
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+""" External sort-merge reconciliation engine """
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from engines.hash_join import RECORD_DTYPE
+from engines.records import UID_SIZE
+from engines.report import (DiscrepancyReport, MATCHED, HASH_MISMATCH,
+                            MISSING_IN_CSV, MISSING_IN_DB)
+from utils.monitoring import Monitoring
+
+m = Monitoring('sort_merge')
+
+DB_SIDE = 'db'
+CSV_SIDE = 'csv'
+
+# a record and its side, 1 for the database
+WORK_DTYPE = np.dtype([('uid', 'S%s' % UID_SIZE),
+                       ('digest', 'S%s' % UID_SIZE),
+                       ('db', 'u1')])
+
+
+class SortedRun:
+    """ A run file of records sorted by transaction_uid, read back by blocks """
+    def __init__(self, file_name, side):
+        self.file_name = file_name
+        self.side = side
+        self.file = None
+        self.buffer = np.empty(0, dtype=RECORD_DTYPE)
+        self.exhausted = False
+
+    def fill(self, rows):
+        """ Read the file until the buffer has `rows` records """
+        if self.file is None:
+            self.file = open(self.file_name, 'rb')
+
+        if len(self.buffer) < rows and not self.exhausted:
+            count = rows - len(self.buffer)
+            block = np.fromfile(self.file, dtype=RECORD_DTYPE, count=count)
+            if len(block) < count:
+                self.exhausted = True
+                self.file.close()
+            if len(block):
+                self.buffer = np.concatenate([self.buffer, block])
+
+    def take_below(self, bound=None):
+        """ Remove and return the records with uid < bound (all without it) """
+        if bound is None:
+            rows = len(self.buffer)
+        else:
+            rows = int(np.searchsorted(self.buffer['uid'], bound, side='left'))
+        part = self.buffer[:rows]
+        self.buffer = self.buffer[rows:]
+        return part
+
+
+class SortMergeEngine:
+    """ Spills the (transaction_uid, digest) records of both sides into
+        sorted run files and merge-joins the runs by transaction_uid.
+        run_mb is the budget of the records in memory, shared by the
+        sides: each of them fills half of it and sorts it in place, the
+        merge buffers a third of it and classifies a copy of them. The
+        peak is about run_mb (1.1 x measured with 4M + 4M records and
+        run_mb of 16 to 128) over the hashed chunks in flight, whatever
+        the size of the sources, as long as the merge blocks of 1024
+        records per run fit in a third of it """
+    def __init__(self, work_dir=None, run_mb=256):
+        self.work_dir = tempfile.mkdtemp(prefix='reconciliation_sort_', dir=work_dir or None)
+        self.run_rows = max(1024, run_mb * 1024 * 1024 // RECORD_DTYPE.itemsize)
+
+        # allocated on the first records, filled in place
+        self.buffers = {}
+        self.buffer_rows = {DB_SIDE: 0, CSV_SIDE: 0}
+        self.runs = []
+
+        self.report = DiscrepancyReport()
+        self.matched_file = os.path.join(self.work_dir, 'matched.uid')
+
+    def add_db(self, packed):
+        """ Collect packed records of the database side """
+        self.add(DB_SIDE, packed)
+
+    def add_csv(self, packed):
+        """ Collect packed records of the CSV side """
+        self.add(CSV_SIDE, packed)
+
+    def add(self, side, packed):
+        """ Copy the records into the buffer of the side, spilling it
+            into a new run whenever it is full """
+        records = np.frombuffer(packed, dtype=RECORD_DTYPE)
+        while len(records):
+            buffer = self.buffers.get(side)
+            if buffer is None:
+                buffer = self.buffers[side] = np.empty(max(1, self.run_rows // 2),
+                                                       dtype=RECORD_DTYPE)
+            start = self.buffer_rows[side]
+            rows = min(len(records), len(buffer) - start)
+            buffer[start:start + rows] = records[:rows]
+            self.buffer_rows[side] += rows
+            records = records[rows:]
+            if self.buffer_rows[side] == len(buffer):
+                self.spill(side)
+
+    def spill(self, side):
+        """ Sort the collected records in place and write them as a run file """
+        if not self.buffer_rows[side]:
+            return
+        records = self.buffers[side][:self.buffer_rows[side]]
+        self.buffer_rows[side] = 0
+
+        # by transaction_uid, then by digest: the bytes of the whole record
+        records.view('S%s' % RECORD_DTYPE.itemsize).sort()
+        file_name = os.path.join(self.work_dir, '%s_%06d.run' % (side, len(self.runs)))
+        records.tofile(file_name)
+        self.runs.append(SortedRun(file_name, side))
+
+    def classify(self, parts):
+        """ Classify the complete uid groups of the merged records, the
+            rules are the ones of PostgreSQLAdapter.classify_storage:
+            matched if a digest is on both sides, whatever the duplicates """
+        rows = sum(len(part) for part, _ in parts)
+        if not rows:
+            return
+
+        # the records and their side, sorted in place by (uid, digest, side)
+        work = np.empty(rows, dtype=WORK_DTYPE)
+        pos = 0
+        for part, side in parts:
+            work['uid'][pos:pos + len(part)] = part['uid']
+            work['digest'][pos:pos + len(part)] = part['digest']
+            work['db'][pos:pos + len(part)] = side == DB_SIDE
+            pos += len(part)
+        work.view('S%s' % WORK_DTYPE.itemsize).sort()
+        uids, digests, is_db = work['uid'], work['digest'], work['db']
+
+        new_uid = np.ones(rows, dtype=bool)
+        new_uid[1:] = uids[1:] != uids[:-1]
+        new_digest = new_uid.copy()
+        new_digest[1:] |= digests[1:] != digests[:-1]
+
+        starts = np.flatnonzero(new_uid)
+        has_db = np.maximum.reduceat(is_db, starts) > 0
+        has_csv = np.minimum.reduceat(is_db, starts) == 0
+
+        # a (uid, digest) group sorted by side has both sides if the CSV
+        # side turns into the database side inside of it
+        both_sides = np.zeros(rows, dtype=bool)
+        both_sides[1:] = ~new_digest[1:] & (is_db[1:] > is_db[:-1])
+
+        missing_in_db = ~has_db
+        missing_in_csv = ~has_csv
+        matched = np.logical_or.reduceat(both_sides, starts)
+
+        self.report.add(MISSING_IN_DB, missing_in_db.sum())
+        self.report.add(MISSING_IN_CSV, missing_in_csv.sum())
+        self.report.add(MATCHED, matched.sum())
+        self.report.add(HASH_MISMATCH, len(starts) - missing_in_db.sum()
+                        - missing_in_csv.sum() - matched.sum())
+
+        with open(self.matched_file, 'ab') as file:
+            file.write(uids[starts][matched].tobytes())
+
+    @m.timing
+    def merge(self):
+        """ K-way merge of the runs by blocks: the records below the
+            smallest last uid of the buffered blocks are complete groups.
+            The blocks of all the runs take a third of the budget """
+        block_rows = max(1024, self.run_rows // max(1, 3 * len(self.runs)))
+        runs = list(self.runs)
+
+        while True:
+            for run in runs:
+                run.fill(block_rows)
+            runs = [run for run in runs if len(run.buffer)]
+            if not runs:
+                break
+
+            bounds = [run.buffer['uid'][-1] for run in runs if not run.exhausted]
+            bound = min(bounds) if bounds else None
+            parts = [(run.take_below(bound), run.side) for run in runs]
+
+            if not sum(len(part) for part, _ in parts):
+                # one uid fills the whole buffers of the bounding runs
+                for run in runs:
+                    if not run.exhausted and run.buffer['uid'][-1] == bound:
+                        run.fill(len(run.buffer) + block_rows)
+                continue
+
+            self.classify(parts)
+            # the blocks under the parts are freed before the next reads
+            del parts
+
+    def finish(self):
+        """ Spill the rest, merge the runs and return the report """
+        self.spill(DB_SIDE)
+        self.spill(CSV_SIDE)
+        # the merge has the memory of the collection
+        self.buffers = {}
+
+        m.info('Sort-merge: %s runs of up to %s rows in %s'
+               % (len(self.runs), max(1, self.run_rows // 2), self.work_dir))
+        open(self.matched_file, 'wb').close()
+        self.merge()
+        return self.report
+
+    def matched_uids(self, block_rows=1024*1024):
+        """ Yield packed arrays of the reconciled transaction_uid """
+        with open(self.matched_file, 'rb') as file:
+            while True:
+                part = file.read(block_rows * UID_SIZE)
+                if not part:
+                    break
+                yield part
+
+    def close(self):
+        """ Remove the run files """
+        shutil.rmtree(self.work_dir, ignore_errors=True)
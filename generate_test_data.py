@@ -3,97 +3,204 @@
 """ Test data generating """
 
 import os
-import sys
-import csv
+import io
+import shutil
+import argparse
 import multiprocessing as mp
-from random import randrange
-from random import randint, choice
-import uuid
-import datetime as dt
 
+import numpy as np
 import psycopg2
 from psycopg2 import sql
 
-from adapters.database_tool import PostgreSQLCommon
+from adapters.database_tool import PostgreSQLCommon, get_worker_database
+from adapters.binary_copy import (binary_stream, encode_columns, uuid_column, text_column,
+                                  timestamp_column, float8_column)
 from utils.monitoring import Monitoring
 from utils.config_reader import ConfigReader
 
 
 m = Monitoring('data_generating')
 
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+# (text position, first hex digit, last hex digit) of the uuid groups
+UUID_GROUPS = ((0, 0, 8), (9, 8, 12), (14, 12, 16), (19, 16, 20), (24, 20, 32))
+
+RAW_COLUMNS = ('transaction_uid',
+               'account_uid',
+               'transaction_date',
+               'type_deal',
+               'transaction_amount')
+
 
 class TestDataCreator:
     """ The main class for the data generating """
-    def __init__(self, num_rows, conf_reader, data_file):
+    def __init__(self, num_rows, conf_reader, data_file, seed=None,
+                 load_table=None, write_csv=True, binary=False):
         self.num_rows = num_rows
+        # The same seed gives the same file, None gives new random rows
+        self.seed = seed
+        # Every worker COPYs its chunk into load_table over its own connection
+        self.load_table = load_table
+        # The chunks are loaded in the binary COPY format
+        self.binary = binary
+        self.write_csv = write_csv
         self.conf_reader = conf_reader
         self.data_file = data_file
         if os.path.exists(self.data_file):
             os.remove(self.data_file)
 
-        self.date_in = dt.datetime.strptime(self.conf_reader.get_attr('initial_date'),
-                                            '%Y-%m-%d')
+        self.date_in = np.datetime64(self.conf_reader.get_attr('initial_date'), 's')
         self.random_accounts_count = int(self.conf_reader.get_attr('random_accounts'))
-        self.list_acc = self.get_accounts_num()     # Ten random accounts
+        self.accounts = self.get_accounts_num()     # Ten random accounts
+
+        self.list_type_deal = np.array([b'commision', b'deal'])
+
+    def get_rng(self, chunk_start=None):
+        """ Return the random generator of a chunk, every chunk has its
+            own stream, so the rows don't depend on the workers """
+        if self.seed is None:
+            return np.random.default_rng()
+        # tagged keys: [seed, 0] of the first chunk would repeat the accounts
+        if chunk_start is None:
+            return np.random.default_rng([self.seed, 0])
+        return np.random.default_rng([self.seed, 1, chunk_start])
 
-        self.list_type_deal = ['commision', 'deal']
+    @staticmethod
+    def get_random_uuids(rng, num):
+        """ Return num random uuids (version 4) as a (num, 16) array of bytes """
+        raw = rng.integers(0, 256, size=(num, 16), dtype=np.uint8)
+        raw[:, 6] = (raw[:, 6] & 0x0f) | 0x40
+        raw[:, 8] = (raw[:, 8] & 0x3f) | 0x80
+        return raw
 
     @staticmethod
-    def get_random_date(start, num):
-        """ Return a random date from a start value """
-        current = start
-        while num >= 0:
-            curr = current + \
-                   dt.timedelta(days=randrange(365)) + \
-                   dt.timedelta(hours=randrange(60)) + \
-                   dt.timedelta(minutes=randrange(60)) + \
-                   dt.timedelta(seconds=randrange(60))
-            yield curr
-            num -= 1
+    def get_uuids_text(raw):
+        """ Return the uuids as a (num, 36) array of chars """
+        num = len(raw)
+        digits = np.empty((num, 32), dtype=np.uint8)
+        digits[:, 0::2] = HEX_DIGITS[raw >> 4]
+        digits[:, 1::2] = HEX_DIGITS[raw & 0x0f]
+
+        uuids = np.full((num, 36), ord('-'), dtype=np.uint8)
+        for text_start, digit_start, digit_end in UUID_GROUPS:
+            uuids[:, text_start:text_start + digit_end - digit_start] = \
+                digits[:, digit_start:digit_end]
+        return uuids
 
     def get_accounts_num(self):
-        """ Return a list of accounts """
-        acc_list = []
-        while self.random_accounts_count >= 0:
-            acc_list.append(uuid.uuid4())
-            self.random_accounts_count -= 1
-        return acc_list
-
-    def write_in_file(self, rows, chunk_start, chunk_end):
-        """ Save data into csv file """
-        try:
-            with open(self.data_file, 'a', newline='\n') as file:
-                csv_writer = csv.writer(file, delimiter='\t', )
-                csv_writer.writerows(rows)
-                file.flush()
+        """ Return an array of accounts """
+        return self.get_random_uuids(self.get_rng(), self.random_accounts_count + 1)
 
-            print('\tTest data created from {:7} to {:7} rows. '.format(chunk_start,
-                                                                        chunk_end), end=' ')
-        except Exception as err:
-            m.error("OOps! File write function failed! Reason: %s'" % str(err))
+    def get_random_dates(self, rng, num):
+        """ Return num random timestamps after the start date """
+        offsets = (rng.integers(0, 365, num) * 86400 +
+                   rng.integers(0, 60, num) * 3600 +
+                   rng.integers(0, 60, num) * 60 +
+                   rng.integers(0, 60, num))
+        return self.date_in + offsets
+
+    @staticmethod
+    def get_dates_text(dates):
+        """ Return the timestamps as a (num, 19) array of chars """
+        dates = np.datetime_as_string(dates, unit='s').astype('S19')
+        dates = dates.view(np.uint8).reshape(len(dates), 19)
+        dates[:, 10] = ord(' ')
+        return dates
+
+    def build_values(self, chunk_start, chunk_end):
+        """ Return the random columns of a chunk in the order of RAW_COLUMNS """
+        num = chunk_end - chunk_start
+        rng = self.get_rng(chunk_start)
+
+        type_deal = self.list_type_deal[rng.integers(0, len(self.list_type_deal), num)]
+        amount = rng.integers(-1000, 1001, num)
+
+        return (self.get_random_uuids(rng, num),
+                self.accounts[rng.integers(0, len(self.accounts), num)],
+                self.get_random_dates(rng, num),
+                type_deal,
+                amount)
+
+    @staticmethod
+    def build_binary_rows(values):
+        """ Return the rows of a chunk in the binary COPY format """
+        transaction_uid, account_uid, transaction_date, type_deal, amount = values
+        return b''.join(binary_stream([encode_columns([uuid_column(transaction_uid),
+                                                       uuid_column(account_uid),
+                                                       timestamp_column(transaction_date),
+                                                       text_column(type_deal),
+                                                       float8_column(amount)])]))
+
+    def build_rows(self, values):
+        """ Return the tab separated lines of a chunk """
+        transaction_uid, account_uid, transaction_date, type_deal, amount = values
+        num = len(transaction_uid)
+        amount = amount.astype('S5')
+
+        # every field in a fixed-width column padded by zero bytes,
+        # the padding is removed at once in the end
+        columns = [self.get_uuids_text(transaction_uid),
+                   self.get_uuids_text(account_uid),
+                   self.get_dates_text(transaction_date),
+                   type_deal.view(np.uint8).reshape(num, type_deal.itemsize),
+                   amount.view(np.uint8).reshape(num, amount.itemsize)]
+
+        width = sum(column.shape[1] + 1 for column in columns) + 1
+        lines = np.zeros((num, width), dtype=np.uint8)
+        position = 0
+        for column in columns:
+            lines[:, position:position + column.shape[1]] = column
+            position += column.shape[1]
+            lines[:, position] = ord('\t')
+            position += 1
+        # the csv writer line ends of the previous files
+        lines[:, position - 1] = ord('\r')
+        lines[:, position] = ord('\n')
+
+        return lines[lines != 0].tobytes()
+
+    def get_shard_name(self, chunk_start):
+        """ Return the file of a chunk """
+        return '%s.%012d.part' % (self.data_file, chunk_start)
 
     @m.timing
     def generate_test_data_by_chunk(self, chunk_start, chunk_end):
-        """ Generating and saving to the file """
-        num_rows_mp = chunk_end - chunk_start
-        new_rows = []
-
-        for _ in range(num_rows_mp):
-            transaction_uid = uuid.uuid4()
-            account_uid = choice(self.list_acc)
-            transaction_date = (self.get_random_date(self.date_in, 0)
-                                .__next__()
-                                .strftime('%Y-%m-%d %H:%M:%S'))
-            type_deal = choice(self.list_type_deal)
-            transaction_amount = randint(-1000, 1000)
-
-            new_rows.append([transaction_uid,
-                             account_uid,
-                             transaction_date,
-                             type_deal,
-                             transaction_amount])
-
-        self.write_in_file(new_rows, chunk_start, chunk_end)
+        """ Generating and saving to the shard file of the chunk
+            and/or straight into the table """
+        values = self.build_values(chunk_start, chunk_end)
+        rows = self.build_rows(values) if self.write_csv or not self.binary else None
+
+        if self.write_csv:
+            try:
+                with open(self.get_shard_name(chunk_start), 'wb') as file:
+                    file.write(rows)
+            except Exception as err:
+                m.error("OOps! File write function failed! Reason: %s'" % str(err))
+                raise
+
+        if self.load_table:
+            try:
+                if self.binary:
+                    source = io.BytesIO(self.build_binary_rows(values))
+                else:
+                    source = io.BytesIO(rows.replace(b'\r\n', b'\n'))
+                get_worker_database('staging').bulk_copy(source, self.load_table, RAW_COLUMNS,
+                                                         binary=self.binary)
+            except psycopg2.Error as err:
+                m.error('OOps! Bulk copy of rows {} - {} FAILED! Reason: {}'
+                        .format(chunk_start, chunk_end, err.pgerror))
+                raise
+
+        m.info('Test data created from {:7} to {:7} rows'.format(chunk_start, chunk_end))
+
+    def concat_shards(self, chunks):
+        """ Concatenate the shards into the data file in the order of chunks """
+        with open(self.data_file, 'wb') as target:
+            for chunk_start, _ in chunks:
+                shard_name = self.get_shard_name(chunk_start)
+                with open(shard_name, 'rb') as shard:
+                    shutil.copyfileobj(shard, target, 16 * 1024 * 1024)
+                os.remove(shard_name)
 
     @staticmethod
     def chunks(array, start, num):
@@ -126,7 +233,8 @@ class TestDataCreator:
         pool = mp.Pool(mp.cpu_count())
         jobs = []
 
-        for chunk_start, chunk_end in self.divide_into_chunks(0, self.num_rows):
+        chunks = self.divide_into_chunks(0, self.num_rows)
+        for chunk_start, chunk_end in chunks:
             jobs.append(pool.apply_async(self.generate_test_data_by_chunk,
                                          (chunk_start, chunk_end)))
         # wait for all jobs to finish
@@ -137,12 +245,19 @@ class TestDataCreator:
         pool.close()
         pool.join()
 
+        if self.write_csv:
+            self.concat_shards(chunks)
+
 
 class GenerateTestData:
     """ The main class for creating a dummy data """
 
-    def __init__(self):
+    def __init__(self, seed=None, direct=False, write_csv=True):
         self.conf_reader = ConfigReader('./conf/db.ini')
+        self.seed = seed
+        # direct: the generator workers COPY into the table in parallel
+        self.direct = direct
+        self.write_csv = write_csv or not direct
 
         self.data_file = self.conf_reader.get_attr('file_name_raw')
         self.schema_raw = self.conf_reader.get_attr('transaction_db_raw')
@@ -183,31 +298,32 @@ class GenerateTestData:
     @m.timing
     @m.wrapper(m.entering, m.exiting)
     def create_csv_file(self, num_rows, ):
-        """ Create csv file """
-        csv_creator = TestDataCreator(num_rows, self.conf_reader, self.data_file)
+        """ Create csv file, in the direct mode load the table as well """
+        csv_creator = TestDataCreator(num_rows, self.conf_reader, self.data_file, self.seed,
+                                      load_table=self.raw_full_table_name if self.direct else None,
+                                      write_csv=self.write_csv,
+                                      binary=self.conf_reader.get_attr('copy_format') == 'binary')
         csv_creator.run_csv_writing()
 
     @m.timing
     @m.wrapper(m.entering, m.exiting)
     def bulk_copy_to_db(self):
         """ Insert data into DB """
-        columns = (
-            'transaction_uid',
-            'account_uid',
-            'transaction_date',
-            'type_deal',
-            'transaction_amount'
-        )
-
         try:
-            with open(self.data_file, 'r') as csv_file:
+            with open(self.data_file, 'r') as csv_file, self.database.session('staging'):
                 rows = self.database.bulk_copy(csv_file,
                                                self.raw_full_table_name,
-                                               columns)
+                                               RAW_COLUMNS)
                 m.info('Have been added %s rows into %s' % (rows, self.raw_full_table_name))
         except psycopg2.Error as err:
             m.error('OOps! Bulk copy process FAILED! Reason: %s' % err.pgerror)
 
+    def get_repeatable(self, salt):
+        """ Return the repeatable clause of the sampling for a seeded run """
+        if self.seed is None:
+            return sql.SQL('')
+        return sql.SQL('repeatable ({0})').format(sql.Literal(self.seed + salt))
+
     @m.timing
     @m.wrapper(m.entering, m.exiting)
     def random_delete_rows(self):
@@ -217,9 +333,10 @@ class GenerateTestData:
                         where ctid = any(array(
                           select ctid
                           from {0}.{1}
-                          tablesample bernoulli (1)
+                          tablesample bernoulli (1) {2}
                           ))""").format(sql.Identifier(self.schema_raw),
-                                        sql.Identifier(self.raw_table_name))
+                                        sql.Identifier(self.raw_table_name),
+                                        self.get_repeatable(1))
         try:
             rows = self.database.execute(sql_command)
             m.info('Has been deleted [%s rows] from table %s' % (rows, self.raw_table_name))
@@ -236,8 +353,9 @@ class GenerateTestData:
                 where ctid = any(array(
                   select ctid
                   from {0}.{1}
-                  tablesample bernoulli (1) ))""").format(sql.Identifier(self.schema_raw),
-                                                          sql.Identifier(self.raw_table_name))
+                  tablesample bernoulli (1) {2} ))""").format(sql.Identifier(self.schema_raw),
+                                                              sql.Identifier(self.raw_table_name),
+                                                              self.get_repeatable(2))
         try:
             rows = self.database.execute(sql_command)
             m.info('Has been updated [%s rows] from table %s' % (rows, self.raw_table_name))
@@ -251,7 +369,8 @@ class GenerateTestData:
         self.create_db_schema()
         self.create_folder('data')
         self.create_csv_file(num_rows)
-        self.bulk_copy_to_db()
+        if not self.direct:
+            self.bulk_copy_to_db()
         self.random_delete_rows()
         self.random_update_rows()
         m.info('END!')
@@ -259,13 +378,18 @@ class GenerateTestData:
 
 def main():
     """ Data creating """
-    if len(sys.argv) > 1:
-        num_rows = int(sys.argv[1])
-    else:
-        num_rows = 100000
-
-    gtd = GenerateTestData()
-    gtd.run(num_rows)
+    parser = argparse.ArgumentParser(description='Test data generating')
+    parser.add_argument('num_rows', nargs='?', type=int, default=100000)
+    # An optional seed makes the data reproducible
+    parser.add_argument('seed', nargs='?', type=int, default=None)
+    parser.add_argument('--direct', action='store_true',
+                        help='COPY the chunks into the table from the workers in parallel')
+    parser.add_argument('--no-csv', dest='write_csv', action='store_false',
+                        help='with --direct: do not write the CSV file')
+    args = parser.parse_args()
+
+    gtd = GenerateTestData(args.seed, args.direct, args.write_csv)
+    gtd.run(args.num_rows)
 
 if __name__ == '__main__':
     main()
@@ -3,9 +3,14 @@
 """ The main reconciliation process module"""
 
 import time
+import argparse
 
 from adapters.postgresql_adapter import PostgreSQLAdapter
 from adapters.csv_adapter import CsvAdapter
+from adapters.parquet_adapter import ParquetAdapter
+from engines.hash_join import HashJoinEngine
+from engines.sort_merge import SortMergeEngine
+from engines.report import MATCHED
 from utils.monitoring import Monitoring
 from utils.config_reader import ConfigReader
 
@@ -15,60 +20,240 @@ m = Monitoring('reconciliation_main')
 
 class Reconciliator:
     """ Reconciliation executor """
-    def __init__(self):
+    def __init__(self, full_run=False):
         # Unique table name for the parallel processing
         self.conf_reader = ConfigReader('./conf/db.ini')
+        self.engine = self.conf_reader.get_attr('engine')
+        # Both sides must always hash with the same scheme
+        self.digest_scheme = self.conf_reader.get_attr('digest_scheme')
+        # Only the rows appended after the last run are reconciled
+        self.incremental = self.conf_reader.get_attr('incremental')
+        # The watermarks are ignored, every row is reconciled again
+        self.full_run = full_run
+        self.report = None
+        # csv: the CSV files, parquet: the Parquet archives within a date window
+        self.source = self.conf_reader.get_attr('source')
+        if self.source == 'parquet' and self.incremental:
+            m.info('The parquet archives are read in full, the incremental mode is off')
+            self.incremental = False
+        date_window = {}
+        if self.source == 'parquet':
+            date_window = {'date_from': self.conf_reader.get_attr('date_from'),
+                           'date_to': self.conf_reader.get_attr('date_to')}
+        # The profiling can be turned on by the config or by RECONCILIATION_PROFILE
+        if self.conf_reader.get_attr('profile_dir'):
+            m.profiler.enable(self.conf_reader.get_attr('profile_dir'))
 
         self.storage_table = 'storage_' + str(int(time.time()))
         self.psa = PostgreSQLAdapter(storage_table=self.storage_table,
                                      schema_raw=self.conf_reader.get_attr('transaction_db_raw'),
                                      schema_target=self.conf_reader.get_attr('reconciliation_db'),
-                                     schema_db_clean=self.conf_reader.get_attr('transaction_db_clean'))
+                                     schema_db_clean=self.conf_reader.get_attr('transaction_db_clean'),
+                                     digest_scheme=self.digest_scheme,
+                                     extract_mode=self.conf_reader.get_attr('extract_mode'),
+                                     parallel_workers=self.conf_reader.get_attr('parallel_workers'),
+                                     range_retries=self.conf_reader.get_attr('range_retries'),
+                                     rows_per_task=self.conf_reader.get_attr('rows_per_task'),
+                                     storage_layout=self.conf_reader.get_attr('storage_layout'),
+                                     storage_partitions=self.conf_reader.get_attr('storage_partitions'),
+                                     publish_batch_rows=self.conf_reader.get_attr('publish_batch_rows'),
+                                     copy_format=self.conf_reader.get_attr('copy_format'),
+                                     **date_window)
+
+        if self.source == 'parquet':
+            self.csv = ParquetAdapter(storage_table=self.storage_table,
+                                      schema_target=self.conf_reader.get_attr('reconciliation_db'),
+                                      file_name_raw=self.conf_reader.get_attr('parquet_file_name'),
+                                      file_name_hash=self.conf_reader.get_attr('file_name_hash'),
+                                      streaming=self.conf_reader.get_attr('streaming'),
+                                      copy_format=self.conf_reader.get_attr('copy_format'),
+                                      digest_scheme=self.digest_scheme,
+                                      **date_window)
+            return
 
         self.csv = CsvAdapter(storage_table=self.storage_table,
                               schema_target=self.conf_reader.get_attr('reconciliation_db'),
                               file_name_raw=self.conf_reader.get_attr('file_name_raw'),
-                              file_name_hash=self.conf_reader.get_attr('file_name_hash'))
+                              file_name_hash=self.conf_reader.get_attr('file_name_hash'),
+                              streaming=self.conf_reader.get_attr('streaming'),
+                              cache_dir=self.conf_reader.get_attr('cache_dir'),
+                              cache_max_mb=self.conf_reader.get_attr('cache_max_mb'),
+                              ingest_mode=self.conf_reader.get_attr('ingest_mode'),
+                              copy_format=self.conf_reader.get_attr('copy_format'),
+                              digest_scheme=self.digest_scheme)
 
     def storage_preparing(self):
         """ Database preparing """
-        self.psa.storage_create()
+        with m.metrics.span('storage_create'):
+            self.psa.storage_create()
 
     def postgresql_adapter_run(self):
         """ Postgre side preparing """
-        self.psa.adapter_run_main()
+        with m.metrics.span('pg_hashing'):
+            self.psa.adapter_run_main()
 
     @m.timing
     def csv_adapter_run(self):
         """ CSV side preparing """
-        self.csv.run_reading()
-        self.csv.bulk_copy_to_db()
+        if self.csv.streaming:
+            with m.metrics.span('csv_hashing'):
+                self.csv.run_streaming()
+        else:
+            with m.metrics.span('csv_hashing'):
+                self.csv.run_reading()
+            with m.metrics.span('storage_load'):
+                self.csv.bulk_copy_to_db()
+
+    def storage_finalize(self):
+        """ Keys and statistics of the loaded storage """
+        with m.metrics.span('storage_finalize'):
+            self.psa.storage_finalize()
 
     @m.timing
     def get_report(self):
         """ Return the detailed report """
-        self.psa.get_discrepancy_report()
+        with m.metrics.span('report'):
+            self.report = self.psa.get_discrepancy_report()
 
     def reconcillation_run(self):
         """ Comparison the data from two sources """
-        self.psa.save_clean_data()
-        self.psa.drop_storage()
+        with m.metrics.span('clean_save'):
+            self.psa.save_clean_data()
+            self.psa.drop_storage()
+
+    @m.timing
+    def hash_join_run(self):
+        """ Comparison the sources in memory without the storage table """
+        engine = HashJoinEngine()
+
+        with m.metrics.span('pg_hashing'):
+            self.psa.export_hashes(engine.add_build, packed=True)
+            engine.build_finish()
+
+        with m.metrics.span('csv_hashing'):
+            for packed in self.csv.hash_iterator(packed=True):
+                engine.probe(packed)
+
+        with m.metrics.span('report'):
+            self.report = engine.finish()
+            self.report.print_report()
+
+        with m.metrics.span('clean_save'):
+            self.psa.save_clean_uids(engine.matched_uids())
+
+    @m.timing
+    def sort_merge_run(self):
+        """ Comparison the sources by sorted run files on disk """
+        engine = SortMergeEngine(self.conf_reader.get_attr('sort_dir'),
+                                 self.conf_reader.get_attr('sort_run_mb'))
+        try:
+            with m.metrics.span('pg_hashing'):
+                self.psa.export_hashes(engine.add_db, packed=True)
+
+            with m.metrics.span('csv_hashing'):
+                for packed in self.csv.hash_iterator(packed=True):
+                    engine.add_csv(packed)
+
+            with m.metrics.span('report'):
+                self.report = engine.finish()
+                self.report.print_report()
+
+            with m.metrics.span('clean_save'):
+                self.psa.save_clean_uids(engine.matched_uids())
+        finally:
+            engine.close()
+
+    def watermarks_load(self):
+        """ Continue both sources from the last reconciled positions """
+        state = self.psa.load_run_state()
+
+        # every CSV file has its own watermark
+        for csv_file in self.csv.files.values():
+            csv_state = state.get(csv_file.file_name)
+            if csv_state:
+                csv_file.set_watermark(*csv_state)
+
+        db_state = state.get(self.psa.get_source_name())
+        if db_state:
+            self.psa.min_id_num_row = db_state[0]
+            m.info('PostgreSQL reading continues after id_num_row %s' % db_state[0])
+
+    def watermarks_save(self):
+        """ Remember the read positions if the run had no errors: the
+            watermarks move past the rows with discrepancies as well,
+            they are examined again only by a full run """
+        if Monitoring.errors_count:
+            m.error('The run had %s errors, watermarks are not moved'
+                    % Monitoring.errors_count)
+            return
+
+        # the parquet archives have no watermarks, and the database rows
+        # outside of a date window were not reconciled
+        if self.source == 'parquet' or self.psa.date_from or self.psa.date_to:
+            m.info('The run read the parquet archives or a date window, '
+                   'watermarks are not moved')
+            return
+
+        if self.report:
+            unreconciled = sum(count for name, count in self.report.counts.items()
+                               if name != MATCHED)
+            if unreconciled:
+                m.info('%s transactions are not reconciled and stay behind the watermarks, '
+                       'run with --full to examine them again' % unreconciled)
+
+        for csv_file in self.csv.files.values():
+            self.psa.save_run_state(csv_file.file_name,
+                                    csv_file.file_end,
+                                    csv_file.get_fingerprint(csv_file.file_end))
+        self.psa.save_run_state(self.psa.get_source_name(),
+                                self.psa.max_id_num_row)
 
     def start_all(self):
         """ Run all steps """
-        self.storage_preparing()
-        self.csv_adapter_run()
-        self.postgresql_adapter_run()
-        self.get_report()
-        self.reconcillation_run()
+        self.psa.register_run(self.engine)
+
+        if self.full_run:
+            m.info('Full run: the watermarks are ignored')
+        elif self.incremental:
+            self.watermarks_load()
+
+        with m.metrics.span('reconciliation'):
+            if self.engine == 'hash_join':
+                self.hash_join_run()
+            elif self.engine == 'sort_merge':
+                self.sort_merge_run()
+            else:
+                self.storage_preparing()
+                self.csv_adapter_run()
+                self.postgresql_adapter_run()
+                self.storage_finalize()
+                self.get_report()
+                self.reconcillation_run()
+
+        self.watermarks_save()
+
+    def metrics_export(self):
+        """ Save the metrics of the run """
+        m.metrics.export(self.conf_reader.get_attr('metrics_json'),
+                         self.conf_reader.get_attr('metrics_prom'))
+
+        run_prof = m.profiler.report()
+        if run_prof:
+            m.info('Profile of the run has been saved into %s' % run_prof)
 
 
 @m.timing
 def main():
     """ Main starter """
-    recon = Reconciliator()
+    parser = argparse.ArgumentParser(description='Transactions reconciliation')
+    parser.add_argument('--full', dest='full_run', action='store_true',
+                        help='ignore the watermarks of the incremental mode')
+    args = parser.parse_args()
+
+    recon = Reconciliator(args.full_run)
     m.info('START!')
     recon.start_all()
+    recon.metrics_export()
     m.info('END!')
 
 if __name__ == '__main__':
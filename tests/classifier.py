@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+""" Brute-force classifier and random sides for the engine tests """
+
+from engines.records import UID_SIZE
+from engines.report import MATCHED, HASH_MISMATCH, MISSING_IN_CSV, MISSING_IN_DB
+
+
+def brute_force(db_rows, csv_rows):
+    """ Classify every transaction_uid by the sets of its digests """
+    counts = dict.fromkeys((MATCHED, HASH_MISMATCH, MISSING_IN_CSV, MISSING_IN_DB), 0)
+    matched = set()
+
+    for uid in set(uid for uid, _ in db_rows) | set(uid for uid, _ in csv_rows):
+        db_digests = set(digest for row_uid, digest in db_rows if row_uid == uid)
+        csv_digests = set(digest for row_uid, digest in csv_rows if row_uid == uid)
+        if not db_digests:
+            counts[MISSING_IN_DB] += 1
+        elif not csv_digests:
+            counts[MISSING_IN_CSV] += 1
+        elif db_digests & csv_digests:
+            counts[MATCHED] += 1
+            matched.add(uid)
+        else:
+            counts[HASH_MISMATCH] += 1
+    return counts, matched
+
+
+def pack(rows):
+    """ Return the packed (uid, digest) records """
+    return b''.join(uid + digest for uid, digest in rows)
+
+
+def unpack_uids(parts):
+    """ Return the set of the packed uids """
+    packed = b''.join(parts)
+    return set(packed[pos:pos + UID_SIZE] for pos in range(0, len(packed), UID_SIZE))
+
+
+def random_sides(rng):
+    """ Both sides over a few uids and digests, so they have duplicates;
+        the zero digest checks the trailing zero bytes of the S16 arrays """
+    uids = [bytes(rng.randrange(256) for _ in range(UID_SIZE))
+            for _ in range(rng.randrange(1, 30))]
+    digests = [bytes([value]) * 16 for value in range(4)]
+    return ([(rng.choice(uids), rng.choice(digests)) for _ in range(rng.randrange(0, 40))],
+            [(rng.choice(uids), rng.choice(digests)) for _ in range(rng.randrange(0, 40))])
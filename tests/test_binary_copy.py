@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+""" The encoders of the binary COPY format """
+
+import struct
+import unittest
+
+import numpy as np
+
+from adapters.binary_copy import (PGCOPY_HEADER, PGCOPY_TRAILER, binary_stream,
+                                  encode_columns, encode_hash_records, encode_uids,
+                                  float8_column, text_column, timestamp_column,
+                                  uuid_column)
+
+
+def field(data):
+    """ One field: its int32 length and its bytes """
+    return struct.pack('>i', len(data)) + data
+
+
+class BinaryCopyTest(unittest.TestCase):
+    """ Every tuple is the int16 field count and the fields """
+    def test_header(self):
+        """ The signature, the flags and the header extension length """
+        self.assertEqual(PGCOPY_HEADER, b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0))
+        self.assertEqual(PGCOPY_TRAILER, struct.pack('>h', -1))
+
+    def test_text_column(self):
+        """ The varchar fields are cut to their own lengths """
+        data = encode_columns([text_column(np.array([b'a', b'abc', b'']))])
+        self.assertEqual(data, b''.join(struct.pack('>h', 1) + field(value)
+                                        for value in (b'a', b'abc', b'')))
+
+    def test_text_column_unicode(self):
+        """ The str values are encoded as utf-8 """
+        data = encode_columns([text_column(np.array(['déal']))])
+        self.assertEqual(data, struct.pack('>h', 1) + field('déal'.encode('utf-8')))
+
+    def test_timestamp_column(self):
+        """ Microseconds since 2000-01-01 """
+        values = np.array(['2000-01-01T00:00:01', '1999-12-31T23:59:59.5'],
+                          dtype='datetime64[us]')
+        data = encode_columns([timestamp_column(values)])
+        self.assertEqual(data, b''.join(struct.pack('>h', 1) + field(struct.pack('>q', micros))
+                                        for micros in (1000000, -500000)))
+
+    def test_float8_column(self):
+        """ IEEE 754 doubles in the network order """
+        data = encode_columns([float8_column([0.1, -250.0])])
+        self.assertEqual(data, b''.join(struct.pack('>h', 1) + field(struct.pack('>d', value))
+                                        for value in (0.1, -250.0)))
+
+    def test_mixed_columns(self):
+        """ A fixed width column after a variable width one """
+        uids = np.arange(32, dtype=np.uint8).reshape(2, 16)
+        data = encode_columns([text_column(np.array([b'deal', b'commision'])),
+                               uuid_column(uids)])
+        self.assertEqual(data, struct.pack('>h', 2) + field(b'deal') + field(bytes(range(16))) +
+                         struct.pack('>h', 2) + field(b'commision') + field(bytes(range(16, 32))))
+
+    def test_hash_records(self):
+        """ (adapter_name, transaction_uid, hash) of the packed records """
+        uid = bytes(range(16))
+        digest = bytes(range(100, 116))
+        data = encode_hash_records(uid + digest, 'csv_adapter')
+        self.assertEqual(data, struct.pack('>h', 3) + field(b'csv_adapter') +
+                         field(uid) + field(digest))
+        self.assertEqual(encode_hash_records(b'', 'csv_adapter'), b'')
+
+    def test_uids(self):
+        """ One uuid column """
+        uids = bytes(range(32))
+        self.assertEqual(encode_uids(uids), struct.pack('>h', 1) + field(uids[:16]) +
+                         struct.pack('>h', 1) + field(uids[16:]))
+        self.assertEqual(encode_uids(b''), b'')
+
+    def test_stream(self):
+        """ The header, the non empty parts and the trailer """
+        self.assertEqual(list(binary_stream([b'a', b'', b'b'])),
+                         [PGCOPY_HEADER, b'a', b'b', PGCOPY_TRAILER])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+""" The cache of the hashed chunks """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.chunk_cache import ChunkCache
+
+
+class ChunkCacheTest(unittest.TestCase):
+    """ The keys, the entries and the eviction """
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ChunkCache(self.cache_dir, max_size_mb=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def get_key(self, chunk, scheme_id='md5_nested_v1/lines'):
+        """ The key of a chunk of the same file and offsets """
+        return self.cache.get_key('transactions.csv', 0, len(chunk),
+                                  self.cache.checksum(chunk), scheme_id)
+
+    def test_round_trip(self):
+        """ An entry is read back as it was written """
+        key = self.get_key(b'uid\tfields\n')
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, b'\x01' * 64)
+        self.assertEqual(self.cache.get(key), b'\x01' * 64)
+
+    def test_checksum_mismatch(self):
+        """ A chunk changed in place, same file and offsets, is a miss """
+        key = self.get_key(b'uid\tfields\n')
+        self.cache.put(key, b'\x01' * 32)
+
+        changed_key = self.get_key(b'uid\tFields\n')
+        self.assertNotEqual(changed_key, key)
+        self.assertIsNone(self.cache.get(changed_key))
+
+    def test_scheme_mismatch(self):
+        """ The records of another digest scheme are not reused """
+        self.assertNotEqual(self.get_key(b'uid\tfields\n'),
+                            self.get_key(b'uid\tfields\n', 'md5_row_v1/lines'))
+
+    def test_parts(self):
+        """ A list of byte strings, empty ones included """
+        parts = [b'\x02' * 32, b'', bytearray(b'\x03' * 96)]
+        self.cache.put_parts('parts', parts)
+        self.assertEqual(self.cache.get_parts('parts'), [bytes(part) for part in parts])
+        self.assertIsNone(self.cache.get_parts('missing'))
+
+    def test_eviction(self):
+        """ The least recently used entries go first, a read entry stays """
+        entry = b'\x04' * (400 * 1024)
+        for age, key in enumerate(('newest', 'middle', 'oldest')):
+            self.cache.put(key, entry)
+            mtime = 1000000000 - age * 100
+            os.utime(self.cache.get_path(key), (mtime, mtime))
+
+        # the read makes the oldest entry the most recent one
+        self.assertEqual(self.cache.get('oldest'), entry)
+        self.cache.evict()
+
+        self.assertIsNone(self.cache.get('middle'))
+        self.assertEqual(self.cache.get('newest'), entry)
+        self.assertEqual(self.cache.get('oldest'), entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+""" The columnar ingestion gives the hashes of the raw lines """
+
+import datetime
+import unittest
+
+from utils.columnar import hash_csv_buffer, pa
+from utils.digest import SCHEMES, pg_float8_text, pg_timestamp_text
+from tests.test_digest import BUFFER, LINES
+
+if pa is not None:
+    from utils.columnar import float8_text, timestamp_text
+
+
+class Float8TextTest(unittest.TestCase):
+    """ The float8 text of PostgreSQL """
+    VALUES = ((0.1, '0.1'), (-250.0, '-250'), (1e15, '1e+15'),
+              (123456789012345.0, '123456789012345'), (1e-05, '1e-05'),
+              (0.0001, '0.0001'), (0.0, '0'), (-0.0, '-0'),
+              (float('inf'), 'Infinity'), (float('nan'), 'NaN'))
+
+    def test_float8_text(self):
+        """ One value at a time """
+        for value, text in self.VALUES:
+            self.assertEqual(pg_float8_text(value), text)
+
+    @unittest.skipIf(pa is None, 'pyarrow is not installed')
+    def test_float8_column(self):
+        """ A column, the integers formatted by arrow, NULL kept """
+        column = pa.array([value for value, _ in self.VALUES] + [None], pa.float64())
+        self.assertEqual(float8_text(column).to_pylist(),
+                         [text for _, text in self.VALUES] + [None])
+
+
+@unittest.skipIf(pa is None, 'pyarrow is not installed')
+class ColumnarTest(unittest.TestCase):
+    """ The columns are canonicalized like the text of PostgreSQL """
+    def test_timestamp_column(self):
+        """ to_char(..., 'YYYY-MM-DD HH24:MI:SS'), fractions cut """
+        values = [datetime.datetime(2015, 3, 1, 10, 20, 30, 999999),
+                  datetime.datetime(1969, 12, 31, 23, 59, 59),
+                  datetime.datetime(9999, 12, 31, 23, 59, 59)]
+        self.assertEqual(timestamp_text(pa.array(values + [None], pa.timestamp('us')))
+                         .to_pylist(),
+                         [pg_timestamp_text(value) for value in values] + [None])
+
+    def test_lines(self):
+        """ The text lines and the packed records of every scheme """
+        for scheme_id, scheme in SCHEMES.items():
+            self.assertEqual(hash_csv_buffer(BUFFER, 0, len(BUFFER), scheme, 'csv_adapter'),
+                             scheme.hash_buffer(BUFFER, 0, len(BUFFER), 'csv_adapter'),
+                             scheme_id)
+            self.assertEqual(hash_csv_buffer(BUFFER, 0, len(BUFFER), scheme),
+                             scheme.hash_buffer(BUFFER, 0, len(BUFFER)), scheme_id)
+
+    def test_canonical(self):
+        """ Upper-case uuids and 250.0 are hashed as the text of PostgreSQL,
+            \\\\N stays NULL """
+        lines = LINES + ['00000000-0000-4000-8000-000000000001\t\\N\t\\N\t\\N\t\\N']
+        raw = ''.join(line.upper().replace('DEAL', 'deal').replace('COMMISION', 'commision')
+                      .replace('-250', '-250.0') + '\n'
+                      for line in lines).encode('utf-8')
+        canonical = ''.join(line + '\n' for line in lines).encode('utf-8')
+        for scheme_id, scheme in SCHEMES.items():
+            self.assertEqual(hash_csv_buffer(raw, 0, len(raw), scheme),
+                             scheme.hash_buffer(canonical, 0, len(canonical)), scheme_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
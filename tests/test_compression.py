@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+""" The frame parsing of the compressed inputs """
+
+import os
+import gzip
+import zlib
+import shutil
+import struct
+import tempfile
+import unittest
+
+from utils.compression import (GZIP, ZSTD, bgzf_frames, decompress, detect_compression,
+                               get_frames, zstandard, zstd_frames)
+
+DATA = b''.join(b'%032x\tline %d\n' % (index, index) for index in range(5000))
+
+
+def bgzf_block(data):
+    """ One bgzip block: a gzip member with its size in the BC field """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    body = compressor.compress(data) + compressor.flush()
+    extra = b'BC' + struct.pack('<HH', 2, len(body) + 25)
+    header = (b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' +
+              struct.pack('<H', len(extra)) + extra)
+    return header + body + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def split(data, size):
+    """ The pieces of `size` bytes """
+    return [data[pos:pos + size] for pos in range(0, len(data), size)]
+
+
+class GzipFramesTest(unittest.TestCase):
+    """ The bgzip blocks are found by their headers """
+    def test_bgzf(self):
+        """ Every block is a frame, the empty end block too """
+        blocks = [bgzf_block(piece) for piece in split(DATA, 20000)] + [bgzf_block(b'')]
+        buffer = b''.join(blocks)
+
+        offsets = bgzf_frames(buffer, 0, len(buffer))
+        self.assertEqual(offsets, [sum(len(block) for block in blocks[:index])
+                                   for index in range(len(blocks))])
+        self.assertEqual(get_frames(buffer, 0, len(buffer), GZIP), offsets)
+
+        bounds = offsets + [len(buffer)]
+        self.assertEqual(b''.join(decompress(GZIP, buffer[start:end])
+                                  for start, end in zip(bounds, bounds[1:])), DATA)
+
+    def test_plain_gzip(self):
+        """ A gzip file without the BC field is one stream """
+        buffer = gzip.compress(DATA)
+        self.assertIsNone(bgzf_frames(buffer, 0, len(buffer)))
+        self.assertIsNone(get_frames(buffer, 0, len(buffer), GZIP))
+
+    def test_truncated(self):
+        """ A cut block is not walked """
+        buffer = b''.join(bgzf_block(piece) for piece in split(DATA, 20000))
+        self.assertIsNone(bgzf_frames(buffer, 0, len(buffer) - 10))
+
+
+@unittest.skipIf(zstandard is None, 'zstandard is not installed')
+class ZstdFramesTest(unittest.TestCase):
+    """ The zstd frames are walked by the frame and block headers """
+    def frames(self, **kwargs):
+        """ Independent frames of the data """
+        compressor = zstandard.ZstdCompressor(**kwargs)
+        return [compressor.compress(piece) for piece in split(DATA, 30000)]
+
+    def test_frames(self):
+        """ Every frame is found, the skippable frames are passed """
+        for kwargs in ({}, {'write_checksum': True}, {'write_content_size': False}):
+            frames = self.frames(**kwargs)
+            skippable = struct.pack('<II', 0x184D2A5E, 4) + b'abcd'
+            buffer = b''.join(frames) + skippable
+
+            offsets = zstd_frames(buffer, 0, len(buffer))
+            self.assertEqual(offsets, [sum(len(frame) for frame in frames[:index])
+                                       for index in range(len(frames))], kwargs)
+
+            bounds = offsets + [len(buffer)]
+            self.assertEqual(b''.join(decompress(ZSTD, buffer[start:end])
+                                      for start, end in zip(bounds, bounds[1:])), DATA)
+
+    def test_single_frame(self):
+        """ One frame is read as one stream """
+        buffer = zstandard.ZstdCompressor().compress(DATA)
+        self.assertEqual(zstd_frames(buffer, 0, len(buffer)), [0])
+        self.assertIsNone(get_frames(buffer, 0, len(buffer), ZSTD))
+
+    def test_truncated(self):
+        """ A cut frame or some other data is not walked """
+        buffer = b''.join(self.frames())
+        self.assertIsNone(zstd_frames(buffer, 0, len(buffer) - 10))
+        self.assertIsNone(zstd_frames(b'not a zstd file', 0, 15))
+
+
+class DetectTest(unittest.TestCase):
+    """ The compression is found by the magic bytes """
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def detect(self, data):
+        """ Write the data and detect its compression """
+        file_name = os.path.join(self.folder, 'input')
+        with open(file_name, 'wb') as file:
+            file.write(data)
+        return detect_compression(file_name)
+
+    def test_detect(self):
+        """ gzip, zstd and the plain text """
+        self.assertEqual(self.detect(gzip.compress(DATA)), GZIP)
+        self.assertIsNone(self.detect(DATA))
+        self.assertIsNone(self.detect(b''))
+        if zstandard is not None:
+            self.assertEqual(self.detect(zstandard.ZstdCompressor().compress(DATA)), ZSTD)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+""" The registered digest schemes """
+
+import hashlib
+import unittest
+
+from engines.records import pack_hash_lines, unpack_hash_lines
+from utils.digest import SCHEMES, get_scheme
+
+LINES = [
+    '6f1e0c5a-1b2c-4d3e-8f90-123456789abc\t0b7c9e4a-55d1-4a6f-9c21-0f3e5d7a9b10'
+    '\t2015-03-01 10:20:30\tdeal\t-250',
+    'a0b1c2d3-e4f5-4a6b-8c7d-9e0f1a2b3c4d\t0b7c9e4a-55d1-4a6f-9c21-0f3e5d7a9b10'
+    '\t2015-12-31 23:59:59\tcommision\t0.1',
+    '00000000-0000-4000-8000-000000000000\t1c2d3e4f-5a6b-4c7d-8e9f-a0b1c2d3e4f5'
+    '\t2015-01-01 00:00:00\tdeal\t1e+15',
+]
+BUFFER = ('\n'.join(LINES) + '\n').encode('utf-8')
+
+
+def original_md5(line):
+    """ The hash of the first version: md5 of the md5 of the four fields """
+    def md5(text):
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+    fields = line.split('\t')
+    return md5(md5(fields[1]) + md5(fields[2]) + md5(fields[3]) + md5(fields[4]))
+
+
+class DigestTest(unittest.TestCase):
+    """ The hashes of every scheme """
+    def test_unknown_scheme(self):
+        """ A typo is not a new scheme """
+        with self.assertRaises(ValueError):
+            get_scheme('md5_nested_v2')
+
+    def test_md5_nested(self):
+        """ md5_nested_v1 is the hash of the first version """
+        text = get_scheme('md5_nested_v1').hash_buffer(BUFFER, 0, len(BUFFER), 'csv_adapter')
+        self.assertEqual(text, ''.join('csv_adapter\t%s\t%s\n' % (line.split('\t')[0],
+                                                                   original_md5(line))
+                                       for line in LINES))
+
+    def test_md5_nested_null(self):
+        """ A NULL field is a space in the outer md5, as coalesce(..., ' ') """
+        row_digest = get_scheme('md5_nested_v1').row_digest
+        self.assertEqual(row_digest(b'\\N\tb\tc\td'),
+                         hashlib.md5(b' ' + b''.join(hashlib.md5(field).hexdigest().encode()
+                                                     for field in (b'b', b'c', b'd')))
+                         .hexdigest())
+
+    def test_row_schemes(self):
+        """ The *_row_v1 schemes hash the canonical row once """
+        payloads = [line.split('\t', 1)[1].encode('utf-8') for line in LINES]
+        for scheme_id, func in (('md5_row_v1', hashlib.md5),
+                                ('blake2b_row_v1',
+                                 lambda data: hashlib.blake2b(data, digest_size=16))):
+            row_digest = get_scheme(scheme_id).row_digest
+            self.assertEqual([row_digest(payload) for payload in payloads],
+                             [func(payload).hexdigest() for payload in payloads])
+
+    def test_buffer_paths(self):
+        """ The text lines and the packed records agree """
+        for scheme_id, scheme in SCHEMES.items():
+            text = scheme.hash_buffer(BUFFER, 0, len(BUFFER), 'csv_adapter')
+            self.assertEqual(text.count('\n'), len(LINES), scheme_id)
+            packed = scheme.hash_buffer(BUFFER, 0, len(BUFFER))
+            self.assertEqual(packed, pack_hash_lines(text), scheme_id)
+            self.assertEqual(unpack_hash_lines(packed, 'csv_adapter'),
+                             text.replace('-', ''), scheme_id)
+
+    def test_buffer_window(self):
+        """ \\r\\n line ends, an empty line and a window of a bigger buffer """
+        for scheme_id, scheme in SCHEMES.items():
+            text = scheme.hash_buffer(BUFFER, 0, len(BUFFER), 'csv_adapter')
+            crlf = b'xx' + BUFFER.replace(b'\n', b'\r\n') + b'\r\nyy'
+            self.assertEqual(scheme.hash_buffer(bytearray(crlf), 2, len(crlf) - 2,
+                                                'csv_adapter'), text, scheme_id)
+
+    def test_no_fields(self):
+        """ A line without a tab is not hashed as an empty row """
+        with self.assertRaises(ValueError):
+            get_scheme('md5_nested_v1').hash_buffer(b'uid only\n', 0, 9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+""" The hash join engine against a brute-force classifier """
+
+import random
+import unittest
+
+from engines.hash_join import HashJoinEngine
+from engines.records import UID_SIZE
+from engines.report import MATCHED, HASH_MISMATCH, MISSING_IN_CSV, MISSING_IN_DB
+from tests.classifier import brute_force, pack, random_sides, unpack_uids
+
+
+def run_hash_join(db_rows, csv_rows, batch=7):
+    """ Return the report counts and the matched uids of the hash join """
+    engine = HashJoinEngine()
+    engine.add_build(pack(db_rows))
+    engine.build_finish()
+    for pos in range(0, len(csv_rows), batch):
+        engine.probe(pack(csv_rows[pos:pos + batch]))
+    return engine.finish().counts, unpack_uids(engine.matched_uids())
+
+
+class HashJoinTest(unittest.TestCase):
+    """ Every transaction_uid is counted once, as the database does """
+    def setUp(self):
+        self.uid = b'\x11' * UID_SIZE
+        self.other_uid = b'\x44' * UID_SIZE
+        self.right = b'\x22' * 16
+        self.wrong = b'\x33' * 16
+
+    def test_duplicated_wrong_digest(self):
+        """ Two CSV rows with the same wrong digest are one mismatch """
+        db_rows = [(self.uid, self.right)]
+        csv_rows = [(self.uid, self.wrong), (self.uid, self.wrong)]
+
+        self.assertEqual(run_hash_join(db_rows, csv_rows),
+                         ({MATCHED: 0, HASH_MISMATCH: 1, MISSING_IN_CSV: 0, MISSING_IN_DB: 0},
+                          set()))
+
+    def test_duplicated_missing(self):
+        """ A uid missing in the database is counted once over the probes """
+        csv_rows = [(self.other_uid, self.right)] * 10
+
+        self.assertEqual(run_hash_join([(self.uid, self.right)], csv_rows, batch=3),
+                         ({MATCHED: 0, HASH_MISMATCH: 0, MISSING_IN_CSV: 1, MISSING_IN_DB: 1},
+                          set()))
+
+    def test_second_digest_of_build_side(self):
+        """ The digest is looked up among all the rows of a uid """
+        db_rows = [(self.uid, self.right), (self.uid, self.wrong)]
+        csv_rows = [(self.uid, self.wrong)] * 2
+
+        self.assertEqual(run_hash_join(db_rows, csv_rows),
+                         ({MATCHED: 1, HASH_MISMATCH: 0, MISSING_IN_CSV: 0, MISSING_IN_DB: 0},
+                          {self.uid}))
+
+    def test_empty_sides(self):
+        """ One of the sides has no rows at all """
+        rows = [(self.uid, self.right), (self.uid, self.right)]
+        for db_rows, csv_rows in ((rows, []), ([], rows), ([], [])):
+            self.assertEqual(run_hash_join(db_rows, csv_rows), brute_force(db_rows, csv_rows))
+
+    def test_random_duplicates(self):
+        """ Random sides with duplicated uids and digests """
+        for seed in range(200):
+            db_rows, csv_rows = random_sides(random.Random(seed))
+            self.assertEqual(run_hash_join(db_rows, csv_rows), brute_force(db_rows, csv_rows),
+                             'seed %s' % seed)
+
+
+if __name__ == '__main__':
+    unittest.main()
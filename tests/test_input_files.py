@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+""" The CSV inputs: a file, a directory or a glob of plain and compressed files """
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from adapters.csv_adapter import CsvAdapter, get_input_files
+from utils.compression import zstandard
+from utils.digest import get_scheme
+from tests.test_digest import LINES
+
+
+def encode(lines):
+    """ The lines of a CSV file """
+    return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+
+class InputFilesTest(unittest.TestCase):
+    """ Every file is hashed once, in the order of the names """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.write('a.csv', encode(LINES[:1]))
+        self.write('b.csv.gz', gzip.compress(encode(LINES[1:2])))
+        self.write('notes.txt', b'not a CSV file\n')
+        self.write('transaction_hashed.csv', b'')
+        os.mkdir(os.path.join(self.temp_dir, 'archive.csv'))
+
+        self.names = ['a.csv', 'b.csv.gz', 'transaction_hashed.csv']
+        if zstandard is not None:
+            self.write('c.csv.zst', zstandard.ZstdCompressor().compress(encode(LINES[2:])))
+            self.names.insert(2, 'c.csv.zst')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, data):
+        """ Create a file of the folder """
+        with open(os.path.join(self.temp_dir, name), 'wb') as file:
+            file.write(data)
+
+    def paths(self, names):
+        """ The full names of the files """
+        return [os.path.join(self.temp_dir, name) for name in names]
+
+    def test_directory(self):
+        """ The *.csv, *.csv.gz and *.csv.zst files, sorted, no folders """
+        self.assertEqual(get_input_files(self.temp_dir), self.paths(self.names))
+
+    def test_glob(self):
+        """ A glob takes the files it matches """
+        self.assertEqual(get_input_files(os.path.join(self.temp_dir, '[ab]*')),
+                         self.paths(['a.csv', 'b.csv.gz']))
+        self.assertEqual(get_input_files(os.path.join(self.temp_dir, 'a.csv')),
+                         self.paths(['a.csv']))
+
+    def test_exclude(self):
+        """ The hash file of the run is not an input """
+        self.assertEqual(get_input_files(self.temp_dir,
+                                         exclude=self.paths(['transaction_hashed.csv'])),
+                         self.paths(self.names[:-1]))
+
+    def test_not_found(self):
+        """ Nothing to read is an error, not an empty run """
+        with self.assertRaises(FileNotFoundError):
+            get_input_files(os.path.join(self.temp_dir, '*.parquet'))
+        with self.assertRaises(FileNotFoundError):
+            get_input_files(os.path.join(self.temp_dir, 'archive.csv'))
+
+    def test_hash_iterator(self):
+        """ The chunks of all the files are hashed by one pool, in order """
+        adapter = CsvAdapter(file_name_raw=self.temp_dir, schema_target='reconciliation_db',
+                             file_name_hash=self.paths(['transaction_hashed.csv'])[0],
+                             storage_table='storage')
+        self.assertEqual(list(adapter.files), self.paths(self.names[:-1]))
+
+        lines = LINES if zstandard is not None else LINES[:2]
+        buffer = encode(lines)
+        expected = get_scheme('md5_nested_v1').hash_buffer(buffer, 0, len(buffer), 'csv_adapter')
+        self.assertEqual(''.join(adapter.hash_iterator()), expected)
+
+        # chunks smaller than the lines, cut and stitched again
+        adapter.open_mappings()
+        try:
+            hashed = adapter.stitch(map(adapter.process_chunk, adapter.chunkify(size=16)))
+            self.assertEqual(''.join(hashed), expected)
+        finally:
+            adapter.release_mappings()
+
+
+if __name__ == '__main__':
+    unittest.main()
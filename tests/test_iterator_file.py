@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+""" The file object over an iterator of pieces """
+
+import unittest
+
+from utils.iterator_file import IteratorFile
+
+
+class IteratorFileTest(unittest.TestCase):
+    """ The lines span the pieces, of strings or of bytes """
+    PIECES = ['ab\ncd', '', 'ef\n', 'g\nh']
+
+    @staticmethod
+    def convert(kind, values):
+        """ The strings as str or as bytes """
+        if kind is str:
+            return list(values)
+        return [value.encode('ascii') for value in values]
+
+    def pieces(self, kind):
+        """ The pieces as str or as bytes """
+        return self.convert(kind, self.PIECES)
+
+    def test_readline(self):
+        """ A line ends after its new line, the last one at the end """
+        for kind in (str, bytes):
+            file = IteratorFile(self.pieces(kind))
+            self.assertEqual(list(iter(file.readline, kind())),
+                             self.convert(kind, ['ab\n', 'cdef\n', 'g\n', 'h']))
+            self.assertEqual(file.readline(), kind())
+
+    def test_readline_size(self):
+        """ A line is cut at size characters """
+        for kind in (str, bytes):
+            file = IteratorFile(self.pieces(kind))
+            self.assertEqual([file.readline(3) for _ in range(6)],
+                             self.convert(kind, ['ab\n', 'cde', 'f\n', 'g\n', 'h', '']))
+
+    def test_read(self):
+        """ Blocks of size characters across the pieces, then the rest """
+        for kind in (str, bytes):
+            data = kind().join(self.pieces(kind))
+            file = IteratorFile(self.pieces(kind))
+            self.assertEqual(file.read(4), data[:4])
+            self.assertEqual(file.read(0), kind())
+            self.assertEqual(file.readline(), data[4:8])
+            self.assertEqual(file.read(), data[8:])
+            self.assertEqual(file.read(), kind())
+
+    def test_bytearray(self):
+        """ The pieces of the binary COPY may be bytearrays """
+        file = IteratorFile([bytearray(b'x\ny'), b'z\n'])
+        self.assertEqual(file.readline(), bytearray(b'x\n'))
+        self.assertEqual(file.readline(), b'yz\n')
+
+    def test_empty(self):
+        """ No pieces at all """
+        file = IteratorFile([])
+        self.assertEqual(file.read(), '')
+        self.assertEqual(file.readline(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+""" The id_num_row ranges of the range planner """
+
+import unittest
+
+from adapters.range_planner import RangePlanner
+
+
+class StatsDatabase:
+    """ Answers the statistics queries of the planner, no server needed:
+        the histogram is there once the column is analyzed """
+    def __init__(self, histogram=None, ntile=None, analyzed=True):
+        self.histogram = histogram
+        self.ntile = ntile or []
+        self.analyzed = analyzed
+
+    def query_one(self, query, **kwargs):
+        """ The histogram_bounds of pg_stats """
+        return (self.histogram if self.analyzed else None,)
+
+    def query(self, query, **kwargs):
+        """ The ntile bounds """
+        return [(value,) for value in self.ntile]
+
+    def execute(self, query, **kwargs):
+        """ The analyze """
+        self.analyzed = True
+
+
+class RangePlannerTest(unittest.TestCase):
+    """ Splitting of the bounds and the ranges covering the ids """
+    def assert_covers(self, ranges, min_value, max_value):
+        """ The ranges follow each other from min_value to max_value """
+        self.assertEqual(ranges[0][0], min_value)
+        self.assertEqual(ranges[-1][1], max_value)
+        for previous, current in zip(ranges, ranges[1:]):
+            self.assertEqual(previous[1], current[0])
+        for start, end in ranges:
+            self.assertLess(start, end)
+
+    def test_split_fewer_tasks(self):
+        """ Fewer tasks than buckets: the buckets are joined """
+        self.assertEqual(RangePlanner.split_bounds([0, 10, 20, 30, 40], 2), [0, 20, 40])
+        self.assertEqual(RangePlanner.split_bounds([0, 10, 20, 30, 40], 4),
+                         [0, 10, 20, 30, 40])
+
+    def test_split_more_tasks(self):
+        """ More tasks than buckets: every bucket is divided by the width """
+        self.assertEqual(RangePlanner.split_bounds([0, 10, 20], 4), [0, 5, 10, 15, 20])
+        self.assertEqual(RangePlanner.split_bounds([0, 100], 3), [0, 33, 66, 100])
+
+    def test_plan_histogram(self):
+        """ Skewed ids: the ranges follow the histogram, not the width """
+        database = StatsDatabase(histogram=[0, 10, 20, 30, 1000000])
+        planner = RangePlanner(database, 'raw', 'transaction_log', rows_per_task=25)
+
+        self.assertEqual(planner.plan(100, 1000000),
+                         [[0, 10], [10, 20], [20, 30], [30, 1000000]])
+
+    def test_plan_analyze(self):
+        """ No statistics yet: the column is analyzed first """
+        database = StatsDatabase(histogram=[0, 50, 100], analyzed=False)
+        planner = RangePlanner(database, 'raw', 'transaction_log', rows_per_task=50)
+
+        self.assertEqual(planner.plan(100, 100), [[0, 50], [50, 100]])
+        self.assertTrue(database.analyzed)
+
+    def test_plan_ntile(self):
+        """ Without a histogram the ntile bounds are taken """
+        database = StatsDatabase(ntile=[40, 70, 100])
+        planner = RangePlanner(database, 'raw', 'transaction_log', rows_per_task=34)
+
+        self.assertEqual(planner.plan(100, 100), [[0, 40], [40, 70], [70, 100]])
+
+    def test_plan_tail(self):
+        """ The rows added after the statistics get ranges of their own,
+            a short tail goes into the last range """
+        database = StatsDatabase(histogram=[0, 50, 100])
+        planner = RangePlanner(database, 'raw', 'transaction_log', rows_per_task=50)
+
+        self.assertEqual(planner.plan(100, 210), [[0, 50], [50, 100], [100, 150], [150, 210]])
+
+    def test_plan_watermark(self):
+        """ The ranges start after min_value """
+        database = StatsDatabase(histogram=[0, 100, 200, 300])
+        planner = RangePlanner(database, 'raw', 'transaction_log', rows_per_task=100)
+
+        ranges = planner.plan(200, 300, min_value=100)
+        self.assert_covers(ranges, 100, 300)
+
+    def test_plan_single_task(self):
+        """ One task needs no statistics """
+        planner = RangePlanner(None, 'raw', 'transaction_log', rows_per_task=1000)
+
+        self.assertEqual(planner.plan(10, 10), [[0, 10]])
+        self.assertEqual(planner.plan(0, 10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" The sort-merge engine against a brute-force classifier """
+
+import random
+import unittest
+
+from engines.records import UID_SIZE
+from engines.report import MATCHED, HASH_MISMATCH, MISSING_IN_CSV, MISSING_IN_DB
+from engines.sort_merge import SortMergeEngine
+from tests.classifier import brute_force, pack, random_sides, unpack_uids
+
+
+def run_sort_merge(db_rows, csv_rows, run_rows=5, batch=3):
+    """ Return the report counts and the matched uids of the sort-merge,
+        the runs are tiny so that the groups span many blocks """
+    engine = SortMergeEngine(run_mb=1)
+    engine.run_rows = run_rows
+    try:
+        engine.add_db(pack(db_rows))
+        for pos in range(0, len(csv_rows), batch):
+            engine.add_csv(pack(csv_rows[pos:pos + batch]))
+        return engine.finish().counts, unpack_uids(engine.matched_uids())
+    finally:
+        engine.close()
+
+
+class SortMergeTest(unittest.TestCase):
+    """ Every transaction_uid is counted once, as the database does """
+    def setUp(self):
+        self.uid = b'\x11' * UID_SIZE
+        self.right = b'\x22' * 16
+        self.wrong = b'\x33' * 16
+
+    def test_duplicated_wrong_digest(self):
+        """ Two CSV rows with the same wrong digest are not a match """
+        db_rows = [(self.uid, self.right)]
+        csv_rows = [(self.uid, self.wrong), (self.uid, self.wrong)]
+
+        self.assertEqual(run_sort_merge(db_rows, csv_rows),
+                         ({MATCHED: 0, HASH_MISMATCH: 1, MISSING_IN_CSV: 0, MISSING_IN_DB: 0},
+                          set()))
+
+    def test_duplicated_matched(self):
+        """ A duplicated uid is matched once """
+        db_rows = [(self.uid, self.right), (self.uid, self.wrong)]
+        csv_rows = [(self.uid, self.right)] * 3
+
+        self.assertEqual(run_sort_merge(db_rows, csv_rows),
+                         ({MATCHED: 1, HASH_MISMATCH: 0, MISSING_IN_CSV: 0, MISSING_IN_DB: 0},
+                          {self.uid}))
+
+    def test_empty_sides(self):
+        """ One of the sides has no rows at all """
+        rows = [(self.uid, self.right), (self.uid, self.right)]
+        for db_rows, csv_rows in ((rows, []), ([], rows), ([], [])):
+            self.assertEqual(run_sort_merge(db_rows, csv_rows), brute_force(db_rows, csv_rows))
+
+    def test_random_duplicates(self):
+        """ Random sides with duplicated uids and digests """
+        for seed in range(200):
+            db_rows, csv_rows = random_sides(random.Random(seed))
+            self.assertEqual(run_sort_merge(db_rows, csv_rows), brute_force(db_rows, csv_rows),
+                             'seed %s' % seed)
+
+    def test_uid_over_blocks(self):
+        """ One uid has more rows than the merge blocks of its runs """
+        rng = random.Random(3)
+        uids = [bytes([value]) * UID_SIZE for value in range(3)]
+        digests = [bytes([value]) * 16 for value in range(3)]
+        db_rows = [(uids[0] if index % 7 else rng.choice(uids), rng.choice(digests))
+                   for index in range(6000)]
+        csv_rows = [(uids[0] if index % 5 else rng.choice(uids), rng.choice(digests[1:]))
+                    for index in range(5000)]
+        self.assertEqual(run_sort_merge(db_rows, csv_rows, run_rows=3000, batch=500),
+                         brute_force(db_rows, csv_rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+""" The CSV watermarks of the incremental runs """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from adapters.csv_adapter import CsvAdapter
+from utils.digest import get_scheme
+from tests.test_digest import LINES
+
+
+def read_all(file_name):
+    """ One run over the file: the hash lines and the watermark to save """
+    adapter = CsvAdapter(file_name_raw=file_name, schema_target='reconciliation_db',
+                         file_name_hash=file_name + '.hash', storage_table='storage')
+    return adapter, adapter.files[file_name]
+
+
+def hash_file(adapter, csv_file, size=64):
+    """ Hash the chunks of the file as the workers do """
+    return ''.join(adapter.process_wrapper(file_name, chunk_start, chunk_size)
+                   for file_name, chunk_start, chunk_size in csv_file.chunkify(size))
+
+
+class WatermarkTest(unittest.TestCase):
+    """ A line being appended is left for the next run """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.temp_dir, 'transactions.csv')
+        self.scheme = get_scheme('md5_nested_v1')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def expected(self, lines):
+        """ The hash lines of complete lines """
+        buffer = ''.join(line + '\n' for line in lines).encode('utf-8')
+        return self.scheme.hash_buffer(buffer, 0, len(buffer), 'csv_adapter')
+
+    def test_partial_line(self):
+        """ The first run stops before the partial line, the second one
+            reads it once it is complete """
+        complete = ''.join(line + '\n' for line in LINES[:2]).encode('utf-8')
+        with open(self.file_name, 'wb') as file:
+            file.write(complete + LINES[2][:50].encode('utf-8'))
+
+        adapter, csv_file = read_all(self.file_name)
+        self.assertEqual(csv_file.file_end, len(complete))
+        self.assertEqual(hash_file(adapter, csv_file), self.expected(LINES[:2]))
+        watermark = (csv_file.file_end, csv_file.get_fingerprint(csv_file.file_end))
+
+        with open(self.file_name, 'ab') as file:
+            file.write(LINES[2][50:].encode('utf-8') + b'\n')
+
+        adapter, csv_file = read_all(self.file_name)
+        csv_file.set_watermark(*watermark)
+        self.assertEqual(csv_file.file_start, len(complete))
+        self.assertEqual(hash_file(adapter, csv_file), self.expected(LINES[2:]))
+
+    def test_no_complete_line(self):
+        """ A file of one partial line has nothing to read yet """
+        with open(self.file_name, 'wb') as file:
+            file.write(LINES[0].encode('utf-8'))
+
+        adapter, csv_file = read_all(self.file_name)
+        self.assertEqual(csv_file.file_end, 0)
+        self.assertEqual(hash_file(adapter, csv_file), '')
+
+    def test_changed_file(self):
+        """ A rewritten head means the file is read from the beginning """
+        with open(self.file_name, 'wb') as file:
+            file.write(''.join(line + '\n' for line in LINES[:2]).encode('utf-8'))
+        _, csv_file = read_all(self.file_name)
+        watermark = (csv_file.file_end, csv_file.get_fingerprint(csv_file.file_end))
+
+        with open(self.file_name, 'wb') as file:
+            file.write(''.join(line + '\n' for line in LINES[::-1]).encode('utf-8'))
+
+        adapter, csv_file = read_all(self.file_name)
+        csv_file.set_watermark(*watermark)
+        self.assertEqual(csv_file.file_start, 0)
+        self.assertEqual(hash_file(adapter, csv_file), self.expected(LINES[::-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
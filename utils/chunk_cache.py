@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+""" Content-addressed cache of the hashed chunks """
+
+import os
+import struct
+import hashlib
+import tempfile
+
+from utils.monitoring import Monitoring
+
+m = Monitoring('chunk_cache')
+
+
+class ChunkCache:
+    """ Keeps the packed (uid, digest) records of every hashed chunk in
+        a file named by the chunk identity and content, old entries are
+        evicted by the last access time """
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def checksum(data):
+        """ Return the checksum of the raw chunk """
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @staticmethod
+    def get_key(file_name, chunk_start, chunk_size, checksum, scheme_id):
+        """ Return the cache key of a chunk """
+        identity = '\t'.join([os.path.abspath(file_name),
+                              str(chunk_start),
+                              str(chunk_size),
+                              checksum,
+                              scheme_id])
+        return hashlib.blake2b(identity.encode('utf-8'), digest_size=20).hexdigest()
+
+    def get_path(self, key):
+        """ Return the file of a cache entry """
+        return os.path.join(self.cache_dir, key + '.bin')
+
+    def get(self, key):
+        """ Return the cached records or None """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        """ Save the records, atomically for the concurrent workers """
+        try:
+            file_tmp, path_tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(file_tmp, 'wb') as file:
+                file.write(data)
+            os.replace(path_tmp, self.get_path(key))
+        except OSError as err:
+            m.error('OOps! Chunk cache writing FAILED! Reason: %s' % str(err))
+
+    def get_parts(self, key):
+        """ Return the cached list of byte strings or None """
+        data = self.get(key)
+        if data is None:
+            return None
+
+        parts = []
+        pos = 0
+        while pos < len(data):
+            size = struct.unpack_from('<Q', data, pos)[0]
+            parts.append(data[pos + 8:pos + 8 + size])
+            pos += 8 + size
+        return parts
+
+    def put_parts(self, key, parts):
+        """ Save a list of byte strings as one entry, every one
+            prefixed by its length """
+        self.put(key, b''.join(struct.pack('<Q', len(part)) + bytes(part) for part in parts))
+
+    def evict(self):
+        """ Remove the least recently used entries above the size limit """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.bin'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+                removed += 1
+            except OSError:
+                pass
+
+        m.info('Chunk cache: %s entries, %s Mb, %s evicted'
+               % (len(entries) - removed, round(total_size / (1024 * 1024), 2), removed))
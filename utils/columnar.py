@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+""" Columnar hashing of the CSV chunks
+
+    A chunk is parsed by pyarrow into typed columns and every column is
+    turned into the canonical text of PostgreSQL in one vectorized call:
+    lower-case uuid, to_char() of the timestamp, float8out() of the
+    amount, \\N for NULL. Only the digest itself is computed row by row:
+    arrow and numpy have no md5 or blake2b kernel, so the mode is about as
+    fast as hashing the raw lines. It is the compatibility path for the
+    files whose text is not the one of PostgreSQL (upper-case uuids,
+    250.0 for 250), the raw lines stay the default.
+"""
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
+from engines.records import UID_SIZE
+from utils.digest import NULL_TEXT, pg_float8_text
+
+CSV_COLUMNS = ('transaction_uid',
+               'account_uid',
+               'transaction_date',
+               'type_deal',
+               'transaction_amount')
+
+RECORD_DTYPE = np.dtype([('uid', 'S%s' % UID_SIZE), ('digest', 'S%s' % UID_SIZE)])
+
+
+def check_arrow():
+    """ Fail early if pyarrow is not installed """
+    if pa is None:
+        raise ValueError('The arrow ingestion mode requires pyarrow')
+
+
+def read_batch(buffer, start, end):
+    """ Parse buffer[start:end] (whole tab separated lines) into a table """
+    with memoryview(buffer) as view:
+        source = pa.BufferReader(pa.py_buffer(view[start:end]))
+        return pa_csv.read_csv(
+            source,
+            read_options=pa_csv.ReadOptions(column_names=list(CSV_COLUMNS),
+                                            use_threads=False),
+            parse_options=pa_csv.ParseOptions(delimiter='\t', quote_char=False),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={'transaction_uid': pa.string(),
+                              'account_uid': pa.string(),
+                              'transaction_date': pa.timestamp('us'),
+                              'type_deal': pa.string(),
+                              'transaction_amount': pa.float64()},
+                null_values=[NULL_TEXT],
+                strings_can_be_null=True))
+
+
+def float8_text(column):
+    """ Return the float8out() text of a float64 column, integers of the
+        usual size are formatted by arrow, the rest one by one """
+    values = column.to_numpy(zero_copy_only=False)
+    with np.errstate(invalid='ignore'):
+        integral = (np.isfinite(values) & (values == np.trunc(values))
+                    & (np.abs(values) < 1e15) & ~((values == 0) & np.signbit(values)))
+
+    text = pc.cast(pa.array(np.where(integral, values, 0).astype(np.int64)), pa.string())
+    if not integral.all():
+        text = np.array(text.to_pylist(), dtype=object)
+        for index in np.flatnonzero(~integral):
+            text[index] = pg_float8_text(float(values[index]))
+        text = pa.array(text, type=pa.string())
+
+    # NULL stays NULL
+    return pc.if_else(pc.is_valid(column), text, pa.scalar(None, pa.string()))
+
+
+def timestamp_text(column):
+    """ Return the to_char(..., 'YYYY-MM-DD HH24:MI:SS') text of a timestamp
+        column: the string cast of arrow is this format, and is much faster
+        than pc.strftime """
+    return pc.cast(pc.cast(column, pa.timestamp('s'), safe=False), pa.string())
+
+
+def canonical_payloads(table):
+    """ Return the canonical 'account\\tdate\\ttype\\tamount' binary column """
+    columns = [pc.utf8_lower(table['account_uid'].combine_chunks()),
+               timestamp_text(table['transaction_date'].combine_chunks()),
+               table['type_deal'].combine_chunks(),
+               float8_text(table['transaction_amount'].combine_chunks())]
+
+    return pc.cast(pc.binary_join_element_wise(*[pc.fill_null(column, NULL_TEXT)
+                                                 for column in columns], '\t'),
+                   pa.binary())
+
+
+def hash_csv_buffer(buffer, start, end, scheme, adapter_name=None):
+    """ Hash buffer[start:end] a batch at a time. Return 'adapter\\tuid\\thash'
+        lines if adapter_name is given, the packed records otherwise """
+    return hash_table(read_batch(buffer, start, end), scheme, adapter_name)
+
+
+def hash_table(table, scheme, adapter_name=None):
+    """ Hash a table of CSV_COLUMNS, the output is the one of hash_csv_buffer """
+    if not table.num_rows:
+        return '' if adapter_name is not None else b''
+
+    row_digest = scheme.row_digest
+    digests = [row_digest(payload) for payload in canonical_payloads(table).to_pylist()]
+    uids = pc.utf8_lower(table['transaction_uid'].combine_chunks())
+
+    if adapter_name is not None:
+        lines = pc.binary_join_element_wise(adapter_name, uids, pa.array(digests), '\t')
+        return '\n'.join(lines.to_pylist()) + '\n'
+
+    records = np.empty(table.num_rows, dtype=RECORD_DTYPE)
+    records['uid'] = np.frombuffer(bytes.fromhex(''.join(
+        pc.replace_substring(uids, '-', '').to_pylist())), dtype=RECORD_DTYPE['uid'])
+    records['digest'] = np.frombuffer(bytes.fromhex(''.join(digests)),
+                                      dtype=RECORD_DTYPE['digest'])
+    return records.tobytes()
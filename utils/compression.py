@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+""" Compressed CSV inputs: gzip and zstd
+
+    A gzip or zstd file made of many independent frames (bgzip blocks,
+    zstd -B / pzstd / the seekable format) is indexed by its frame
+    headers without decompressing it, so the groups of frames can be
+    decompressed by the workers in parallel. Any other file is read as
+    one stream.
+"""
+
+import gzip
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# the bytes of the frame content size by the flag, and of the dictionary id
+ZSTD_FCS_SIZES = (0, 2, 4, 8)
+ZSTD_DID_SIZES = (0, 1, 2, 4)
+
+
+def detect_compression(file_name):
+    """ Return GZIP, ZSTD or None by the magic bytes of the file """
+    with open(file_name, 'rb') as file:
+        magic = file.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return GZIP
+    if magic == ZSTD_MAGIC:
+        check_zstd()
+        return ZSTD
+    return None
+
+
+def check_zstd():
+    """ Fail early if zstandard is not installed """
+    if zstandard is None:
+        raise ValueError('The zstd inputs require zstandard')
+
+
+def bgzf_frames(buffer, start, end):
+    """ Return the offsets of the bgzip blocks, None if it is not bgzip:
+        every block is a gzip member with its size in the BC extra field """
+    offsets = []
+    pos = start
+    while pos < end:
+        # ID1 ID2 CM=8 FLG=FEXTRA ... XLEN
+        if buffer[pos:pos + 4] != b'\x1f\x8b\x08\x04' or pos + 12 > end:
+            return None
+        xlen = struct.unpack_from('<H', buffer, pos + 10)[0]
+
+        block_size = None
+        field = pos + 12
+        while field + 4 <= pos + 12 + xlen:
+            field_size = struct.unpack_from('<H', buffer, field + 2)[0]
+            if buffer[field:field + 2] == b'BC' and field_size == 2:
+                block_size = struct.unpack_from('<H', buffer, field + 4)[0] + 1
+                break
+            field += 4 + field_size
+
+        if block_size is None:
+            return None
+        offsets.append(pos)
+        pos += block_size
+
+    return offsets if pos == end else None
+
+
+def zstd_frames(buffer, start, end):
+    """ Return the offsets of the zstd frames, None if the file can't be
+        walked: the frame header and the block headers are read only """
+    offsets = []
+    pos = start
+    while pos < end:
+        if pos + 8 > end:
+            return None
+        magic = struct.unpack_from('<I', buffer, pos)[0]
+        if magic & 0xfffffff0 == 0x184d2a50:
+            # skippable frame (the seek table of the seekable format too)
+            pos += 8 + struct.unpack_from('<I', buffer, pos + 4)[0]
+            continue
+        if buffer[pos:pos + 4] != ZSTD_MAGIC:
+            return None
+
+        offsets.append(pos)
+        descriptor = buffer[pos + 4]
+        single_segment = descriptor >> 5 & 1
+        fcs_size = ZSTD_FCS_SIZES[descriptor >> 6] or single_segment
+        has_checksum = descriptor >> 2 & 1
+        pos += (5 + (not single_segment) + ZSTD_DID_SIZES[descriptor & 3] + fcs_size)
+
+        while True:
+            if pos + 3 > end:
+                return None
+            header = int.from_bytes(buffer[pos:pos + 3], 'little')
+            block_type = header >> 1 & 3
+            if block_type == 3:
+                return None
+            pos += 3 + (1 if block_type == 1 else header >> 3)
+            if header & 1:
+                break
+        pos += 4 * has_checksum
+
+    return offsets if pos == end else None
+
+
+def get_frames(buffer, start, end, compression):
+    """ Return the offsets of the independent frames of buffer[start:end],
+        None if it has to be read as one stream """
+    if compression == GZIP:
+        offsets = bgzf_frames(buffer, start, end)
+    else:
+        offsets = zstd_frames(buffer, start, end)
+    return offsets if offsets and len(offsets) > 1 else None
+
+
+def decompress(compression, data):
+    """ Decompress whole frames """
+    if compression == GZIP:
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True).read()
+
+
+def open_stream(file, compression):
+    """ Return the decompressing reader of an open binary file """
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=file, mode='rb')
+    return zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True)
@@ -18,12 +18,49 @@ class ConfigReader:
         self.conf['reconciliation_db'] = self.config.get('POSTGRESQL', 'reconciliation_db')
         self.conf['transaction_db_raw'] = self.config.get('POSTGRESQL', 'transaction_db_raw')
         self.conf['transaction_db_clean'] = self.config.get('POSTGRESQL', 'transaction_db_clean')
+        self.conf['extract_mode'] = self.config.get('POSTGRESQL', 'extract_mode', fallback='sql')
+        self.conf['parallel_workers'] = self.config.getint('POSTGRESQL', 'parallel_workers',
+                                                           fallback=0)
+        self.conf['range_retries'] = self.config.getint('POSTGRESQL', 'range_retries', fallback=3)
+        self.conf['rows_per_task'] = self.config.getint('POSTGRESQL', 'rows_per_task',
+                                                        fallback=50000)
+        self.conf['storage_layout'] = self.config.get('POSTGRESQL', 'storage_layout',
+                                                      fallback='classic')
+        self.conf['storage_partitions'] = self.config.getint('POSTGRESQL', 'storage_partitions',
+                                                             fallback=0)
+        self.conf['publish_batch_rows'] = self.config.getint('POSTGRESQL', 'publish_batch_rows',
+                                                             fallback=100000)
+        self.conf['copy_format'] = self.config.get('POSTGRESQL', 'copy_format', fallback='text')
+        self.conf['pool_size'] = self.config.getint('POSTGRESQL', 'pool_size', fallback=4)
+        self.conf['work_mem'] = self.config.get('POSTGRESQL', 'work_mem', fallback='')
+        self.conf['maintenance_work_mem'] = self.config.get('POSTGRESQL', 'maintenance_work_mem',
+                                                            fallback='')
+        self.conf['parallel_workers_per_gather'] = self.config.get(
+            'POSTGRESQL', 'parallel_workers_per_gather', fallback='')
 
         self.conf['file_name_raw'] = self.config.get('CSV', 'file_name_raw')
         self.conf['file_name_hash'] = self.config.get('CSV', 'file_name_hash')
+        self.conf['streaming'] = self.config.getboolean('CSV', 'streaming', fallback=False)
+        self.conf['cache_dir'] = self.config.get('CSV', 'cache_dir', fallback='')
+        self.conf['cache_max_mb'] = self.config.getint('CSV', 'cache_max_mb', fallback=1024)
+        self.conf['ingest_mode'] = self.config.get('CSV', 'ingest_mode', fallback='lines')
+
+        self.conf['parquet_file_name'] = self.config.get('PARQUET', 'file_name_raw', fallback='')
+        self.conf['date_from'] = self.config.get('PARQUET', 'date_from', fallback='')
+        self.conf['date_to'] = self.config.get('PARQUET', 'date_to', fallback='')
 
         self.conf['initial_date'] = self.config.get('MAIN', 'initial_date')
+        self.conf['source'] = self.config.get('MAIN', 'source', fallback='csv')
         self.conf['random_accounts'] = self.config.get('MAIN', 'random_accounts')
+        self.conf['engine'] = self.config.get('MAIN', 'engine', fallback='database')
+        self.conf['sort_dir'] = self.config.get('MAIN', 'sort_dir', fallback='')
+        self.conf['sort_run_mb'] = self.config.getint('MAIN', 'sort_run_mb', fallback=256)
+        self.conf['digest_scheme'] = self.config.get('MAIN', 'digest_scheme',
+                                                     fallback='md5_nested_v1')
+        self.conf['incremental'] = self.config.getboolean('MAIN', 'incremental', fallback=False)
+        self.conf['metrics_json'] = self.config.get('MAIN', 'metrics_json', fallback='')
+        self.conf['metrics_prom'] = self.config.get('MAIN', 'metrics_prom', fallback='')
+        self.conf['profile_dir'] = self.config.get('MAIN', 'profile_dir', fallback='')
 
     def get_attr(self, attribute_name):
         """ Return the specific attribute """
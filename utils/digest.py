@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+""" Row digest schemes
+
+    A row is encoded canonically as the text of account_uid,
+    transaction_date, type_deal and transaction_amount joined by tabs,
+    NULL written as \\N. It is exactly the tail of a CSV line after
+    transaction_uid and of a COPY ... TO STDOUT line, so both sides hash
+    the same bytes without re-encoding the fields.
+"""
+
+import hashlib
+from decimal import Decimal
+
+import numpy as np
+from psycopg2 import sql
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+NULL_TEXT = '\\N'
+
+# to_char(transaction_date, 'YYYY-MM-DD HH24:MI:SS') in strftime terms
+PG_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SQL_NESTED_MD5 = sql.SQL("""md5(
+                        coalesce(md5(account_uid::text), ' ') ||
+                        coalesce(md5(to_char(transaction_date,
+                            'YYYY-MM-DD HH24:MI:SS')), ' ') ||
+                        coalesce(md5(type_deal::text), ' ') ||
+                        coalesce(md5(transaction_amount::text), ' '))""")
+
+SQL_CANONICAL_ROW = sql.SQL("""(
+                        coalesce(account_uid::text, '\\N') || E'\\t' ||
+                        coalesce(to_char(transaction_date,
+                            'YYYY-MM-DD HH24:MI:SS'), '\\N') || E'\\t' ||
+                        coalesce(type_deal::text, '\\N') || E'\\t' ||
+                        coalesce(transaction_amount::text, '\\N'))""")
+
+# The raw columns in the canonical text form, for hashing outside of the database
+SQL_CANONICAL_COLUMNS = sql.SQL("""
+                    transaction_uid,
+                    account_uid,
+                    to_char(transaction_date, 'YYYY-MM-DD HH24:MI:SS'),
+                    type_deal,
+                    transaction_amount""")
+
+
+def shortest_repr(value):
+    """ The shortest digits which read back as the value, like repr(),
+        but never exactly half way to a neighbour (PostgreSQL doesn't
+        take the bounds of the rounding interval, python does) """
+    text = repr(value)
+    exact = Decimal(value)
+    delta = Decimal(text) - exact
+    if not delta:
+        return text
+
+    # math.nextafter is 3.9+ only
+    neighbour = float(np.nextafter(value, np.inf if delta > 0 else -np.inf))
+    if abs(delta) * 2 < abs(Decimal(neighbour) - exact):
+        return text
+
+    digits = len(text.partition('e')[0].replace('.', '').strip('0'))
+    while True:
+        text = '%.*e' % (digits, value)
+        if float(text) == value and abs(Decimal(text) - exact) * 2 < abs(Decimal(neighbour) - exact):
+            return text
+        digits += 1
+
+
+def pg_float8_text(value):
+    """ Return the float8 text of PostgreSQL (12+): the shortest exact
+        digits, the exponent form below 1e-4 and from 1e15 """
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value == 0:
+        return '-0' if str(value)[0] == '-' else '0'
+
+    sign = '-' if value < 0 else ''
+    mantissa, _, exponent = shortest_repr(abs(value)).partition('e')
+    int_part, _, frac_part = mantissa.partition('.')
+    digits = (int_part + frac_part).lstrip('0')
+    # the decimal exponent of the first significant digit
+    point = len(int_part) - (len(int_part + frac_part) - len(digits)) - 1 + int(exponent or 0)
+    digits = digits.rstrip('0')
+
+    if point < -4 or point >= 15:
+        text = digits[0] + ('.' + digits[1:] if len(digits) > 1 else '')
+        return '%s%se%s%02d' % (sign, text, '-' if point < 0 else '+', abs(point))
+    if point < 0:
+        return '%s0.%s%s' % (sign, '0' * (-point - 1), digits)
+    if len(digits) <= point + 1:
+        return sign + digits + '0' * (point + 1 - len(digits))
+    return '%s%s.%s' % (sign, digits[:point + 1], digits[point + 1:])
+
+
+def pg_timestamp_text(value):
+    """ Return the text of a timestamp like to_char(..., 'YYYY-MM-DD HH24:MI:SS') """
+    return value.strftime(PG_TIMESTAMP_FORMAT)
+
+
+def md5_nested(payload):
+    """ md5 of the md5 of every field, the original scheme """
+    return hashlib.md5(b''.join(b' ' if field == b'\\N'
+                                else hashlib.md5(field).hexdigest().encode()
+                                for field in payload.split(b'\t'))).hexdigest()
+
+
+def md5_row(payload):
+    """ One md5 of the whole canonical row """
+    return hashlib.md5(payload).hexdigest()
+
+
+def blake2b_row(payload):
+    """ 128-bit blake2b of the whole canonical row """
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def xxh128_row(payload):
+    """ 128-bit xxh3 of the whole canonical row """
+    return xxhash.xxh3_128_hexdigest(payload)
+
+
+class DigestScheme:
+    """ Versioned row digest: the python function and, if the database
+        can compute the same value, the SQL expression for it """
+    def __init__(self, scheme_id, row_digest, sql_expression=None):
+        self.scheme_id = scheme_id
+        self.row_digest = row_digest
+        self.sql_expression = sql_expression
+
+    def hash_buffer(self, buffer, start, end, adapter_name=None):
+        """ Hash the 'uid\\tfields...' lines of buffer[start:end] without
+            decoding them: the chunk is copied once and split into lines.
+            Return 'adapter\\tuid\\thash' lines if adapter_name is given,
+            the packed (uid, digest) records otherwise """
+        row_digest = self.row_digest
+        with memoryview(buffer) as view:
+            lines = view[start:end].tobytes().splitlines()
+
+        output = []
+        for line in lines:
+            if not line:
+                continue
+            uid, tab, payload = line.partition(b'\t')
+            if not tab:
+                raise ValueError('No fields in the line %r' % line[:64])
+            digest = row_digest(payload)
+            if adapter_name is None:
+                output.append(bytes.fromhex(uid.decode('ascii').replace('-', '') + digest))
+            else:
+                output.append(adapter_name + '\t' + uid.decode('ascii') + '\t' + digest + '\n')
+
+        return ''.join(output) if adapter_name is not None else b''.join(output)
+
+
+SCHEMES = {}
+
+
+def register_scheme(scheme):
+    """ Add a scheme into the registry """
+    SCHEMES[scheme.scheme_id] = scheme
+
+
+def get_scheme(scheme_id):
+    """ Return a registered scheme by its id """
+    if scheme_id not in SCHEMES:
+        raise ValueError('Unknown digest scheme %s, available: %s'
+                         % (scheme_id, ', '.join(sorted(SCHEMES))))
+    return SCHEMES[scheme_id]
+
+
+register_scheme(DigestScheme('md5_nested_v1', md5_nested, SQL_NESTED_MD5))
+register_scheme(DigestScheme('md5_row_v1', md5_row,
+                             sql.SQL('md5({0})').format(SQL_CANONICAL_ROW)))
+register_scheme(DigestScheme('blake2b_row_v1', blake2b_row))
+
+if xxhash is not None:
+    register_scheme(DigestScheme('xxh128_row_v1', xxh128_row))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" File-like wrapper over an iterator of strings or bytes """
+
+import io
+
+
+class IteratorFile(io.TextIOBase):
+    """ Read-only file object which pulls its data from an iterator,
+        so it can be passed to copy_from/copy_expert directly """
+    def __init__(self, iterator):
+        self._iterator = iter(iterator)
+        self._buffer = ''
+        self._pos = 0
+        # '' or b'', the type of the pieces, and its new line
+        self._empty = ''
+        self._newline = '\n'
+
+    def readable(self):
+        """ The stream is readable """
+        return True
+
+    def _fill(self):
+        """ Take the next piece from the iterator, False at the end """
+        while self._pos >= len(self._buffer):
+            try:
+                self._buffer = next(self._iterator)
+                self._empty = self._buffer[:0]
+                self._newline = '\n' if isinstance(self._buffer, str) else b'\n'
+                self._pos = 0
+            except StopIteration:
+                self._buffer = self._empty
+                self._pos = 0
+                return False
+        return True
+
+    def read(self, size=-1):
+        """ Return up to size characters, everything left if size < 0 """
+        size = -1 if size is None else size
+        parts = []
+
+        while size != 0 and self._fill():
+            if size < 0:
+                end = len(self._buffer)
+            else:
+                end = min(self._pos + size, len(self._buffer))
+                size -= end - self._pos
+
+            parts.append(self._buffer[self._pos:end])
+            self._pos = end
+
+        return self._empty.join(parts)
+
+    def readline(self, size=-1):
+        """ Return the next line including the trailing new line """
+        size = -1 if size is None else size
+        parts = []
+
+        while size != 0 and self._fill():
+            end = self._buffer.find(self._newline, self._pos)
+            end = len(self._buffer) if end < 0 else end + 1
+            if size > 0:
+                end = min(end, self._pos + size)
+                size -= end - self._pos
+
+            parts.append(self._buffer[self._pos:end])
+            found = self._buffer[end - 1:end] == self._newline
+            self._pos = end
+            if found:
+                break
+
+        return self._empty.join(parts)
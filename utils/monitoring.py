@@ -1,13 +1,445 @@
 """ Monitoring module """
 
-import logging
+import os
 import sys
+import json
+import glob
+import shutil
+import pstats
+import cProfile
+import logging
+import tempfile
+import tracemalloc
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
 from functools import wraps
 from time import time
 
+# The main process of the run, inherited by the pool workers
+METRICS_PID = 'RECONCILIATION_METRICS_PID'
+
+# The folder of the profiles, inherited by the pool workers
+PROFILE_DIR = 'RECONCILIATION_PROFILE'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class Profiler:
+    """ cProfile and tracemalloc of the stages and of the pool workers
+
+        Enabled by the RECONCILIATION_PROFILE folder. Every process writes
+        a profile per stage, <stage>.<pid>.prof, and its top allocations;
+        the main process merges them into run.prof (pstats), run.collapsed
+        (collapsed stacks for flamegraph.pl/speedscope) and run_memory.txt.
+        The profile of a stage doesn't include its nested stages. """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.stack = []
+        self.profiles = {}
+
+    @staticmethod
+    def enable(base_dir):
+        """ Turn the profiling on for this process and its future workers """
+        os.environ[PROFILE_DIR] = base_dir
+
+    @property
+    def run_dir(self):
+        """ The folder of the current run, None if the profiling is off """
+        base_dir = os.environ.get(PROFILE_DIR)
+        if not base_dir:
+            return None
+        return os.path.join(base_dir, 'run_%s' % os.environ.get(METRICS_PID, os.getpid()))
+
+    def check_process(self):
+        """ A forked worker drops the profiles of its parent """
+        if os.getpid() != self.pid:
+            if self.stack:
+                self.stack[-1][1].disable()
+            self.pid = os.getpid()
+            self.stack = []
+            self.profiles = {}
+
+    @contextmanager
+    def profile(self, stage):
+        """ Profile the block as a part of the stage """
+        run_dir = self.run_dir
+        if not run_dir:
+            yield
+            return
+
+        self.check_process()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        profile = self.profiles.setdefault(stage, cProfile.Profile())
+        if self.stack:
+            self.stack[-1][1].disable()
+        self.stack.append((stage, profile))
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.stack.pop()
+            self.dump(run_dir, stage, profile)
+            if self.stack:
+                self.stack[-1][1].enable()
+
+    def dump(self, run_dir, stage, profile):
+        """ Save the profile and the top allocations of the process """
+        os.makedirs(run_dir, exist_ok=True)
+        path = os.path.join(run_dir, '%s.%s' % (stage, self.pid))
+        profile.dump_stats(path + '.prof')
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, cProfile.__file__),
+             tracemalloc.Filter(False, pstats.__file__),
+             tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+        memory = {'peak': tracemalloc.get_traced_memory()[1],
+                  'lines': [[stat.traceback[0].filename, stat.traceback[0].lineno,
+                             stat.size, stat.count]
+                            for stat in snapshot.statistics('lineno')[:100]]}
+        with open(path + '.memory', 'w') as file:
+            json.dump(memory, file)
+
+    @staticmethod
+    def get_label(func):
+        """ Return file:line(function) of a pstats key """
+        file_name, line, name = func
+        label = name if file_name == '~' else '%s:%s(%s)' % (os.path.basename(file_name),
+                                                            line, name)
+        return label.replace(';', ',').replace(' ', '_')
+
+    def collapse(self, stats, min_share=1e-4, max_depth=60):
+        """ Return the collapsed stacks of a call graph: the own time of a
+            function is divided between its callers like their time,
+            the paths below min_share of the total time are dropped """
+        children = defaultdict(list)
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, edge in callers.items():
+                children[caller].append((func, edge[3]))
+
+        roots = [func for func, value in stats.items() if not value[4]]
+        min_seconds = min_share * sum(stats[func][3] for func in roots)
+        lines = defaultdict(float)
+
+        def walk(func, path, funcs, seconds):
+            """ `seconds` of the function's cumulative time go by this path """
+            own_time, total_time = stats[func][2], stats[func][3]
+            scale = seconds / total_time if total_time else 0
+            path = path + [self.get_label(func)]
+            lines[';'.join(path)] += own_time * scale
+            if len(path) >= max_depth:
+                return
+            funcs = funcs | {func}
+            for child, edge_time in children[func]:
+                # the recursive calls are already in the time of the caller
+                if child not in funcs and edge_time * scale >= min_seconds:
+                    walk(child, path, funcs, edge_time * scale)
+
+        for func in roots:
+            if stats[func][3] >= min_seconds:
+                walk(func, [], frozenset(), stats[func][3])
+
+        return ['%s %s' % (path, int(seconds * 1e6))
+                for path, seconds in sorted(lines.items()) if int(seconds * 1e6)]
+
+    def report(self, top=40):
+        """ Merge the profiles of all the processes of the run """
+        run_dir = self.run_dir
+        if not run_dir or not os.path.isdir(run_dir):
+            return None
+
+        files = sorted(path for path in glob.glob(os.path.join(run_dir, '*.*.prof')))
+        if not files:
+            return None
+
+        run_prof = os.path.join(run_dir, 'run.prof')
+        with open(os.path.join(run_dir, 'run.txt'), 'w') as file:
+            stats = pstats.Stats(*files, stream=file)
+            stats.dump_stats(run_prof)
+            stats.sort_stats('cumulative').print_stats(top)
+            stats.sort_stats('tottime').print_stats(top)
+
+        with open(os.path.join(run_dir, 'run.collapsed'), 'w') as file:
+            file.write('\n'.join(self.collapse(stats.stats)) + '\n')
+
+        # every file is a snapshot of the whole process: the largest
+        # value of a line in a process, summed over the processes
+        peaks = {}
+        process_allocations = defaultdict(dict)
+        for path in glob.glob(os.path.join(run_dir, '*.*.memory')):
+            with open(path) as file:
+                memory = json.load(file)
+            name = os.path.basename(path)[:-len('.memory')]
+            peaks[name] = memory['peak']
+            lines = process_allocations[name.rsplit('.', 1)[1]]
+            for file_name, line, size, count in memory['lines']:
+                key = '%s:%s' % (file_name, line)
+                lines[key] = max(lines.get(key, (0, 0)), (size, count))
+
+        allocations = defaultdict(lambda: [0, 0])
+        for lines in process_allocations.values():
+            for key, (size, count) in lines.items():
+                allocations[key][0] += size
+                allocations[key][1] += count
+
+        with open(os.path.join(run_dir, 'run_memory.txt'), 'w') as file:
+            file.write('Peak traced memory by stages and processes, Kb\n')
+            for name, peak in sorted(peaks.items()):
+                file.write('{:40} {:>12}\n'.format(name, peak // 1024))
+            file.write('\nLive allocations (the largest in a process, summed), Kb\n')
+            for name, (size, count) in sorted(allocations.items(),
+                                              key=lambda item: -item[1][0])[:top]:
+                file.write('{:>12} {:>10} {}\n'.format(size // 1024, count, name))
+
+        return run_prof
+
+
+class MetricsRegistry:
+    """ Counters, gauges and latency histograms of the run
+
+        Pool workers start with an empty registry and spool their
+        snapshots into files, the main process merges them on export.
+        Stage spans can be nested, the workers forked inside a span
+        report into its stage. """
+    def __init__(self, prefix='reconciliation', profiler=None):
+        self.prefix = prefix
+        self.profiler = profiler
+        os.environ.setdefault(METRICS_PID, str(os.getpid()))
+        self.main_pid = int(os.environ[METRICS_PID])
+        self.stack = []
+        self.reset()
+
+    def reset(self):
+        """ Forget everything except the current stages """
+        self.pid = os.getpid()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.spans = []
+
+    def check_process(self):
+        """ A forked worker must not count the values of its parent """
+        if os.getpid() != self.pid:
+            self.reset()
+
+    @property
+    def is_worker(self):
+        """ True in the pool workers """
+        return os.getpid() != self.main_pid
+
+    @property
+    def spool_dir(self):
+        """ The folder of the worker snapshots """
+        return os.path.join(tempfile.gettempdir(), 'reconciliation_metrics_%s' % self.main_pid)
+
+    @staticmethod
+    def get_key(name, labels):
+        """ Return the key of a series """
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def current_stage(self):
+        """ Return the name of the innermost stage """
+        return self.stack[-1] if self.stack else 'main'
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter """
+        self.check_process()
+        key = self.get_key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """ Set a gauge """
+        self.check_process()
+        self.gauges[self.get_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """ Add a value into a latency histogram """
+        self.check_process()
+        key = self.get_key(name, labels)
+        histogram = self.histograms.setdefault(key, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                                                     'sum': 0,
+                                                     'count': 0})
+        histogram['buckets'][bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def add_progress(self, rows, bytes_read=0, stage=None):
+        """ Count the rows processed and the bytes read by a stage """
+        stage = stage or self.current_stage()
+        self.inc('rows_processed', rows, stage=stage)
+        if bytes_read:
+            self.inc('bytes_read', bytes_read, stage=stage)
+        self.flush()
+
+    @contextmanager
+    def span(self, stage):
+        """ Measure a stage, the stages can be nested """
+        self.check_process()
+        self.stack.append(stage)
+        path = '/'.join(self.stack)
+        start = time()
+        try:
+            if self.profiler:
+                with self.profiler.profile(stage):
+                    yield
+            else:
+                yield
+        finally:
+            seconds = time() - start
+            self.stack.pop()
+            self.spans.append({'stage': stage, 'path': path, 'seconds': round(seconds, 4)})
+            self.observe('stage_seconds', seconds, stage=stage)
+
+    def snapshot(self):
+        """ Return the values of this process """
+        self.check_process()
+        return {'pid': self.pid,
+                'counters': [[name, dict(labels), value]
+                             for (name, labels), value in self.counters.items()],
+                'gauges': [[name, dict(labels), value]
+                           for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, dict(labels), value]
+                               for (name, labels), value in self.histograms.items()]}
+
+    def flush(self):
+        """ Save the snapshot of a worker for the main process """
+        if not self.is_worker:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, '%s.json' % self.pid)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """ Return the snapshots of the main process and of the workers """
+        snapshots = [self.snapshot()]
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, '*.json'))):
+            try:
+                with open(path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                pass
+        return snapshots
+
+    def summary(self):
+        """ Return the run summary: the totals, the values by workers,
+            the stages and their throughput """
+        counters, gauges, histograms, workers = {}, {}, {}, {}
+
+        for snapshot in self.collect():
+            worker_counters = workers.setdefault(str(snapshot['pid']), {})
+            for name, labels, value in snapshot['counters']:
+                key = self.get_key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+                worker_key = self.format_series(name, labels)
+                worker_counters[worker_key] = worker_counters.get(worker_key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                gauges[self.get_key(name, labels)] = value
+            for name, labels, value in snapshot['histograms']:
+                key = self.get_key(name, labels)
+                total = histograms.setdefault(key, {'buckets': [0] * len(value['buckets']),
+                                                    'sum': 0,
+                                                    'count': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+                total['sum'] += value['sum']
+                total['count'] += value['count']
+
+        # throughput of the stages, the gauge to alert on
+        stages = {}
+        for span in self.spans:
+            stage = stages.setdefault(span['stage'], {'seconds': 0})
+            stage['seconds'] = round(stage['seconds'] + span['seconds'], 4)
+        for name, stage in stages.items():
+            stage['rows'] = counters.get(self.get_key('rows_processed', {'stage': name}), 0)
+            stage['bytes'] = counters.get(self.get_key('bytes_read', {'stage': name}), 0)
+            stage['rows_per_sec'] = round(stage['rows'] / stage['seconds']) if stage['seconds'] else 0
+            if stage['rows']:
+                gauges[self.get_key('stage_rows_per_second', {'stage': name})] = stage['rows_per_sec']
+
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms,
+                'workers': {pid: values for pid, values in workers.items() if values},
+                'stages': stages, 'spans': self.spans}
+
+    @staticmethod
+    def format_series(name, labels):
+        """ Return name{label="value",...} """
+        if isinstance(labels, dict):
+            labels = sorted(labels.items())
+        if not labels:
+            return name
+        return '%s{%s}' % (name, ','.join('%s="%s"' % (key, value) for key, value in labels))
+
+    def to_prometheus(self, summary):
+        """ Return the summary in the Prometheus text format """
+        lines = []
+        printed = set()
+
+        def add_type(name, metric_type):
+            """ Describe every metric once """
+            if name not in printed:
+                printed.add(name)
+                lines.append('# TYPE %s %s' % (name, metric_type))
+
+        for (name, labels), value in sorted(summary['counters'].items()):
+            metric = '%s_%s_total' % (self.prefix, name)
+            add_type(metric, 'counter')
+            lines.append('%s %s' % (self.format_series(metric, labels), value))
+        for (name, labels), value in sorted(summary['gauges'].items()):
+            metric = '%s_%s' % (self.prefix, name)
+            add_type(metric, 'gauge')
+            lines.append('%s %s' % (self.format_series(metric, labels), value))
+        for (name, labels), value in sorted(summary['histograms'].items()):
+            metric = '%s_%s' % (self.prefix, name)
+            add_type(metric, 'histogram')
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value['buckets']):
+                cumulative += count
+                lines.append('%s %s' % (self.format_series(metric + '_bucket',
+                                                           labels + (('le', str(bound)),)),
+                                        cumulative))
+            lines.append('%s %s' % (self.format_series(metric + '_sum', labels),
+                                    round(value['sum'], 6)))
+            lines.append('%s %s' % (self.format_series(metric + '_count', labels),
+                                    value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path=None, prom_path=None):
+        """ Write the JSON summary and the Prometheus textfile,
+            then remove the worker snapshots """
+        summary = self.summary()
+
+        if json_path:
+            data = dict(summary)
+            for name in ('counters', 'gauges', 'histograms'):
+                data[name] = {self.format_series(key[0], key[1]): value
+                              for key, value in sorted(summary[name].items())}
+            with open(json_path, 'w') as file:
+                json.dump(data, file, indent=2)
+
+        if prom_path:
+            # the textfile collector must never see a half-written file
+            with open(prom_path + '.tmp', 'w') as file:
+                file.write(self.to_prometheus(summary))
+            os.replace(prom_path + '.tmp', prom_path)
+
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+        return summary
+
 
 class Monitoring:
     """ The main monitoring class """
+    # Errors logged by this process through any of the instances
+    errors_count = 0
+    # Profiling and metrics of the run shared by all the instances
+    profiler = Profiler()
+    metrics = MetricsRegistry(profiler=profiler)
+
     def __init__(self, name):
         self.__logger = self.logger_setup(name)
         self.start_time = None
@@ -33,6 +465,9 @@ class Monitoring:
 
     def error(self, message):
         """ Create a new log message into stdout """
+        Monitoring.errors_count += 1
+        Monitoring.metrics.inc('errors', logger=self.__logger.name)
+        Monitoring.metrics.flush()
         self.__logger.error(message)
 
     @staticmethod
@@ -76,7 +511,21 @@ class Monitoring:
             end = time()
             time_elapsed = round(end - start, 4)
 
+            Monitoring.metrics.observe('function_seconds', end - start, function=func.__name__)
+            Monitoring.metrics.flush()
             print('func: {:^15}. Elapsed time: {} sec'.format(func.__name__, time_elapsed))
 
             return result
         return wrapper
+
+    @staticmethod
+    def profiled(func):
+        """ Profile the function as a part of the current stage,
+            if the profiling is on """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not os.environ.get(PROFILE_DIR):
+                return func(*args, **kwargs)
+            with Monitoring.profiler.profile(Monitoring.metrics.current_stage()):
+                return func(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+""" Process pool helpers """
+
+import multiprocessing as mp
+
+
+def ordered_imap(func, tasks, processes=None, max_in_flight=None):
+    """ Yield func(task) in the order of tasks while the pool is working,
+        keeping at most max_in_flight results in memory """
+    processes = processes or mp.cpu_count()
+    max_in_flight = max_in_flight or processes * 2
+
+    pool = mp.Pool(processes)
+    jobs = []
+
+    try:
+        for task in tasks:
+            jobs.append(pool.apply_async(func, (task, )))
+
+            if len(jobs) >= max_in_flight:
+                yield jobs.pop(0).get()
+
+        while jobs:
+            yield jobs.pop(0).get()
+
+        # the workers exit by themselves and run their finalizers
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        pool.join()